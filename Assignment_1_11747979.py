@@ -12,61 +12,167 @@ This program allows the user to key in the ABO and Rh types of both the donor an
 the recipient is allowed to get blood from that donor.
 After each report, the program prompts the user for another check if needed. When the user chooses to finish, the
 program will display the total number of checks performed, and what percentage of those were found to be compatible
+
+Run with a file name (or - for stdin) to check a whole audit file of pairs at once instead. Each line holds a donor and a
+recipient group (O-,A+) or their ABO and Rh types (O,-,A,+); a line starting with "donor" is taken as a header. Every
+line is written back with its verdict (compatible, incompatible or invalid) followed by the same summary:
+python Assignment_1_11747979.py pairs.csv --output verdicts.csv
 """
 
-total_checks = 0  # accumulator variable to store the number of checks done
-compatible_results = 0  # accumulator variable to store the number of compatible results
-check = 'y'  # condition variable to prompt user if they want to continue running the program
-
-while check == 'y' or check == 'Y':  # check whether user has typed Y/y
-    print("Donor's Blood Group")  # Display heading
-    # Prompt for the user's input, convert the blood group letters to uppercase for consistency
-    donor_abo = input('\tABO Type: ').upper()  # ABO Type of the donor - priming read
-    donor_rh = input('\tRh Type: ').upper()  # Rh Type of the donor - priming read
-    print()
-    print("Recipient's Blood Group")
-    recipient_abo = input('\tABO Type: ').upper()  # ABO Type of the recipient - priming read
-    recipient_rh = input('\tRh Type: ').upper()  # Rh Type of the recipient - priming read
-
-    # Validate the user's input by checking that the right data was keyed in
-    while (donor_abo != 'A' and donor_abo != 'AB' and donor_abo != 'B' and donor_abo != 'O') or (donor_rh != '+' and \
-            donor_rh != '-') or (recipient_abo != 'A' and recipient_abo != 'AB' and recipient_abo != 'B' and \
-            recipient_abo != 'O') or (recipient_rh != '+' and recipient_rh != '-'):
-        # Generate an error message and prompt user to re-enter data
-        print('\nERROR: Please check your ABO and/or Rh data (A, AB, or O)!')
-        print("\nDonor's Blood Group")
-        donor_abo = input('\tABO Type: ').upper()
-        donor_rh = input('\tRh Type: ').upper()
-        print("\nRecipient's Blood Group")
-        recipient_abo = input('\tABO Type: ').upper()
-        recipient_rh = input('\tRh Type: ').upper()
-
-    # Check for ABO and Rh compatibility
-    not_compatible = False  # create a flag variable (set to False) to check for incompatibility
-    if donor_abo != "O" and recipient_abo != "AB" and donor_abo != recipient_abo:
-        not_compatible = True
-    if donor_rh != '-' and donor_rh != recipient_rh:
-        if not_compatible:  # if not_compatible == True
-            print('\n✗ Recipient’s blood is incompatible.')  # blood group and Rh factor do not match
+import argparse
+import sys
+import numpy as np
+from compatibility import BLOOD_GROUPS, GROUP_CODES, NO_GROUP, compatibility_matrix, encode, group_code, is_compatible
+
+CHUNK_SIZE = 1024 * 1024  # Bytes of pairs read and checked at a time in batch mode
+PAIRS = len(BLOOD_GROUPS) ** 2  # Pair index donor code * 8 + recipient code, for the 64 valid pairs
+INVALID = PAIRS  # Pair index of a line that could not be read
+BLANK = PAIRS + 1  # Pair index of an empty line, which is skipped
+# PAIR_COMPATIBLE[pair index] is True for a compatible pair: every donor group against every recipient group at once
+PAIR_COMPATIBLE = compatibility_matrix(encode(BLOOD_GROUPS), encode(BLOOD_GROUPS)).ravel()
+# Text appended to a line for each pair index
+VERDICTS = [b',compatible\n' if compatible else b',incompatible\n' for compatible in PAIR_COMPATIBLE] + \
+           [b',invalid\n', b'']
+
+
+def main():
+    """ This function checks donor and recipient pairs keyed in one at a time, until the user chooses to finish """
+    total_checks = 0  # accumulator variable to store the number of checks done
+    compatible_results = 0  # accumulator variable to store the number of compatible results
+    check = 'y'  # condition variable to prompt user if they want to continue running the program
+
+    while check == 'y' or check == 'Y':  # check whether user has typed Y/y
+        print("Donor's Blood Group")  # Display heading
+        # Prompt for the user's input, convert the blood group letters to uppercase for consistency
+        donor_abo = input('\tABO Type: ').upper()  # ABO Type of the donor - priming read
+        donor_rh = input('\tRh Type: ').upper()  # Rh Type of the donor - priming read
+        print()
+        print("Recipient's Blood Group")
+        recipient_abo = input('\tABO Type: ').upper()  # ABO Type of the recipient - priming read
+        recipient_rh = input('\tRh Type: ').upper()  # Rh Type of the recipient - priming read
+
+        # Validate the user's input by checking that the right data was keyed in
+        # group_code returns NO_GROUP when either the ABO or the Rh type is not recognised
+        while group_code(donor_abo, donor_rh) == NO_GROUP or group_code(recipient_abo, recipient_rh) == NO_GROUP:
+            # Generate an error message and prompt user to re-enter data
+            print('\nERROR: Please check your ABO and/or Rh data (A, AB, or O)!')
+            print("\nDonor's Blood Group")
+            donor_abo = input('\tABO Type: ').upper()
+            donor_rh = input('\tRh Type: ').upper()
+            print("\nRecipient's Blood Group")
+            recipient_abo = input('\tABO Type: ').upper()
+            recipient_rh = input('\tRh Type: ').upper()
+
+        # Check for ABO and Rh compatibility with the shared compatibility engine
+        donor_group = BLOOD_GROUPS[group_code(donor_abo, donor_rh)]
+        recipient_group = BLOOD_GROUPS[group_code(recipient_abo, recipient_rh)]
+        if is_compatible(donor_group, recipient_group):
+            print('\n✓ Recipient’s blood is compatible.')
+            compatible_results += 1  # increment the compatible result by one
         else:
-            print('\n✗ Recipient’s blood is incompatible.')  # Rh factors do not match
-    elif not_compatible:
-        print('\n✗ Recipient’s blood is incompatible.')  # blood groups do not match
+            print('\n✗ Recipient’s blood is incompatible.')  # blood group and/or Rh factor do not match
+
+        check = input('\nDo you want another check (y/n)? ')  # ask user if they want another try
+        total_checks += 1  # increment the total_checks variable by one
+
+    print_summary(total_checks, compatible_results)
+
+
+def print_summary(total_checks, compatible_results, file=sys.stdout):
+    """ This function displays the number of checks done and the percentage of them that were compatible """
+    # Display the appropriate message for checks depending on if it was more than one or not
+    if total_checks == 1:
+        print('\nA total of', total_checks, 'check was done.', file=file)
     else:
-        print('\n✓ Recipient’s blood is compatible.')
-        compatible_results += 1  # increment the compatible result by one
+        print('\nA total of', total_checks, 'checks were done.', file=file)
 
-    check = input('\nDo you want another check (y/n)? ')  # ask user if they want another try
-    total_checks += 1  # increment the total_checks variable by one
+    # Print out the percentage of compatible results
+    if total_checks > 0:
+        print(format(compatible_results / total_checks, '.1%'), 'of those returned a compatible result.', file=file)
+    print('Thank you.', file=file)
 
-# Display the appropriate message for checks depending on if it was more than one or not
-if total_checks < 2:
-    print('\nA total of', total_checks, 'check was done.')
-else:
-    print('\nA total of', total_checks, 'checks were done.')
 
-# calculate the compatible results by dividing it by total_checks and storing the results in compatible_results
-compatible_results /= total_checks  # compatible_results = compatible_results / total_checks
+def parse_pair(line):
+    """ This function returns the pair index of a line of text that is not spelled as PairIndexes expects: it may
+    have spaces, lowercase letters or separate ABO and Rh types. Returns INVALID if it does not hold a valid pair """
+    fields = line.decode('utf-8', 'replace').replace(' ', '').strip().upper().split(',')
+    if fields == ['']:
+        return BLANK
+    if len(fields) == 4:  # ABO and Rh types in separate columns
+        fields = [fields[0] + fields[1], fields[2] + fields[3]]
+    if len(fields) != 2 or fields[0] not in GROUP_CODES or fields[1] not in GROUP_CODES:
+        return INVALID
+    return GROUP_CODES[fields[0]] * len(BLOOD_GROUPS) + GROUP_CODES[fields[1]]
 
-# Print out the percentage of compatible results
-print(format(compatible_results, '.1%'), 'of those returned a compatible result.\nThank you.')
+
+class PairIndexes(dict):
+    """ Line of text -> pair index, precomputed for the 64 pairs as they are usually written, so most lines cost one
+    dictionary lookup. Lines spelled any other way are parsed by parse_pair, and not stored to keep memory constant """
+
+    def __init__(self):
+        super().__init__()
+        for donor in BLOOD_GROUPS:
+            for recipient in BLOOD_GROUPS:
+                line = (donor + ',' + recipient).encode()
+                self[line] = self[line + b'\r'] = GROUP_CODES[donor] * len(BLOOD_GROUPS) + GROUP_CODES[recipient]
+        self[b''] = self[b'\r'] = BLANK
+
+    def __missing__(self, line):
+        return parse_pair(line)
+
+
+def check_pairs(source, output, chunk_size=CHUNK_SIZE):
+    """ This function writes every line of pairs read from source to output with its verdict, a chunk at a time, and
+    returns the number of lines of each pair index """
+    pair_indexes = PairIndexes()
+    counts = np.zeros(len(VERDICTS), dtype=np.int64)
+    rest = b''  # Incomplete last line of the previous chunk
+    first_chunk = True
+    while True:
+        chunk = source.read(chunk_size)
+        block = rest + chunk
+        if chunk:  # Check whole lines only, keeping the incomplete one for the next chunk
+            end = block.rfind(b'\n') + 1
+            block, rest = block[:end], block[end:]
+        if len(block) > 0:
+            lines = block.split(b'\n')
+            if first_chunk and lines[0].lstrip().lower().startswith(b'donor'):  # Header line
+                output.write(lines.pop(0).rstrip(b'\r') + b',verdict\n')
+            first_chunk = False
+            indexes = [pair_indexes[line] for line in lines]
+            output.write(b''.join(map(bytes.__add__, [line.rstrip(b'\r') for line in lines],
+                                      map(VERDICTS.__getitem__, indexes))))
+            counts += np.bincount(indexes, minlength=len(VERDICTS))
+        if not chunk:
+            return counts
+
+
+def batch_main(arguments):
+    """ This function checks a whole file of donor and recipient pairs without prompts and displays the summary """
+    parser = argparse.ArgumentParser(description='Check the compatibility of donor and recipient blood group pairs, '
+                                                 'one per line: donor group,recipient group')
+    parser.add_argument('pairs', help='pairs file, or - for stdin')
+    parser.add_argument('--output', default='-', help='verdicts file, or - for stdout (default)')
+    options = parser.parse_args(arguments)
+    try:
+        source = sys.stdin.buffer if options.pairs == '-' else open(options.pairs, 'rb')
+        output = sys.stdout.buffer if options.output == '-' else open(options.output, 'wb')
+    except IOError:
+        sys.exit('Some error in the file I/O occurred')
+    with source, output:
+        counts = check_pairs(source, output)
+    total_checks = int(counts[:PAIRS].sum())
+    compatible_results = int(counts[:PAIRS][PAIR_COMPATIBLE].sum())
+    # Keep the summary out of the verdicts when they go to stdout
+    summary_file = sys.stderr if options.output == '-' else sys.stdout
+    if counts[INVALID] > 0:
+        print(counts[INVALID], 'line(s) did not hold a valid pair of blood groups and were not checked.',
+              file=summary_file)
+    print_summary(total_checks, compatible_results, summary_file)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:  # A pairs file selects the batch mode
+        batch_main(sys.argv[1:])
+    else:
+        main()
@@ -1,15 +1,15 @@
-""" A simple Square Hunt game using Python turtle graphics"""
-import random
-import threading
+""" A simple Square Hunt game using Python turtle graphics. The rules are played by square_hunt.SquareHunt; this
+program draws the game and passes it the clicks """
+import time
 import turtle
 import sys
+from hunt_telemetry import Telemetry, LOG_FILE
+from square_hunt import SquareHunt, GRID_SIZE, BTM_LEFT_X, BTM_LEFT_Y, MARGIN, MIN_GRID, MAX_GRID, \
+    DIFFICULTY_INTERVALS, DRAW, CLEAR, max_targets
 
 # Named constants for the layout
 WINDOW_WIDTH = 750  # Screen width
 WINDOW_HEIGHT = 800  # Screen height
-GRID_SIZE = 700  # Size of the grid (700 x 700)
-BTM_LEFT_X = -350  # Bottom left corner of grid (x-coordinate)
-BTM_LEFT_Y = -375  # Bottom left corner of grid (y-coordinate)
 TITLE_XCOR = -350  # Game title x-coordinates
 TITLE_YCOR = 345  # Game title y-coordinates
 START_BTN_X = 0  # Start button x-coordinate
@@ -19,13 +19,149 @@ START_BTN_BORDER_Y = 340  # Start button border y-coordinate
 START_BTN_BORDER_LENGTH = 114  # Start button border length
 SCORE_XCOR = 350  # Score display x-coordinates
 SCORE_YCOR = 345  # Score display y-coordinates
-MARGIN = 10  # Margin around size of the target box in pixels
 PENSIZE = 3  # Set the pen size to 3
+TARGET_COLOUR = 'green'  # Colour of a target waiting to be hit
+HIT_COLOUR = '#33DDFF'  # Colour of a target that was hit
+BUTTON_COLOUR = '#06C7BA'  # Colour of the start button
+BUTTON_HEIGHT = 40  # Height of the start button
+SHAPE_SIZE = 20  # Side of turtle's built-in 'square' shape, which shapesize() stretches
 
 grid_box = 0  # Variable to hold the grid box value
+targets = 1  # Targets shown at a time
 timer = 0  # Variable to set the difficulty level
-score = 0  # Create a score global variable to keep track of the score
-square_count = 0  # Create a square count global variable to keep track of the squares
+game = None  # SquareHunt being played, from the first click on START
+renderer = None  # Renderer of the game window
+telemetry = None  # Telemetry of the session, which prints the timings of every game
+
+
+class TickScheduler:
+    """ Calls a function every interval seconds on the screen's own timer, so all drawing stays on the main thread.
+    Each tick is scheduled for a deadline on the monotonic clock, one interval after the previous deadline rather than
+    after the previous tick ran, so the time taken by drawing does not add up over a game """
+
+    def __init__(self, interval, tick):
+        self.interval = interval  # Seconds between ticks
+        self.tick = tick  # Function called on each tick
+        self.deadline = 0.0  # Monotonic time the next tick is due
+        self.generation = 0  # Incremented on every start and cancel; stale timer callbacks compare unequal
+        self.running = False
+
+    def start(self):
+        """ Run the first tick now and the rest every interval, cancelling any ticks already scheduled """
+        self.cancel()
+        self.running = True
+        self.deadline = time.monotonic()
+        self._run(self.generation)
+
+    def cancel(self):
+        """ Stop ticking. A tick already queued on the screen timer finds its generation out of date and returns """
+        self.generation += 1
+        self.running = False
+
+    def _run(self, generation):
+        if generation != self.generation:  # Cancelled or restarted since this tick was scheduled
+            return
+        self.tick()
+        if generation != self.generation:  # The tick ended the game
+            return
+        self.deadline += self.interval
+        now = time.monotonic()
+        if now - self.deadline > self.interval:  # Stalled for more than a tick (e.g. window dragged): do not catch up
+            self.deadline = now
+        delay = max(0, round((self.deadline - now) * 1000))
+        turtle.ontimer(lambda: self._run(generation), delay)
+
+
+ticker = None  # TickScheduler of the game in progress
+
+
+class Renderer:
+    """ Retained-mode drawing of the game window. The title and grid are drawn once; everything that changes is an item
+    (targets are stretched 'square' shapes, the start button and each text have their own turtle) that is moved,
+    recoloured, hidden or rewritten in place. Automatic screen updates are off and refresh() redraws the screen once
+    per frame, so a frame costs the same whatever the grid size """
+
+    def __init__(self, target_size):
+        self.screen = turtle.Screen()
+        self.target_size = target_size
+        self.shown = {}  # Cell -> the shape showing its target
+        self.free = []  # Hidden target shapes, reused for the next targets
+        self.button = self._pen(START_BTN_BORDER_X, START_BTN_BORDER_Y)
+        self._draw_button()
+        self.status = self._pen(START_BTN_X, START_BTN_Y)  # Start button label, then the square counter
+        self.score = self._pen(SCORE_XCOR, SCORE_YCOR)
+
+    @staticmethod
+    def _shape(width, height, colour):
+        """ Return a hidden turtle drawn as a width x height rectangle """
+        item = turtle.Turtle(shape='square', visible=False)
+        item.penup()
+        item.speed(0)
+        item.shapesize(height / SHAPE_SIZE, width / SHAPE_SIZE, PENSIZE)
+        item.color(colour)
+        return item
+
+    @staticmethod
+    def _pen(x, y):
+        """ Return a hidden turtle with its pen up at (x, y), for the items drawn or written rather than shaped """
+        item = turtle.Turtle(visible=False)
+        item.penup()
+        item.speed(0)
+        item.goto(x, y)
+        return item
+
+    def _draw_button(self):
+        """ Draw the start button border once. Its own turtle holds it, so hiding it is a clear(). A shape would be
+        raised above the button's label on every refresh """
+        self.button.pensize(PENSIZE)
+        self.button.fillcolor(BUTTON_COLOUR)
+        self.button.pendown()
+        self.button.begin_fill()
+        for i in range(4):
+            if i % 2 == 0:
+                self.button.forward(START_BTN_BORDER_LENGTH)
+                self.button.left(90)
+            else:
+                self.button.forward(BUTTON_HEIGHT)
+                self.button.left(90)
+        self.button.end_fill()
+        self.button.penup()
+
+    def show_target(self, cell, x, y):
+        """ Show the target of cell with its bottom left corner at (x, y) """
+        item = self.free.pop() if self.free else self._shape(self.target_size, self.target_size, TARGET_COLOUR)
+        self.shown[cell] = item
+        item.goto(x + self.target_size / 2, y + self.target_size / 2)
+        item.color(TARGET_COLOUR)
+        item.showturtle()
+
+    def mark_hit(self, cell):
+        """ Recolour the target of cell to show it was hit """
+        self.shown[cell].color(HIT_COLOUR)
+
+    def clear_targets(self, cells):
+        """ Hide the targets of cells, keeping their shapes for later targets """
+        for cell in cells:
+            item = self.shown.pop(cell)
+            item.hideturtle()
+            self.free.append(item)
+
+    def hide_button(self):
+        self.button.clear()
+
+    def show_status(self, text, style='normal', size=20):
+        """ Replace the text on the start button """
+        self.status.clear()
+        self.status.write(text, False, align='center', font=('Arial', size, style))
+
+    def show_score(self, score_value):
+        """ Replace the score text """
+        self.score.clear()
+        self.score.write('Score: %s' % score_value, False, align='right', font=('Arial', 20, 'normal'))
+
+    def refresh(self):
+        """ Redraw the screen with every change since the last refresh """
+        self.screen.update()
 
 
 def setup():
@@ -33,29 +169,11 @@ def setup():
     turtle.setup(WINDOW_WIDTH, WINDOW_HEIGHT)
     turtle.speed(0)  # Disable all turtle animation
     turtle.hideturtle()  # Hide the turtle
-    turtle.tracer(10)  # auto-refresh the screen after every 10 drawing steps
+    turtle.tracer(0)  # Only redraw the screen when Renderer.refresh() asks for it
     turtle.pensize(PENSIZE)
     turtle.penup()  # Put the pen up to prevent unnecessary drawings
     turtle.goto(TITLE_XCOR, TITLE_YCOR)
     turtle.write('Square Hunt', False, align='left', font=('Arial', 20, 'normal'))  # Display the game title
-    turtle.goto(START_BTN_BORDER_X, START_BTN_BORDER_Y)
-    turtle.pendown()
-    # Draw the start button border
-    turtle.begin_fill()
-    turtle.fillcolor('#06C7BA')
-    for i in range(4):
-        if i % 2 == 0:
-            turtle.forward(START_BTN_BORDER_LENGTH)
-            turtle.left(90)
-        else:
-            turtle.forward(40)
-            turtle.left(90)
-    turtle.end_fill()
-    turtle.penup()
-    turtle.goto(START_BTN_X, START_BTN_Y)
-    turtle.write('START', False, align='center', font=('Arial', 17, 'bold'))  # Display the start button
-    turtle.goto(SCORE_XCOR, SCORE_YCOR)
-    turtle.write('Score: 0', False, align='right', font=('Arial', 20, 'normal'))  # Display the initial score
 
 
 def draw_grid():
@@ -87,50 +205,13 @@ def draw_y_axis(y_axis):
         turtle.goto(BTM_LEFT_X + (line * GRID_SIZE / y_axis), BTM_LEFT_Y)
         turtle.pendown()
         turtle.forward(GRID_SIZE)
-
-
-def draw_target(grid_box_size):
-    """ Function to draw the target squares """
-    actual_grid_size = GRID_SIZE // grid_box_size  # Get the dimensions of each grid box
-    target_size = actual_grid_size - 2 * MARGIN  # Get the dimensions of the target square
-    # Create a random (x,y) coordinate to start the drawing
-    target_x = random.randrange(BTM_LEFT_X + MARGIN, BTM_LEFT_X + GRID_SIZE - MARGIN, actual_grid_size)
-    target_y = random.randrange(BTM_LEFT_Y + MARGIN, BTM_LEFT_Y + GRID_SIZE - MARGIN, actual_grid_size)
-    turtle.penup()
-    turtle.setheading(0)  # Make the turtle face east (0 degrees)
-    turtle.goto(target_x, target_y)
-    turtle.pendown()  # Put the pen down
-    turtle.pensize(PENSIZE)  # Set the pen's width to 3 pixels
-    turtle.pencolor('green')  # Set the pen colour to green
-    turtle.fillcolor('green')  # Set the fill colour to green
-    turtle.begin_fill()
-    for side in range(4):
-        turtle.forward(target_size)
-        turtle.left(90)
-    turtle.end_fill()
-
-
-def clear_target(grid_box_size):
-    """ Function to clear the target squares """
-    actual_grid_size = GRID_SIZE // grid_box_size  # Get the dimensions of each grid box
-    target_size = actual_grid_size - 2 * MARGIN  # Get the dimensions of the target square
     turtle.penup()
-    turtle.setheading(0)
-    turtle.goto(turtle.xcor(), turtle.ycor())  # Go to drawing's current location
-    turtle.pendown()
-    turtle.pensize(PENSIZE)  # Set the pen's width to 3 pixels
-    turtle.pencolor('white')  # Set the pen colour to white
-    turtle.fillcolor('white')  # Fill the square with white
-    turtle.begin_fill()
-    for side in range(4):
-        turtle.forward(target_size)
-        turtle.left(90)
-    turtle.end_fill()
 
 
 def handle_click(x, y):
     """ Click handler function which receives (x,y) location of a click point. This function is called automatically
     when a left click is detected anywhere in the window """
+    arrived = time.monotonic()  # Time the click reached the program
     # Check that clicks are registered within the game boundary
     if ((BTM_LEFT_X + MARGIN) <= x <= (BTM_LEFT_X - MARGIN + GRID_SIZE)) and \
             ((BTM_LEFT_Y + MARGIN) <= y <= (BTM_LEFT_Y - MARGIN + GRID_SIZE)):
@@ -142,137 +223,114 @@ def handle_click(x, y):
     if START_BTN_BORDER_X <= x <= (START_BTN_BORDER_X + START_BTN_BORDER_LENGTH) and \
             START_BTN_BORDER_Y <= y <= (START_BTN_BORDER_Y + START_BTN_BORDER_LENGTH):
         print('GAME STARTED')
-        update_start_text()
-        start_string = '[' + str(square_count) + ']'  # Display the initial score value at start game
-        turtle.write(start_string, False, align='center', font=('Arial', 20, 'normal'))
-        turtle.setheading(0)
-        next_square(grid_box, timer)  # Call the next_square function to kickstart the loop
+        start_game()
     else:
         print('GAME NOT STARTED!')
 
-    update_score(x, y)  # Call the update_score function to start updating the score
-
-
-def update_score(target_x, target_y):
-    """ This function updates the score after a successful hit or decrement after a miss """
-    global score  # score to update
-    actual_grid_size = GRID_SIZE // grid_box  # Get the dimensions of each grid box
-    target_size = actual_grid_size - 2 * MARGIN  # Get the dimensions of the target square
-
-    # Register a successful hit, change the cell colour and increment the score by one
-    if turtle.xcor() <= target_x <= (turtle.xcor() + target_size) and turtle.ycor() <= target_y <= (turtle.ycor() + target_size) and turtle.fillcolor() == 'green':
-        score += 1  # Increment score on a successful hit
-        turtle.pencolor('#33DDFF')  # Set the pen colour to bright blue
-        turtle.fillcolor('#33DDFF')  # Fill the square with bright blue
-        turtle.begin_fill()
-        for side in range(4):
-            turtle.forward(target_size)
-            turtle.left(90)
-        turtle.end_fill()
-        print('Hit', score)
+    if game is not None:
+        telemetry.click(arrived, x, y)
+        update_score(x, y)  # Call the update_score function to start updating the score
+    show_frame()  # Show the changes made by this click in one redraw
+    if game is not None:
+        telemetry.click_feedback(arrived, time.monotonic())
+
+
+def update_score(click_x, click_y):
+    """ This function scores a click, a hit or a miss, and recolours the target when it was hit """
+    cell = game.click(click_x, click_y)  # The cell is found by arithmetic on the click position
+    if cell is not None:
+        renderer.mark_hit(cell)  # Recolour the square bright blue
+        print('Hit', game.score)
     else:
-        score -= 1  # Subtract one from score if hit is missed
-        if score < 0:  # If score is decremented to below zero, initialize it to zero
-            score = 0
-        print('Miss', score)
+        print('Miss', game.score)
 
 
 def update_score_text():
     """ This function updates the score text to reflect the current results """
-    global score
-    turtle.setheading(0)
-    turtle.penup()
-    # Draw a white rectangle to clear the score each time it is updated
-    turtle.goto(SCORE_XCOR, SCORE_YCOR)
-    turtle.pendown()
-    turtle.pencolor('white')
-    turtle.fillcolor('white')
-    turtle.begin_fill()
-    for i in range(4):
-        if i % 2 == 0:
-            turtle.backward(START_BTN_BORDER_LENGTH)
-            turtle.left(90)
-        else:
-            turtle.forward(40)
-            turtle.left(90)
-    turtle.end_fill()
-    turtle.penup()
-    turtle.pencolor('black')
-    score_string = 'Score: %s' % score
-    turtle.write(score_string, False, align='right', font=('Arial', 20, 'normal'))
-
-
-def next_square(grid_box_size, seconds):
-    """ This function handles the displaying of target squares, erasing them and keeping a count of the number of
-    squares while updating the thread """
-    global square_count
-    square_count += 1  # Increment square_count by 1
-    if square_count <= 20:  # Set square count to 20 as it iterates between drawing and clearing a cell, 10 times each
-        if square_count % 2 != 0:
-            print('Draw cell', square_count)
-            draw_target(grid_box_size)  # Function draws the target square on the main grid
-        else:
-            print('Clear cell', square_count)
-            clear_target(grid_box_size)  # Clear the target square function
-            update_start_text()
-            turtle.write('[' + str(square_count // 2) + ']', False, align='center', font=('Arial', 20, 'normal'))
-            update_score_text()
-        th = threading.Timer(interval=seconds, function=next_square, args=(grid_box_size, seconds))
-        th.start()
-    else:
+    renderer.show_score(game.score)
+
+
+def start_game():
+    """ This function starts a game, or restarts the one in progress: the pending ticks are cancelled, targets still
+    on the grid are cleared and the counts start again """
+    global game, ticker
+    if ticker is not None and ticker.running:
+        ticker.cancel()
+    renderer.clear_targets(list(renderer.shown))
+    game = SquareHunt(grid_box, timer, targets=targets)
+    renderer.hide_button()
+    update_start_text()
+    update_score_text()
+    telemetry.start_game(game)
+    ticker = TickScheduler(timer, next_square)
+    ticker.start()  # Draws the first target now and schedules the rest
+
+
+def next_square():
+    """ This function handles the displaying of target squares and erasing them, as the game ticks. It is called on
+    every tick of the game's scheduler, and cancels it when the game is finished """
+    telemetry.tick(ticker.deadline, time.monotonic())
+    result = game.tick()
+    renderer.clear_targets(game.expired)  # Every tick clears the targets of the tick before
+    if result == DRAW:
+        print('Draw cell', game.square_count)
+        for cell in game.spawned:  # Show the target squares on the main grid
+            renderer.show_target(cell, *game.target_corner(cell))
+    elif result == CLEAR:
+        print('Clear cell', game.square_count)
         update_start_text()
-        turtle.write('FINISHED', False, align='center', font=('Arial', 20, 'italic'))
+        update_score_text()
+    else:
+        ticker.cancel()
+        renderer.show_status('FINISHED', 'italic')
+    show_frame()  # Show the frame
+    if result != DRAW and result != CLEAR:
+        telemetry.end_game(game)  # Print the game's timings
+
+
+def show_frame():
+    """ This function redraws the screen with every change since the last frame and times the redraw """
+    started = time.monotonic()
+    renderer.refresh()
+    telemetry.frame(started, time.monotonic())
 
 
 def update_start_text():
-    """ This function clears the start button and  updates the square counter on the turtle window """
-    turtle.setheading(0)
-    turtle.penup()
-    # Draw a white rectangle to clear the square each time it is updated
-    turtle.goto(START_BTN_BORDER_X, START_BTN_BORDER_Y)
-    turtle.pendown()
-    turtle.begin_fill()
-    turtle.pencolor('white')
-    turtle.fillcolor('white')
-    for i in range(4):
-        if i % 2 == 0:
-            turtle.forward(START_BTN_BORDER_LENGTH)
-            turtle.left(90)
-        else:
-            turtle.forward(40)
-            turtle.left(90)
-    turtle.end_fill()
-    turtle.penup()
-    turtle.pencolor('black')
-    turtle.goto(START_BTN_X, START_BTN_Y)
+    """ This function updates the square counter shown in place of the start button """
+    renderer.show_status('[' + str(game.squares_shown) + ']')
 
 
 def main():
     """ Main function """
-    global grid_box, timer
+    global grid_box, targets, timer, renderer, telemetry
     # Get user input via dialogue box
-    grid_box = int(turtle.textinput('Grid Size (N)', 'Provide the grid size (3-8):'))
+    grid_box = int(turtle.textinput('Grid Size (N)', 'Provide the grid size ({}-{}):'.format(MIN_GRID, MAX_GRID)))
     difficulty = int(turtle.textinput('Difficulty Level', 'Choose a difficulty level (1-3):'))
 
     # Ensure user enters correct dimensions and data
-    if (grid_box < 3 or grid_box > 8) or (difficulty < 1 or difficulty > 3):
-        sys.exit('Please enter a valid grid size (3-8) and/or difficulty level (1-3)')
+    if (grid_box < MIN_GRID or grid_box > MAX_GRID) or difficulty not in DIFFICULTY_INTERVALS:
+        sys.exit('Please enter a valid grid size ({}-{}) and/or difficulty level (1-3)'.format(MIN_GRID, MAX_GRID))
+    targets = int(turtle.textinput('Targets', 'Targets shown at a time (1-{}):'.format(max_targets(grid_box))))
+    if targets < 1 or targets > max_targets(grid_box):
+        sys.exit('Please enter a valid number of targets (1-{})'.format(max_targets(grid_box)))
     else:
-        if difficulty == 1:
-            timer = 2
-        elif difficulty == 2:
-            timer = 1.5
-        else:
-            timer = 1
+        timer = DIFFICULTY_INTERVALS[difficulty]  # Seconds between ticks
 
         setup()  # Call the screen setup function
         draw_grid()  # Call the function to draw the grid
         draw_x_axis(grid_box)  # Call the function to draw the horizontal lines (x-axis)
         draw_y_axis(grid_box)  # Call the function to draw the vertical lines (y-axis)
+        # Create the start button and score items; target shapes are made as they are first needed
+        renderer = Renderer(SquareHunt(grid_box, timer, targets=targets).target_size)
+        renderer.show_status('START', 'bold', 17)  # Display the start button
+        renderer.show_score(0)  # Display the initial score
+        renderer.refresh()
+        telemetry = Telemetry(LOG_FILE)  # Also logs the session to a file if SQUARE_HUNT_LOG is set
 
         turtle.listen()  # Register handle_click as the listener function
         turtle.onscreenclick(handle_click)  # pass the function name as argument
         turtle.done()  # Prevent the graphics window from automatically closing
+        telemetry.close()
 
 
 main()  # Call the main function
@@ -1,56 +1,105 @@
 """ LifeServe Blood Institute (lBI) blood-group program """
 
+import argparse
+import contextlib
+import gc
+import json
+import os
+import sqlite3
 import sys
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 from hospital import check_demand
-from datetime import date
+from blood_store import DonorStore, BagStore
+from compatibility import BLOOD_GROUPS, compatibility_table, compatible_supply, dispatch_groups
+from journal import Journal, apply_op, SNAPSHOT_META
+from columnar import read_donors, read_bags
+from column_cache import read_cached
+from sequence import IdSequence
+from stock_report import StockChart
+from sqlite_store import open_database, DEFAULT_STOCK_TABLE
+from allocation import allocate
+from datetime import date, timedelta
 
 # File constants
 DONORS_FILE = 'donors.txt'
 BAGS_FILE = 'bags.txt'
 DONORS_NEW_FILE = 'donors-new.txt'
 BAGS_NEW_FILE = 'bags-new.txt'
+BAG_SEQUENCE_FILE = 'lbi-bags.seq'  # Next free bag ID, shared by every terminal
+SERVICE_SOCKET = os.environ.get('LBI_SERVICE')  # Unix socket of the database service, if the terminals share one
+# Hospital demand servers as host:port, comma separated; when none are set the hospital module is used
+HOSPITAL_SERVERS = [address for address in os.environ.get('LBI_HOSPITALS', '').split(',') if address]
+SITES_FILE = os.environ.get('LBI_SITES')  # Sites file listing every collection centre, to refer demands to
+SITE_NAME = os.environ.get('LBI_SITE')  # Name of this terminal's centre in the sites file
 # Menu choices
 CHECK_INVENTORY = 1
 ATTEND_BLOOD_DEMAND = 2
 RECORD_NEW_DONATION = 3
 STOCK_VISUAL_REPORT = 4
-EXIT = 5
-
-# Create a blood-group transfusion compatibility table in the form of a dictionary
-blood_table = {'O-': ['O-'],
-               'O+': ['0-', 'O+'],
-               'B-': ['O-', 'B-'],
-               'B+': ['O-', 'O+', 'B-', 'B+'],
-               'A-': ['O-', 'A-'],
-               'A+': ['O-', 'O+', 'A-', 'A+'],
-               'AB-': ['O-', 'B-', 'A-', 'AB-'],
-               'AB+': ['O-', 'O+', 'B-', 'B+', 'A-', 'A+', 'AB-', 'AB+']}
+ATTEND_ALL_DEMANDS = 5
+EXIT = 6
+# Age limits in days
+BAG_SHELF_LIFE = 30  # Bags older than this are out of their use-by date
+DONATION_WINDOW = 120  # Days after a donation before the donor may give blood again
+RECALL_PAGE_SIZE = 10  # Eligible donors listed at a time for an unmet demand
+MAX_REPORTED_ROWS = 20  # Bad rows listed individually when loading a database file
+REPORT_FILE = os.environ.get('LBI_REPORT_FILE')  # Stock report image written instead of showing a window
+# Batch mode
+BATCH_COMMIT_EVERY = 100  # Operations between commits to disk
+BATCH_DONORS_LISTED = 20  # Compatible donors listed for an unmet demand
+STREAM_INTERVAL = 1.0  # Seconds between polls of each hospital server in the stream operation
+
+# Blood-group transfusion compatibility table in the form of a dictionary (recipient -> compatible donor groups),
+# generated from the shared compatibility engine
+blood_table = compatibility_table()
+stock_chart = StockChart()  # Off-screen stock report figure, created on the first report and reused
+site_inventory = None  # Stock of the other collection centres, read on the first referral
 
 
 def main():
     """ This function starts running the main program plus other related functions """
     print('<<< LifeServe Blood Institute >>>\n')
     print('Loading database...')
-    print('Enter the database file names without .txt extension\nor just press Enter to accept defaults')
-    donors_db = input('Donors database (donors): ').lower()  # Convert filename to lowercase letters
-    if len(donors_db) == 0:  # If input field is left blank, use default values
-        donors_db = DONORS_FILE
-    elif '.txt' in donors_db:  # If user enters the file with .txt extension, slice the string and attach .txt to it
-        donors_db = donors_db[:-4] + '.txt'
-    else:
-        # Concatenate filename with extension so that user does not have to enter it and strip to remove extra spaces
-        donors_db = donors_db.strip() + '.txt'
-    stock_db = input('Stock inventory database (bags): ').lower()
-    if len(stock_db) == 0:
-        stock_db = BAGS_FILE
-    elif '.txt' in stock_db:
-        stock_db = stock_db[:-4] + '.txt'
+    building = None  # Background build of the stores from the text files
+    if SERVICE_SOCKET:  # The database service owns the data, shared by every terminal
+        donors_data, stock_data = connect_db(SERVICE_SOCKET)
+        rows = len(donors_data), len(stock_data)
     else:
-        stock_db = stock_db.strip() + '.txt'
+        print('Enter the database file names without .txt extension (or an SQLite .db file)\n'
+              'or just press Enter to accept defaults')
+        donors_db = input('Donors database (donors): ').lower()  # Convert filename to lowercase letters
+        if len(donors_db) == 0:  # If input field is left blank, use default values
+            donors_db = DONORS_FILE
+        elif donors_db.strip().endswith('.db'):  # An SQLite database holds the donors and every stock table
+            donors_db = donors_db.strip()
+        elif '.txt' in donors_db:  # If user enters the file with .txt extension, slice the string and attach .txt
+            donors_db = donors_db[:-4] + '.txt'
+        else:
+            # Concatenate filename with extension so that user does not have to enter it and strip to remove extra
+            # spaces
+            donors_db = donors_db.strip() + '.txt'
+        stock_db = input('Stock inventory database (bags): ').lower()
+        if donors_db.endswith('.db'):  # The stock is a table in the same database
+            stock_db = stock_db.strip() or DEFAULT_STOCK_TABLE
+        elif len(stock_db) == 0:
+            stock_db = BAGS_FILE
+        elif '.txt' in stock_db:
+            stock_db = stock_db[:-4] + '.txt'
+        else:
+            stock_db = stock_db.strip() + '.txt'
 
-    donors_data, stock_data = load_db(donors_db, stock_db)
-    if len(donors_data.keys()) == 0 or len(stock_data.keys()) == 0:  # Check if either file is empty (no data)
+        if donors_db.endswith('.db'):
+            donors_data, stock_data = load_db(donors_db, stock_db)
+            rows = len(donors_data), len(stock_data)
+        else:
+            loaded = read_db(donors_db, stock_db)
+            rows = len(loaded[3]['id']), len(loaded[4]['id'])
+            # Build the stores in the background, while the menu waits for the first choice
+            builder = ThreadPoolExecutor(max_workers=1)
+            building = builder.submit(build_db, *loaded)
+            builder.shutdown(wait=False)  # The build carries on, and the worker thread ends with it
+    if 0 in rows:  # Check if either file is empty (no data)
         sys.exit('File(s) empty!!!')
     else:
         print('Database loaded successfully\n')  # Confirm that the files are loaded successfully
@@ -63,13 +112,17 @@ def main():
 
                 choice = int(input('Enter your choice: '))  # Get the user's choice
                 print()
+                if building is not None:
+                    donors_data, stock_data = building.result()  # Waits only if the stores are not built yet
+                    building = None
                 if choice == CHECK_INVENTORY:
-                    new_stock = check_inventory(stock_data)  # Call the check_inventory function
+                    expired_bags = check_inventory(stock_data)  # Call the check_inventory function
                     input('Please dispose of them. Press [Enter] when done... ')
-                    save_db(donors_data, new_stock)  # Call the save_db() function to save the data into file
+                    stock_data.dispose(expired_bags)  # Remove the disposed bags from the stock records in one batch
+                    save_db(donors_data, stock_data)  # Call the save_db() function to save the data into file
                     print('Updated database files saved to disk.')
                 elif choice == ATTEND_BLOOD_DEMAND:
-                    blood_required = check_demand()
+                    blood_required = next_demand()
                     if blood_required != 'X':
                         print('Currently', blood_required, 'is required\nChecking the stock inventory...\n')
                         # Call the attend to blood demand function
@@ -81,7 +134,23 @@ def main():
                     record_donation(unique_id, donors_data, stock_data)  # Call the record_donation() function
                 elif choice == STOCK_VISUAL_REPORT:
                     visual_report(stock_data)  # Call the visual_report() function
+                elif choice == ATTEND_ALL_DEMANDS:
+                    # Collect every outstanding demand first, then allocate them all in one go
+                    if HOSPITAL_SERVERS:
+                        # Poll every hospital server at once, with timeouts and retries
+                        from hospital_client import collect_demands  # Loads asyncio, so only when servers are set
+                        demands, unreachable = collect_demands(HOSPITAL_SERVERS)
+                    else:
+                        hospitals = int(input('Number of hospitals to check: '))
+                        demands = [check_demand() for hospital in range(hospitals)]
+                        unreachable = demands.count('X')
+                        demands = [blood_group for blood_group in demands if blood_group != 'X']
+                    if unreachable > 0:
+                        print('Could not connect to', unreachable, 'hospital web server(s).')
+                    print('Currently', len(demands), 'bag(s) are required\nChecking the stock inventory...\n')
+                    attend_demands(demands, donors_data, stock_data)
                 elif choice == EXIT:
+                    close_db(donors_data, stock_data)  # Fold the journal into the new database files
                     print('Have a good day.')
                 else:
                     print('Invalid choice! Please try again.')
@@ -90,108 +159,184 @@ def main():
             sys.exit('Invalid data format or input. System exiting...\n')
 
 
+@metrics.timed
 def load_db(donor_fname, stock_fname):
-    """ This function takes in two file names as parameters, reads both files and stores their data in a dictionary """
-    donor_dict = {}  # Create an empty donor dictionary
+    """ This function takes in two file names as parameters, reads both files and stores their data in indexed
+    donor and bag stores, then replays the journal of changes made since the files were written. An SQLite .db file
+    is opened in place instead, with stock_fname naming its stock table """
+    if donor_fname.endswith('.db'):
+        return load_sqlite_db(donor_fname, stock_fname)
+    return build_db(*read_db(donor_fname, stock_fname))
+
+
+@metrics.timed
+def read_db(donor_fname, stock_fname):
+    """ This function reads the columns of both database files, from their column caches when those are up to date,
+    and reports any bad rows. It returns the journal and file names along with the columns, for build_db """
+    journal = Journal()
+    try:
+        meta = journal.read_meta()
+        origin = journal.read_origin()
+    except (IOError, ValueError, KeyError, TypeError):
+        sys.exit('The journal meta file is damaged')
+    if meta is not None:  # An earlier session left a journal, which applies to the files recorded with it
+        requested = same_files(donor_fname, stock_fname)
+        if requested != same_files(*meta[:2]) and requested != same_files(*origin):
+            sys.exit('The journal in this directory belongs to ' + origin[0] + ' and ' + origin[1] + ', not ' +
+                     donor_fname + ' and ' + stock_fname + '. Open those files, or move ' + SNAPSHOT_META +
+                     ' and the journal segments elsewhere to start afresh')
+        if requested != same_files(*meta[:2]):  # The journal's latest snapshot has replaced the requested files
+            donor_fname, stock_fname = meta[0], meta[1]
+            print('Resuming from', donor_fname, 'and', stock_fname, 'plus the journal of later changes')
+
     try:
-        donor_file = open(donor_fname, 'r')  # Open the donors.txt file in read mode
-        for each_donor in donor_file:
-            each_donor = each_donor.strip().split(',')  # Remove leading and trailing characters and split
-            # Get each field individually
-            donor_id = int(each_donor[0])
-            donor_name = each_donor[1]
-            phone = each_donor[2]
-            email = each_donor[3]
-            blood_group = each_donor[4]
-            last_donation_date = each_donor[5]
-            # Append data to dictionary
-            donor_dict[donor_id] = [donor_name, phone, email, blood_group, last_donation_date]
-        donor_file.close()
+        # Stream the donors file into compact columns; bad rows are reported and skipped
+        donor_columns, donor_errors = read_cached(donor_fname, read_donors)
+        report_bad_rows(donor_fname, donor_errors)
+        stock_columns, stock_errors = read_cached(stock_fname, read_bags)
+        report_bad_rows(stock_fname, stock_errors)
 
     except FileNotFoundError:
         sys.exit('No such file or directory')
 
-    except ValueError:
-        sys.exit('Invalid data for Donor ID (should be int)')
-
-    except IndexError:
-        sys.exit('File data format is invalid (list index of of range)')
-
     except IOError:
         sys.exit('Some error in the file I/O occurred')
 
     except:  # Generic handler to capture any other unspecified error
         sys.exit('Something went wrong')
 
-    stock_dict = {}  # Create an empty stock dictionary
+    return journal, donor_fname, stock_fname, donor_columns, stock_columns
+
+
+def same_files(donor_fname, stock_fname):
+    """ This function returns a donor and stock file name pair in a form that compares equal for the same files """
+    return os.path.normpath(donor_fname), os.path.normpath(stock_fname)
+
+
+@metrics.timed
+def build_db(journal, donor_fname, stock_fname, donor_columns, stock_columns):
+    """ This function builds the donor and bag stores and their indexes from the columns read by read_db, replays
+    the journal and opens a new journal segment for this session """
     try:
-        stock_file = open(stock_fname, 'r')  # Open the bags.txt file in read mode
-        for each_bag in stock_file:
-            each_bag = each_bag.strip().split(',')
-            bag_id = int(each_bag[0])
-            blood_group = each_bag[1]
-            date_collected = each_bag[2]
-            stock_dict[bag_id] = [blood_group, date_collected]  # Append data to dictionary
-        stock_file.close()
+        donor_dict = DonorStore.from_columns(donor_columns)  # Build the donor store and its indexes in bulk
+        stock_dict = BagStore.from_columns(stock_columns)
 
-    except FileNotFoundError:
+    except:  # Generic handler to capture any unspecified error
+        sys.exit('Something went wrong')
+
+    try:
+        for op in journal.replay():  # Re-apply every change recorded since the files were written
+            apply_op(donor_dict, stock_dict, op)
+        journal.start(donor_fname, stock_fname)  # Open a new journal segment for this session
+    except IOError:
+        sys.exit('Some error in the journal I/O occurred')
+    except (ValueError, TypeError, IndexError, KeyError):
+        sys.exit('The journal holds an invalid operation')
+    # From here on every change to either store is appended to the journal
+    donor_dict.journal = journal
+    stock_dict.journal = journal
+    # New bag IDs come from the shared sequence, and never below an ID already in stock
+    stock_dict.sequence = IdSequence(BAG_SEQUENCE_FILE, floor=stock_dict.max_id() + 1)
+    # The millions of loaded records live until the program exits, so the garbage collector no longer scans them
+    gc.freeze()
+
+    return donor_dict, stock_dict  # Return the donor and stock stores
+
+
+@metrics.timed
+def load_sqlite_db(db_fname, stock_table):
+    """ This function opens an SQLite database, whose indexed tables answer every lookup and update without loading
+    the records into memory """
+    if not os.path.exists(db_fname):
         sys.exit('No such file or directory')
+    try:
+        donor_dict, stock_dict = open_database(db_fname, stock_table)
+        stock_dict.sequence = IdSequence(BAG_SEQUENCE_FILE, floor=stock_dict.max_id() + 1)
 
-    except ValueError:
-        sys.exit('Invalid data for Bag ID (should be int)')
+    except ValueError:  # The stock table name is not a plain identifier
+        sys.exit('Invalid stock table name')
 
-    except IndexError:
-        sys.exit('File data format is invalid (list index of of range)')
+    except sqlite3.Error:
+        sys.exit('Some error in the database I/O occurred')
 
-    except IOError:
-        sys.exit('Some error in the file I/O occurred')
+    return donor_dict, stock_dict
+
+
+@metrics.timed
+def connect_db(socket_path):
+    """ This function connects to the database service, which owns the donor and bag data and commits every change
+    before confirming it, so several terminals can work on the same database """
+    from db_service import connect  # Loads asyncio, which a session on local files never needs
+    try:
+        donor_dict, stock_dict = connect(socket_path)  # New bag IDs come from the service's own sequence
+
+    except OSError:
+        sys.exit('Could not connect to the database service')
+
+    return donor_dict, stock_dict
 
-    except:  # Generic handler to capture any other unspecified error
-        sys.exit('Something went wrong')
 
-    return donor_dict, stock_dict  # Return the donor and stock dictionary
+def report_bad_rows(file_name, errors):
+    """ This function lists the rows of a database file that could not be loaded, up to MAX_REPORTED_ROWS of them """
+    for line_number, line, reason in errors[:MAX_REPORTED_ROWS]:
+        print('Skipped line', line_number, 'of', file_name + ':', reason, '(' + line + ')')
+    if len(errors) > MAX_REPORTED_ROWS:
+        print('...and', len(errors) - MAX_REPORTED_ROWS, 'more bad rows in', file_name)
 
 
+@metrics.timed
 def save_db(donor_fname, stock_fname):
-    """ This function updates the donor and bags files, and saves them into new files """
+    """ This function commits the changes made so far to the journal (or SQLite database) on disk. Once the journal
+    has grown large it is compacted into the donors-new and bags-new files in the background """
+    journal = stock_fname.journal
     try:
-        donor_file = open(DONORS_NEW_FILE, 'w')  # open the donor-new.txt file in write mode
-        for donor_id, donor_details in donor_fname.items():
-            name = donor_details[0]
-            phone = donor_details[1]
-            email = donor_details[2]
-            blood_group = donor_details[3]
-            last_donation_date = donor_details[4]
-            # Write the updated data from the dictionary to file
-            donor_file.write(str(donor_id) + ',' + name + ',' + phone + ',' + email + ',' + blood_group + ',' +
-                             last_donation_date + '\n')
-        donor_file.close()
+        stock_fname.commit()  # Every change was already appended, so committing is a single fsync
+        if journal is not None and journal.should_compact():
+            compact_db(donor_fname, stock_fname)
 
     except IOError:
         sys.exit('Some error in the file I/O occurred')
 
+    except sqlite3.Error:
+        sys.exit('Some error in the database I/O occurred')
+
     except TypeError:
         sys.exit('Invalid data type')
 
     except ValueError:
         sys.exit('Too many values to unpack')
 
+
+@metrics.timed
+def compact_db(donor_fname, stock_fname):
+    """ This function writes the current donor and bag data to the donors-new and bags-new files (in the background)
+    and lets the journal drop the changes they cover """
+    donor_lines = []
+    for donor_id, donor in donor_fname.items():
+        donor_lines.append(str(donor_id) + ',' + donor.name + ',' + donor.phone + ',' + donor.email + ',' +
+                           donor.blood_group + ',' + donor.last_donation_date + '\n')
+    bag_lines = []
+    for bag_id, bag in stock_fname.items():
+        bag_lines.append(str(bag_id) + ',' + bag.blood_group + ',' + bag.collected_date + '\n')
+    metrics.count('rows_scanned', len(donor_lines) + len(bag_lines))
+    stock_fname.journal.compact(DONORS_NEW_FILE, BAGS_NEW_FILE, donor_lines, bag_lines)
+
+
+@metrics.timed
+def close_db(donor_fname, stock_fname):
+    """ This function compacts any outstanding journal changes into the new database files and closes the journal """
+    journal = stock_fname.journal
+    if journal is None:  # An SQLite database has no journal to compact
+        stock_fname.close()
+        return
     try:
-        stock_file = open(BAGS_NEW_FILE, 'w')  # open the bags-new.txt file in write mode
-        for bag_id, bag_details in stock_fname.items():
-            value_str = ",".join(map(str, bag_details[:2]))  # Convert the value list into a string of characters
-            stock_file.write(str(bag_id) + ',' + value_str + '\n')
-        stock_file.close()
+        if journal.live_bytes > 0:
+            compact_db(donor_fname, stock_fname)
+        journal.close()  # Waits for the compaction to finish
 
     except IOError:
         sys.exit('Some error in the file I/O occurred')
 
-    except TypeError:
-        sys.exit('Invalid data type')
-
-    except ValueError:
-        sys.exit('Too many values to unpack')
-
 
 def display_menu():
     """ This function displays the main menu """
@@ -202,171 +347,430 @@ def display_menu():
     print('(2) Attend to blood demand')
     print('(3) Record new donation')
     print('(4) Stock visual report')
-    print('(5) Exit')
+    print('(5) Attend to all outstanding demands')
+    print('(6) Exit')
 
 
+@metrics.timed
 def check_inventory(stock_dictionary):
     """ This function searches for any bags older than 30 days, and if found, it displays their ID numbers so that staff
-     can dispose of them """
+     can dispose of them. The IDs are returned as a batch to pass to the store's dispose() method """
     print('Following bags are out of their use-by date')
-    for key, value in stock_dictionary.items():
-        # Return date collected corresponding to a date string in the format YYYY-MM-DD
-        date_collected = date.fromisoformat(value[1])
-        today = date.today()  # Set today's date
-        bag_age = (today - date_collected).days  # Calculate difference in number of days
-        # Add a new field for days old to the dictionary
-        stock_dictionary[key].append(bag_age)  # stock_dictionary[key] += [bag_age]
-        bag_age = value[-1]  # Assign age of bag to the last position in the value list
-        if bag_age > 30:  # Search for any bags older than 30 days
-            print(key)  # Display the ID
+    # Bags collected before the cutoff are more than BAG_SHELF_LIFE days old; the date index is ordered by collection
+    # date, so only the expired bags are visited, oldest first
+    expired = stock_dictionary.collected_before(use_by_cutoff())
+    metrics.count('rows_scanned', len(expired))
+    for key in expired:
+        print(key)  # Display the ID
 
-    # Create a new dictionary with the updated stock records
-    new_stock_dict = {k: v[:2] for k, v in stock_dictionary.items() if v[-1] < 30}
+    return expired
 
-    return new_stock_dict
 
+def next_demand():
+    """ This function returns the blood group a hospital currently requires, or 'X' if no hospital could be reached.
+    With hospital servers set, they are asked in turn with timeouts and retries; otherwise the hospital module is """
+    if not HOSPITAL_SERVERS:
+        return check_demand()
+    from hospital_client import first_demand  # Loads asyncio, so only when servers are set
+    blood_required = first_demand(HOSPITAL_SERVERS)
+    return blood_required if blood_required is not None else 'X'
 
+
+def use_by_cutoff():
+    """ This function returns the collection date before which bags are out of their use-by date today """
+    return date.today() - timedelta(days=BAG_SHELF_LIFE)
+
+
+@metrics.timed
 def attend_demand(blood_type_required, donors_dict, stock_dict):
     """ This function searches for available blood group in the database and find a list of eligible donors with
     compatible blood type whom staff can contact. If no eligible donors exist, it notifies the staff """
-    for bag_id, bag_details in stock_dict.items():
-        # Check if value at index[0] in the list is in the blood_table dictionary to find compatible bags
-        if bag_details[0] in blood_table[blood_type_required]:
-            print('Following bag should be supplied\nID: ' + str(bag_id) + ' (' + bag_details[0] + ')\n')
-            # Create a new stock dictionary with dispatched bag removed from database, which is later saved to file
-            new_stock = {k: v[:2] for k, v in stock_dict.items() if k != bag_id}
-            input('Press [Enter] once it is packed for dispatch... ')
-            save_db(donors_dict, new_stock)  # Call the save_db() function
-            print('Inventory records updated.\nUpdated database files saved to disk.\n')
-            break  # break to print only the first blood group found
+    # Pick the oldest bag of the required group that is still within its shelf life, falling back to other
+    # compatible groups and finally O- stock
+    bag_id = stock_dict.oldest_in_groups(dispatch_groups(blood_type_required), use_by_cutoff())
+    if bag_id is not None:
+        bag = stock_dict.get(bag_id)
+        print('Following bag should be supplied\nID: ' + str(bag_id) + ' (' + bag.blood_group + ')\n')
+        input('Press [Enter] once it is packed for dispatch... ')
+        try:
+            stock_dict.remove(bag_id)  # Remove the dispatched bag from the database, which is later saved to file
+        except KeyError:  # Another terminal sharing the database dispatched it first
+            print('That bag has already been dispatched from another terminal. Please try again.\n')
+            return
+        save_db(donors_dict, stock_dict)  # Call the save_db() function
+        print('Inventory records updated.\nUpdated database files saved to disk.\n')
     else:
-        # Get the list of eligible donors with compatible blood type
+        if SITES_FILE:
+            refer_to_site(blood_type_required)  # Another centre may be able to send a bag
         print('We can not meet the requirement. Checking the donor database...\n')
-        for donor_id, donor_details in donors_dict.items():
-            # Give each index a variable name
-            name = donor_details[0]
-            phone = donor_details[1]
-            email = donor_details[2]
-            blood_grp = donor_details[3]
-            if blood_grp in blood_table[blood_type_required]:
-                print('Following donors match the requirements. Please contact them for new donation.\n')
-                print('• ' + name + ', ' + phone + ', ' + email + '\n')
-
-
+        list_donors(blood_type_required, donors_dict)
+
+
+@metrics.timed
+def attend_demands(blood_types_required, donors_dict, stock_dict):
+    """ This function allocates bags to a whole batch of blood demands at once. The allocation fills as many demands
+    as possible and keeps universal O- stock for the demands only it can meet. Donors are listed for the rest """
+    allocation = allocate(blood_types_required, stock_dict, use_by_cutoff())  # One bag ID (or None) per demand
+    dispatched = [bag_id for bag_id in allocation if bag_id is not None]
+    if len(dispatched) > 0:
+        print('Following bags should be supplied')
+        for blood_type_required, bag_id in zip(blood_types_required, allocation):
+            if bag_id is not None:
+                print('ID: ' + str(bag_id) + ' (' + stock_dict.get(bag_id).blood_group + ') for ' + blood_type_required)
+        print()
+        input('Press [Enter] once they are packed for dispatch... ')
+        taken = stock_dict.dispose(dispatched)  # Remove the dispatched bags from the database in one batch
+        save_db(donors_dict, stock_dict)  # Call the save_db() function
+        print('Inventory records updated.\nUpdated database files saved to disk.\n')
+        if taken:  # Dispatched from another terminal sharing the database in the meantime
+            print('Bag(s)', ', '.join(map(str, taken)), 'had already been dispatched from another terminal.\n')
+
+    # Each blood group that is still short only needs its donors listed once
+    unmet = []
+    for blood_type_required, bag_id in zip(blood_types_required, allocation):
+        if bag_id is None and blood_type_required not in unmet:
+            unmet.append(blood_type_required)
+    for blood_type_required in unmet:
+        if SITES_FILE:
+            refer_to_site(blood_type_required)
+        print('We can not meet the requirement for', blood_type_required + '. Checking the donor database...\n')
+        list_donors(blood_type_required, donors_dict)
+
+
+@metrics.timed
+def refer_to_site(blood_type_required):
+    """ This function finds the nearest other collection centre holding a bag that a blood_type_required recipient can
+    receive. The centres' stock is read in parallel worker processes, and re-read only for centres whose files have
+    changed since the last referral """
+    global site_inventory
+    if site_inventory is None:
+        from sites import SiteInventory, read_sites  # Starts worker processes, so only loaded when first needed
+        try:
+            site_inventory = SiteInventory(read_sites(SITES_FILE))
+        except (IOError, ValueError) as error:
+            print('Could not read the sites file:', str(error) + '\n')
+            return
+    here = site_inventory.find(SITE_NAME)
+    if here is None:
+        print('This site is not in the sites file; set LBI_SITE to its name.\n')
+        return
+    for name in site_inventory.refresh(use_by_cutoff()):
+        print('Could not read the stock of', name)
+    found = site_inventory.nearest_with_stock(blood_type_required, here.latitude, here.longitude, here.name)
+    if found is None:
+        print('No other site has stock for', blood_type_required + '.\n')
+    else:
+        site, distance, bag_id, bag_group = found
+        print('Nearest site with stock for', blood_type_required + ':', site.name, '({:.1f} km away)'.format(distance))
+        print('ID: ' + str(bag_id) + ' (' + bag_group + ')\n')
+
+
+@metrics.timed
+def list_donors(blood_type_required, donors_dict):
+    """ This function lists the donors with a blood type compatible with blood_type_required who may give blood
+    today, whom staff can contact. They are listed a page at a time, those who donated longest ago first """
+    last_day = recall_cutoff(date.today())
+    page = donors_dict.eligible(blood_table[blood_type_required], last_day, RECALL_PAGE_SIZE)
+    if len(page) == 0:
+        print('No eligible donors with a compatible blood type were found.\n')
+        return
+    print('Following donors match the requirements. Please contact them for new donation.\n')
+    while True:
+        metrics.count('rows_scanned', len(page))
+        for donor_id, donor in page:
+            print('• ' + donor.name + ', ' + donor.phone + ', ' + donor.email + '\n')
+        if len(page) < RECALL_PAGE_SIZE or input('Show more donors? (y/n): ').lower() != 'y':
+            return
+        donor_id, donor = page[-1]  # The next page starts after the last donor shown
+        page = donors_dict.eligible(blood_table[blood_type_required], last_day, RECALL_PAGE_SIZE,
+                                    (donor.last_donation, donor_id))
+        if len(page) == 0:
+            print('No more eligible donors.\n')
+            return
+
+
+@metrics.timed
 def record_donation(unique_donor_id, donors_dic, stock_dic):
     """ This function allows staff to check for available donors and add a new bag to the database """
     try:
         date_today = date.today()  # Set today's date
-        for donor_id, donor_details in donors_dic.items():
-            # Return last donation date corresponding to a date string in the format YYYY-MM-DD
-            last_donation = date.fromisoformat(donor_details[4])
-            age_of_donation = (date_today - last_donation).days  # Calculate difference in number of days
-            # Add a new field for donation age to the dictionary
-            donors_dic[donor_id].append(age_of_donation)
-            age_of_donation = donor_details[-1]
-            if donors_dic.get(unique_donor_id) is None:  # If donor id is not found in the database
-                print('That ID does not exist in the database.\nTo register a new donor, please contact the system '
-                      'administrator.\n')
-                break
-            # Ineligible if donation age is greater than 120 days from the last donation
-            elif donor_id == unique_donor_id and age_of_donation >= 120:
-                print('Sorry, this donor is not eligible for donation.\n')
-                break
-        else:
-            # If eligible, add a new bag with the current date and new autogenerated ID, also update donor's last
-            # donation date
-            print('Recording a new donation with following details:')
-            for donor_id, donor_details in donors_dic.items():
-                donor_name = donor_details[0]
-                donor_blood_group = donor_details[3]
-                last_donation_date = date_today.isoformat()  # Convert date object to ISO format
-                if donor_id == unique_donor_id:
-                    print('From: ', donor_name)
-                    print('Group: ', donor_blood_group)
-                    print('Date: ', date_today)
-                    donors_dic[donor_id][4] = last_donation_date  # Update donor's last donation date
-                    save_db(donors_dic, stock_dic)  # Call the save_db() function to save donor data
-                    add_bag(donor_blood_group)  # Call the add_bag function to add new bag
+        donor = donors_dic.get(unique_donor_id)  # Look up the donor by ID
+        if donor is None:  # If donor id is not found in the database
+            print('That ID does not exist in the database.\nTo register a new donor, please contact the system '
+                  'administrator.\n')
+            return
+        if not donor_eligible(donor, date_today):
+            print('Sorry, this donor is not eligible for donation.\n')
+            return
+
+        # If eligible, add a new bag with the current date and new autogenerated ID, also update donor's last
+        # donation date
+        print('Recording a new donation with following details:')
+        donor_name = donor.name
+        donor_blood_group = donor.blood_group
+        print('From: ', donor_name)
+        print('Group: ', donor_blood_group)
+        print('Date: ', date_today)
+        donors_dic.update_last_donation(unique_donor_id, date_today.isoformat())  # Update last donation date
+        save_db(donors_dic, stock_dic)  # Call the save_db() function to save donor data
+        add_bag(donor_blood_group, stock_dic)  # Call the add_bag function to add new bag
 
     except ValueError:  # Catch any invalid input
         sys.exit('Invalid data format. System exiting...\n')
 
 
-def visual_report(bags_file):
-    """ This function allows the user to see the distribution of in-stock blood bags in the form of a pie chart """
-    # Initialise the blood group count values to zero
-    count_O_neg, count_O_pos, count_B_neg, count_B_pos = 0, 0, 0, 0
-    count_A_neg, count_A_pos, count_AB_neg, count_AB_pos = 0, 0, 0, 0
-
-    report_dict = {}  # Create an empty dictionary to store the total count of blood per group
-
-    # Count the number of occurrences of blood per group
-    for key, value in bags_file.items():
-        blood_group = value[0]
-        if blood_group == 'O-':
-            count_O_neg += 1
-            report_dict['O-'] = count_O_neg
-        elif blood_group == 'O+':
-            count_O_pos += 1
-            report_dict['O+'] = count_O_pos
-        elif blood_group == 'B-':
-            count_B_neg += 1
-            report_dict['B-'] = count_B_neg
-        elif blood_group == 'A-':
-            count_A_neg += 1
-            report_dict['A-'] = count_A_neg
-        elif blood_group == 'A+':
-            count_A_pos += 1
-            report_dict['A+'] = count_A_pos
-        elif blood_group == 'AB-':
-            count_AB_neg += 1
-            report_dict['AB-'] = count_AB_neg
-        elif blood_group == 'AB+':
-            count_AB_pos += 1
-            report_dict['AB+'] = count_AB_pos
-        else:
-            report_dict = {}
+def donor_eligible(donor, date_today):
+    """ This function tells whether a donor may give blood today """
+    # Dates are kept as day ordinals, so the date the donor may give again is an addition
+    return date_today.toordinal() >= donor.last_donation + DONATION_WINDOW
+
+
+def recall_cutoff(date_today):
+    """ This function returns the latest last donation date of donors who may give blood on date_today """
+    return date_today - timedelta(days=DONATION_WINDOW)
 
-    # Create list of data and labels from dictionary
-    labels = [key for key in report_dict.keys()]
-    data = [value for value in report_dict.values()]
+
+@metrics.timed
+def visual_report(bags_file, report_file=None):
+    """ This function allows the user to see the distribution of in-stock blood bags in the form of a pie chart. With a
+    report file name (or LBI_REPORT_FILE set) the chart is written to that PNG or SVG file instead of a window """
+    # The stock keeps a count per blood group, so the report does not have to go through every bag
+    counts = bags_file.group_counts()
+    # Every donor group against every recipient group at once: the bags a recipient of each group could receive
+    serves = compatible_supply(counts, range(len(BLOOD_GROUPS))).tolist()
+    print('Bags in stock that could serve each recipient group:')
+    print('  '.join(group + ' ' + format(count, ',') for group, count in zip(BLOOD_GROUPS, serves)) + '\n')
+    report_file = report_file or REPORT_FILE
+    if report_file:
+        stock_chart.render(counts, report_file)  # Drawn off screen, reusing the figure while the stock is unchanged
+        print('Stock report saved to', report_file)
+        return
+
+    # Create list of data and labels for the groups in stock
+    labels = [blood_group for blood_group, count in zip(BLOOD_GROUPS, counts) if count > 0]
+    data = [count for count in counts if count > 0]
 
     # Format the data and labels
     data_label = ['{} ({:,.0f})'.format(label, data) for label, data in zip(labels, data)]
 
-    # Plot the pie-chart
+    # Plot the pie-chart; pyplot is imported on first use as it is slow to load and most sessions never need it
+    import matplotlib.pyplot as plt
     plt.pie(data, labels=data_label)
     plt.show()
 
 
-def add_bag(blood_group):
+@metrics.timed
+def add_bag(blood_group, stock_dic):
     """ This function adds a new bag to the database with the current date added """
     try:
-        new_bags_file = open(BAGS_NEW_FILE, 'r+')
         today = date.today()  # Set the current date
         current_date = today.isoformat()  # Convert date object to ISO format
-        # Get the next bag ID in the database and increment by one
-        bag_id = max([int(line.split(',')[0]) for line in new_bags_file]) + 1
+        # Get the next bag ID from the shared sequence
+        bag_id = stock_dic.sequence.next_id()
         print('Bag ID:', bag_id)
         confirm_save = input('Please confirm (y/n): ').lower()
         if confirm_save == 'y':
-            new_bags_file.write(str(bag_id) + ',' + blood_group + ',' + current_date + '\n')
+            stock_dic.add(bag_id, blood_group, current_date)  # Appends the new bag to the journal
+            stock_dic.commit()
             print('Done. Donor\'s last donation date also updated to', current_date)
             print('Updated database files saved to disk.\n')
         elif confirm_save == 'n':
             print('Cancelled.\n')
         else:
             print('Invalid choice\n')
-        new_bags_file.close()
 
-    except FileNotFoundError:
-        print('No such file or directory')
+    except IOError:
+        print('Some error in the file I/O occurred')
 
     except ValueError:
-        print('Invalid data or file is empty')
+        print('Invalid data')
 
     except:
         sys.exit('Something went wrong')
 
 
-main()
+def batch_main(arguments):
+    """ This function runs the program without prompts: operations are read one per line from a file (or stdin) and
+    each result is written as a line of JSON. The confirmations of the menu are replaced by policy flags """
+    parser = argparse.ArgumentParser(description='Run blood bank operations from a file without prompts. '
+                                                 'Operations, one per line: inventory | demand [group] | '
+                                                 'demands group... | stream rounds [interval] | donate donor_id | '
+                                                 'report [image]')
+    parser.add_argument('operations', nargs='?', default='-', help='operations file, or - for stdin (default)')
+    parser.add_argument('--donors', default=DONORS_FILE, help='donors file or SQLite .db file')
+    parser.add_argument('--stock', help='bags file, or stock table of an SQLite database')
+    parser.add_argument('--service', default=SERVICE_SOCKET, help='socket of a database service to use instead')
+    parser.add_argument('--output', default='-', help='results file, or - for stdout (default)')
+    parser.add_argument('--no-dispose', dest='dispose', action='store_false',
+                        help='list expired bags without disposing of them')
+    parser.add_argument('--no-dispatch', dest='dispatch', action='store_false',
+                        help='report the bags that would be dispatched, leaving them in stock')
+    parser.add_argument('--no-donations', dest='donations', action='store_false',
+                        help='check donor eligibility without recording donations')
+    parser.add_argument('--commit-every', type=int, default=BATCH_COMMIT_EVERY,
+                        help='operations between commits to disk')
+    policy = parser.parse_args(arguments)
+    if policy.stock is None:
+        policy.stock = DEFAULT_STOCK_TABLE if policy.donors.endswith('.db') else BAGS_FILE
+
+    with contextlib.redirect_stdout(sys.stderr):  # Keep loading messages out of the results
+        if policy.service:
+            donors_data, stock_data = connect_db(policy.service)
+        else:
+            donors_data, stock_data = load_db(policy.donors, policy.stock)
+    try:
+        operations = sys.stdin if policy.operations == '-' else open(policy.operations)
+        output = sys.stdout if policy.output == '-' else open(policy.output, 'w')
+    except IOError:
+        sys.exit('Some error in the file I/O occurred')
+    with operations, output:
+        run_batch(operations, donors_data, stock_data, policy, output)
+    close_db(donors_data, stock_data)
+
+
+def run_batch(lines, donors_data, stock_data, policy, output):
+    """ This function runs each operation in lines and writes its result to output, committing every
+    policy.commit_every operations and once more at the end """
+    pending = 0  # Operations run since the last commit
+    for line_number, line in enumerate(lines, 1):
+        words = line.split()
+        if len(words) == 0 or words[0].startswith('#'):  # Skip blank lines and comments
+            continue
+        operation = BATCH_OPERATIONS.get(words[0].lower())
+        try:
+            if operation is None:
+                raise ValueError('unknown operation')
+            result = operation(words[1:], donors_data, stock_data, policy)
+        except (ValueError, KeyError, IndexError) as error:
+            result = {'status': 'error', 'reason': str(error)}
+        output.write(json.dumps(dict(line=line_number, op=words[0], **result)) + '\n')
+        pending += 1
+        if pending >= policy.commit_every:
+            save_db(donors_data, stock_data)
+            pending = 0
+    save_db(donors_data, stock_data)
+
+
+@metrics.timed
+def batch_inventory(arguments, donors_data, stock_data, policy):
+    """ inventory: list the expired bags and dispose of them """
+    expired = stock_data.collected_before(use_by_cutoff())
+    if policy.dispose:
+        stock_data.dispose(expired)
+    return {'status': 'ok', 'expired': expired, 'disposed': policy.dispose}
+
+
+@metrics.timed
+def batch_demand(arguments, donors_data, stock_data, policy):
+    """ demand [group]: dispatch a bag for one demand, asking the hospital servers when no group is given """
+    blood_required = arguments[0].upper() if arguments else next_demand()
+    if blood_required == 'X':
+        return {'status': 'unreachable'}
+    if blood_required not in blood_table:
+        raise ValueError('unknown blood group ' + blood_required)
+    while True:
+        bag_id = stock_data.oldest_in_groups(dispatch_groups(blood_required), use_by_cutoff())
+        if bag_id is None:
+            return {'status': 'unmet', 'group': blood_required, 'donors': list_donor_ids(blood_required, donors_data)}
+        bag = stock_data.get(bag_id)
+        if bag is None:
+            continue  # Taken by another terminal sharing the database in the meantime
+        if not policy.dispatch:
+            break
+        try:
+            stock_data.remove(bag_id)
+            break
+        except KeyError:
+            continue  # Taken by another terminal sharing the database in the meantime
+    bag_group = bag.blood_group
+    return {'status': 'dispatched' if policy.dispatch else 'held', 'group': blood_required, 'bag': bag_id,
+            'bag_group': bag_group}
+
+
+@metrics.timed
+def batch_demands(arguments, donors_data, stock_data, policy):
+    """ demands group...: allocate bags to a batch of demands at once """
+    demands = [blood_group.upper() for blood_group in arguments]
+    for blood_group in demands:
+        if blood_group not in blood_table:
+            raise ValueError('unknown blood group ' + blood_group)
+    allocation = allocate(demands, stock_data, use_by_cutoff())
+    dispatched = [bag_id for bag_id in allocation if bag_id is not None]
+    taken = stock_data.dispose(dispatched) if policy.dispatch else []
+    unmet = {}
+    for blood_required, bag_id in zip(demands, allocation):
+        if bag_id is None and blood_required not in unmet:
+            unmet[blood_required] = list_donor_ids(blood_required, donors_data)
+    return {'status': 'dispatched' if policy.dispatch else 'held', 'bags': allocation, 'unmet': unmet, 'taken': taken}
+
+
+@metrics.timed
+def batch_stream(arguments, donors_data, stock_data, policy):
+    """ stream rounds [interval]: poll every hospital server rounds times, interval seconds apart, and allocate bags
+    to the demands in batches as they arrive """
+    if not HOSPITAL_SERVERS:
+        raise ValueError('no hospital servers are set (LBI_HOSPITALS)')
+    rounds = int(arguments[0])
+    interval = float(arguments[1]) if len(arguments) > 1 else STREAM_INTERVAL
+    from hospital_client import stream_to  # Loads asyncio, so only when it is used
+    batches = []
+    unreachable = stream_to(HOSPITAL_SERVERS,
+                            lambda demands: batches.append(batch_demands(demands, donors_data, stock_data, policy)),
+                            rounds, interval)
+    return {'status': 'ok', 'batches': batches, 'unreachable': unreachable}
+
+
+@metrics.timed
+def batch_donate(arguments, donors_data, stock_data, policy):
+    """ donate donor_id: record a donation and add its bag to the stock """
+    donor_id = int(arguments[0])
+    donor = donors_data.get(donor_id)
+    if donor is None:
+        return {'status': 'unknown', 'donor': donor_id}
+    date_today = date.today()
+    if not donor_eligible(donor, date_today):
+        return {'status': 'ineligible', 'donor': donor_id}
+    if not policy.donations:
+        return {'status': 'eligible', 'donor': donor_id}
+    donors_data.update_last_donation(donor_id, date_today.isoformat())
+    bag_id = stock_data.sequence.next_id()
+    stock_data.add(bag_id, donor.blood_group, date_today.isoformat())
+    return {'status': 'recorded', 'donor': donor_id, 'bag': bag_id, 'group': donor.blood_group}
+
+
+@metrics.timed
+def batch_report(arguments, donors_data, stock_data, policy):
+    """ report [image file]: the number of bags in stock per blood group and the number that could serve a recipient of
+    each group, optionally also drawn as a chart """
+    counts = stock_data.group_counts()
+    serves = compatible_supply(counts, range(len(BLOOD_GROUPS))).tolist()  # Compatible bags per recipient group
+    result = {'status': 'ok', 'stock': dict(zip(BLOOD_GROUPS, counts)), 'serves': dict(zip(BLOOD_GROUPS, serves))}
+    if arguments:
+        stock_chart.render(counts, arguments[0])
+        result['chart'] = arguments[0]
+    return result
+
+
+def list_donor_ids(blood_type_required, donors_dict):
+    """ This function returns the IDs of up to BATCH_DONORS_LISTED eligible donors compatible with blood_type_required,
+    those who donated longest ago first """
+    donors = donors_dict.eligible(blood_table[blood_type_required], recall_cutoff(date.today()), BATCH_DONORS_LISTED)
+    return [donor_id for donor_id, donor in donors]
+
+
+# Batch operation names and the functions that run them
+BATCH_OPERATIONS = {
+    'inventory': batch_inventory,
+    'demand': batch_demand,
+    'demands': batch_demands,
+    'stream': batch_stream,
+    'donate': batch_donate,
+    'report': batch_report,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:  # Any command line arguments select the batch mode
+        batch_main(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,122 @@
+""" Batch allocation of blood bags to many hospital demands at once
+
+Filling demands one at a time with whatever compatible bag comes first can spend scarce O- stock on an A+ request that
+A+ bags could have covered, and leave a later O- patient without blood. Instead, all outstanding demands are counted
+per recipient group and the stock per donor group, and a minimum-cost maximum flow is solved over the 8 x 8
+compatibility graph (source -> donor group -> recipient group -> sink). The flow fills as many demands as possible and,
+among all assignments that do, prefers exact group matches and uses universal O- stock least. The graph has 18 nodes
+whatever the size of the batch or inventory, so planning is constant time; picking the actual bags then takes the
+oldest bags of each donor group, to reduce wastage.
+"""
+
+import numpy as np
+from compatibility import BLOOD_GROUPS, GROUP_CODES, COMPATIBLE
+
+UNIVERSAL_PENALTY = 10  # Extra cost of using an O- bag for anyone but an O- recipient
+
+_GROUPS = len(BLOOD_GROUPS)
+_SOURCE = 0
+_SINK = 2 * _GROUPS + 1
+
+
+def allocation_cost(donor_code, recipient_code):
+    """ Return the cost of serving a recipient group with a donor group: one per antigen the recipient has that the
+    donor lacks, plus UNIVERSAL_PENALTY for O- stock given to anyone but an O- recipient """
+    cost = bin(recipient_code & ~donor_code & 7).count('1')
+    if donor_code == 0 and recipient_code != 0:
+        cost += UNIVERSAL_PENALTY
+    return cost
+
+
+def plan(supply, demand):
+    """ Return an 8 x 8 matrix of how many bags of each donor group (rows) should go to each recipient group
+    (columns), given the bags in stock and the bags demanded per group, both indexed by group code """
+    # Residual graph as adjacency lists of edge indexes; edges are stored in pairs so edge ^ 1 is the reverse edge
+    heads, capacities, costs, graph = [], [], [], [[] for node in range(_SINK + 1)]
+
+    def add_edge(tail, head, capacity, cost):
+        for start, end, cap, price in ((tail, head, capacity, cost), (head, tail, 0, -cost)):
+            graph[start].append(len(heads))
+            heads.append(end)
+            capacities.append(cap)
+            costs.append(price)
+
+    for code in range(_GROUPS):
+        add_edge(_SOURCE, 1 + code, int(supply[code]), 0)
+        add_edge(1 + _GROUPS + code, _SINK, int(demand[code]), 0)
+    transfer_edges = {}
+    for donor in range(_GROUPS):
+        for recipient in range(_GROUPS):
+            if COMPATIBLE[donor, recipient]:
+                transfer_edges[donor, recipient] = len(heads)
+                add_edge(1 + donor, 1 + _GROUPS + recipient, int(supply[donor]), allocation_cost(donor, recipient))
+
+    # Successive shortest paths (Bellman-Ford, as residual edges can have negative cost) until the sink is unreachable
+    while True:
+        distance = [None] * (_SINK + 1)
+        through = [None] * (_SINK + 1)  # Edge used to reach each node
+        distance[_SOURCE] = 0
+        changed = True
+        while changed:
+            changed = False
+            for node in range(_SINK + 1):
+                if distance[node] is None:
+                    continue
+                for edge in graph[node]:
+                    if capacities[edge] > 0:
+                        candidate = distance[node] + costs[edge]
+                        if distance[heads[edge]] is None or candidate < distance[heads[edge]]:
+                            distance[heads[edge]] = candidate
+                            through[heads[edge]] = edge
+                            changed = True
+        if distance[_SINK] is None:
+            break
+        path, node = [], _SINK
+        while node != _SOURCE:
+            path.append(through[node])
+            node = heads[through[node] ^ 1]
+        amount = min(capacities[edge] for edge in path)
+        for edge in path:
+            capacities[edge] -= amount
+            capacities[edge ^ 1] += amount
+
+    flows = np.zeros((_GROUPS, _GROUPS), dtype=np.int64)
+    for (donor, recipient), edge in transfer_edges.items():
+        flows[donor, recipient] = capacities[edge ^ 1]  # Flow sent equals the reverse edge's capacity
+    return flows
+
+
+def _assign(demand_codes, flows, bags_for_group):
+    """ Turn a flow matrix into one bag ID (or None) per demand, using bags_for_group(code, count) to fetch bags """
+    assignment = [None] * len(demand_codes)
+    waiting = {code: [] for code in range(_GROUPS)}  # Demand positions per recipient group, first come first served
+    for position, code in enumerate(demand_codes):
+        if code in waiting:  # A demand for an unrecognised group can never be met
+            waiting[code].append(position)
+    filled = [0] * _GROUPS
+    for donor in range(_GROUPS):
+        needed = int(flows[donor].sum())
+        if needed == 0:
+            continue
+        bags = iter(bags_for_group(donor, needed))
+        for recipient in range(_GROUPS):
+            for count in range(int(flows[donor, recipient])):
+                # A store shared with other terminals can hand back fewer bags than it counted a moment earlier
+                assignment[waiting[recipient][filled[recipient]]] = next(bags, None)
+                filled[recipient] += 1
+    return assignment
+
+
+def allocate(demands, stock, expired_before=None):
+    """ Allocate bags from a BagStore to a list of demanded blood groups, one bag per demand. Bags collected before
+    expired_before (a date), which are past their shelf life, are never allocated
+
+    Returns a list holding, for each demand in order, the ID of the bag to dispatch or None if it cannot be met.
+    Nothing is removed from the store; the caller dispatches the bags """
+    demand_codes = [GROUP_CODES[group] for group in demands]
+    supply = [stock.count(group, expired_before) for group in BLOOD_GROUPS]
+    demand = np.bincount(demand_codes, minlength=_GROUPS) if demand_codes else np.zeros(_GROUPS, dtype=np.int64)
+    flows = plan(supply, demand)
+    return _assign(demand_codes, flows,
+                   lambda code, count: stock.oldest_bags(BLOOD_GROUPS[code], count, expired_before))
+
@@ -0,0 +1,272 @@
+""" Benchmarks for the LifeServe Blood Institute (LBI) blood bank program
+
+Seeded generators write synthetic donors and bags files in the same formats as donors.txt and bags.txt, with blood
+groups drawn from a typical population distribution. For each size, the data is loaded with load_db and the menu
+operations are timed against it: wall time, operations per second and peak memory (traced by tracemalloc in a separate
+run, so tracing does not slow the timings). Startup is timed by launching the program itself, from the start of the
+process to the first menu prompt and to the stores being ready, both cold (parsing the text files) and warm (from
+their column caches). Each benchmark runs in a scratch directory so the journal and the bag ID sequence of a real
+database are never touched.
+
+Results can be saved as a baseline and later runs compared against it, flagging operations that got slower:
+python benchmark.py --sizes 1000 100000 --save baseline.json
+python benchmark.py --sizes 1000 100000 --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+import matplotlib
+matplotlib.use('Agg')  # visual_report draws off screen
+import matplotlib.pyplot as plt
+from column_cache import CACHE_SUFFIX
+
+# Share of the population in each blood group
+GROUP_SHARES = {'O+': 0.38, 'A+': 0.34, 'B+': 0.09, 'O-': 0.07, 'A-': 0.06, 'AB+': 0.03, 'B-': 0.02, 'AB-': 0.01}
+FIRST_NAMES = ['Ignatiy', 'Jorgen', 'Bethel', 'Trygve', 'Amara', 'Kofi', 'Mei', 'Sanjay', 'Olga', 'Luis', 'Aroha',
+               'Fatima', 'Hamish', 'Ines', 'Tane', 'Yuki']
+LAST_NAMES = ['Claudio', 'Krysia', 'Wayland', 'Imke', 'Okafor', 'Mensah', 'Chen', 'Patel', 'Ivanova', 'Garcia',
+              'Ngata', 'Haddad', 'Stewart', 'Moreau', 'Walker', 'Sato']
+EMAIL_DOMAINS = ['gmail.com', 'yahoo.com', 'outlook.com', 'defence.gov.au']
+DONATION_HISTORY = 365  # Last donation dates are spread over this many days
+STOCK_HISTORY = 40  # Bags are collected over this many days, so some are past their shelf life
+WRITE_CHUNK = 100000  # Lines formatted and written at a time
+
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5]
+CALLS = 200  # Most calls made to time a repeatable operation
+TIME_BUDGET = 2.0  # Seconds after which no further calls are made
+MENU_PROMPT = b'Enter your choice: '
+STARTUP_INPUT = b'\n\n'  # Accept the default database files
+EXIT_INPUT = b'6\n'  # Menu choice that exits, once the stores are built
+EXIT_MESSAGE = b'Have a good day.'
+REGRESSION_THRESHOLD = 1.25  # Slower than the baseline by this factor counts as a regression
+
+
+def _groups(rng, count):
+    return rng.choices(list(GROUP_SHARES), weights=list(GROUP_SHARES.values()), k=count)
+
+
+def generate_donors(path, count, seed=0, today=None):
+    """ Write count synthetic donors, with IDs 1 to count, in the donors.txt format """
+    rng = random.Random(seed)
+    today = (today or date.today()).toordinal()
+    with open(path, 'w') as donors_file:
+        for start in range(1, count + 1, WRITE_CHUNK):
+            end = min(start + WRITE_CHUNK, count + 1)
+            lines = []
+            for donor_id, group in zip(range(start, end), _groups(rng, end - start)):
+                first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                phone = '04{:02d} {:03d} {:03d}'.format(rng.randrange(100), rng.randrange(1000), rng.randrange(1000))
+                email = (first[0] + last).lower() + str(donor_id) + '@' + rng.choice(EMAIL_DOMAINS)
+                last_donation = date.fromordinal(today - rng.randrange(DONATION_HISTORY)).isoformat()
+                lines.append(str(donor_id) + ',' + first + ' ' + last + ',' + phone + ',' + email + ',' + group + ',' +
+                             last_donation + '\n')
+            donors_file.writelines(lines)
+
+
+def generate_bags(path, count, seed=0, today=None, first_id=1):
+    """ Write count synthetic bags, with consecutive IDs from first_id, in the bags.txt format """
+    rng = random.Random(seed + 1)  # Not the donors' stream, so the two files are independent
+    today = (today or date.today()).toordinal()
+    dates = [date.fromordinal(today - age).isoformat() for age in range(STOCK_HISTORY)]
+    with open(path, 'w') as bags_file:
+        for start in range(first_id, first_id + count, WRITE_CHUNK):
+            end = min(start + WRITE_CHUNK, first_id + count)
+            bags_file.writelines([str(bag_id) + ',' + group + ',' + rng.choice(dates) + '\n'
+                                  for bag_id, group in zip(range(start, end), _groups(rng, end - start))])
+
+
+def measure(function, calls=1, memory=True):
+    """ Time up to calls calls of function (stopping after TIME_BUDGET seconds, but making at least one), then trace
+    the peak memory of one more call. Returns a dictionary of the figures """
+    made = 0
+    started = time.perf_counter()
+    while made < calls:
+        function()
+        made += 1
+        if time.perf_counter() - started > TIME_BUDGET:
+            break
+    seconds = time.perf_counter() - started
+    result = {'calls': made, 'seconds': seconds / made, 'ops_per_sec': made / seconds if seconds > 0 else None}
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _reset_journal():
+    """ Remove the journal left by a previous load, so the next load_db starts from the text files """
+    for name in os.listdir('.'):
+        if name.startswith('lbi-'):
+            os.remove(name)
+
+
+def _reset_caches():
+    """ Remove the column caches of the text files, so the next load parses them """
+    for name in os.listdir('.'):
+        if name.endswith(CACHE_SUFFIX):
+            os.remove(name)
+
+
+def _read_until(process, marker, output):
+    """ Read the process's output into output until it holds marker; raises RuntimeError if the process exits first """
+    while marker not in output:
+        data = os.read(process.stdout.fileno(), 65536)
+        if not data:
+            raise RuntimeError('the program exited before printing {!r}: {}'.format(marker, output.decode()[-500:]))
+        output += data
+
+
+def measure_startup(script):
+    """ Launch the program in the current directory with the default database files, and time from the start of the
+    process to the first menu prompt and to the first menu choice being answered, which waits for the stores """
+    _reset_journal()
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        output = bytearray()
+        process.stdin.write(STARTUP_INPUT)
+        process.stdin.flush()
+        _read_until(process, MENU_PROMPT, output)
+        menu = time.perf_counter() - started
+        process.stdin.write(EXIT_INPUT)
+        process.stdin.flush()
+        _read_until(process, EXIT_MESSAGE, output)
+        ready = time.perf_counter() - started
+    finally:
+        process.kill()
+        process.wait()
+    return ({'calls': 1, 'seconds': menu, 'ops_per_sec': 1 / menu},
+            {'calls': 1, 'seconds': ready, 'ops_per_sec': 1 / ready})
+
+
+def run_size(lbi, size, seed=0, memory=True):
+    """ Benchmark every operation against size donors and size bags; returns {operation: figures} """
+    generate_donors('donors.txt', size, seed)
+    generate_bags('bags.txt', size, seed)
+    rng = random.Random(seed)
+    groups = list(GROUP_SHARES)
+    stores = []
+
+    def load():
+        _reset_journal()
+        _reset_caches()
+        stores[:] = lbi.load_db('donors.txt', 'bags.txt')
+
+    def load_cached():
+        _reset_journal()
+        stores[:] = lbi.load_db('donors.txt', 'bags.txt')
+
+    results = {'load_db': measure(load, 1, memory), 'load_db_cached': measure(load_cached, 1, memory)}
+    donors_data, stock_data = stores
+
+    def change_and_save():
+        stock_data.add(rng.randrange(size + 1, 2 * size + 1), rng.choice(groups), date.today().isoformat())
+        lbi.save_db(donors_data, stock_data)
+
+    def compact():
+        lbi.compact_db(donors_data, stock_data)
+        stock_data.journal.wait()
+
+    def report():
+        lbi.visual_report(stock_data)
+        plt.close('all')
+
+    results['save_db'] = measure(change_and_save, CALLS, memory)
+    results['compact_db'] = measure(compact, 1, memory)
+    results['check_inventory'] = measure(lambda: lbi.check_inventory(stock_data), CALLS, memory)
+    results['attend_demand'] = measure(lambda: lbi.attend_demand(rng.choice(groups), donors_data, stock_data),
+                                       CALLS, memory)
+    results['record_donation'] = measure(lambda: lbi.record_donation(rng.randrange(1, size + 1), donors_data,
+                                                                     stock_data), CALLS, memory)
+    results['visual_report'] = measure(report, CALLS, memory)
+    lbi.close_db(donors_data, stock_data)
+    _reset_caches()
+    results['startup_menu'], results['startup_ready'] = measure_startup(lbi.__file__)
+    results['startup_menu_warm'], results['startup_ready_warm'] = measure_startup(lbi.__file__)
+    return results
+
+
+def run(sizes, seed=0, memory=True):
+    """ Benchmark every size in a scratch directory; returns {size: {operation: figures}} """
+    lbi = importlib.import_module('Assignment_3_11747979')
+    lbi.input = lambda prompt='': 'y'  # Answer every prompt of the program
+    home = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='lbi-benchmark-')
+    results = {}
+    try:
+        os.chdir(scratch)
+        for size in sizes:
+            with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+                results[str(size)] = run_size(lbi, size, seed, memory)
+            print_results(size, results[str(size)])
+    finally:
+        os.chdir(home)
+        shutil.rmtree(scratch)
+    return results
+
+
+def print_results(size, results):
+    """ Print one size's figures as a table """
+    print('{:,} donors and bags'.format(size))
+    print('  {:<16}{:>14}{:>14}{:>14}'.format('operation', 'ms/call', 'ops/sec', 'peak MiB'))
+    for operation, figures in results.items():
+        peak = figures.get('peak_bytes')
+        print('  {:<16}{:>14.3f}{:>14,.0f}{:>14}'.format(operation, figures['seconds'] * 1000,
+                                                        figures['ops_per_sec'] or 0,
+                                                        '-' if peak is None else format(peak / 2 ** 20, '.1f')))
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """ Return a list of (size, operation, baseline seconds, seconds) for every operation slower than the baseline by
+    more than threshold times """
+    regressions = []
+    for size, operations in results.items():
+        for operation, figures in operations.items():
+            before = baseline.get(size, {}).get(operation)
+            if before is not None and figures['seconds'] > before['seconds'] * threshold:
+                regressions.append((size, operation, before['seconds'], figures['seconds']))
+    return regressions
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Benchmark the blood bank program on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of donors and bags to generate (10 ** 7 takes minutes)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the peak memory runs')
+    parser.add_argument('--save', help='write the results to this baseline JSON file')
+    parser.add_argument('--compare', help='compare the results with this baseline JSON file')
+    options = parser.parse_args(arguments)
+
+    results = run(options.sizes, options.seed, options.memory)
+    if options.save:
+        with open(options.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for size, operation, before, after in regressions:
+            print('Regression:', operation, 'with', size, 'rows went from', format(before * 1000, '.3f'), 'to',
+                  format(after * 1000, '.3f'), 'ms per call')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,453 @@
+""" Indexed in-memory store for the LifeServe Blood Institute (LBI) donor and bag databases
+
+Records are immutable Donor and Bag tuples with named fields and no per-instance dictionary. Blood groups are shared
+with BLOOD_GROUPS, and dates are held as day ordinals, one int object per distinct date, so a million records cost
+little more than their names, phones and emails. The indexes share the ID objects of the primary index.
+"""
+
+import bisect
+import gc
+import heapq
+from itertools import islice
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache, partial
+import numpy as np
+from datetime import date
+from compatibility import BLOOD_GROUPS
+from columnar import EPOCH_ORDINAL
+
+DISPOSE_REBUILD_RATIO = 64  # dispose() rebuilds the date index when a batch is more than 1/64th of the stock
+_GROUP_NAMES = {group: group for group in BLOOD_GROUPS}  # Maps an equal string to the shared blood group string
+
+
+def check_group(blood_group):
+    """ Return the shared string of a blood group, raising ValueError if it is not one of the eight groups """
+    shared = _GROUP_NAMES.get(blood_group)
+    if shared is None:
+        raise ValueError('unknown blood group ' + str(blood_group))
+    return shared
+
+
+@lru_cache(maxsize=4096)
+def day_string(day):
+    """ Return a day ordinal as a YYYY-MM-DD string """
+    return date.fromordinal(day).isoformat()
+
+
+def parse_day(date_string):
+    """ Return a YYYY-MM-DD string as a day ordinal """
+    return date.fromisoformat(date_string).toordinal()
+
+
+class Donor(namedtuple('Donor', 'name phone email blood_group last_donation')):
+    """ A donor's details; last_donation is the day ordinal of the last donation """
+    __slots__ = ()
+
+    @property
+    def last_donation_date(self):
+        return day_string(self.last_donation)
+
+
+class Bag(namedtuple('Bag', 'blood_group collected')):
+    """ A blood bag's details; collected is the day ordinal of its collection """
+    __slots__ = ()
+
+    @property
+    def collected_date(self):
+        return day_string(self.collected)
+
+
+def last_occurrences(ids):
+    """ Return the positions of the last row for each ID, in file order, so a repeated ID keeps its latest row """
+    sorted_ids = np.sort(ids)
+    if not (sorted_ids[1:] == sorted_ids[:-1]).any():
+        return np.arange(len(ids))
+    unique_ids, reversed_positions = np.unique(ids[::-1], return_index=True)
+    return np.sort(len(ids) - 1 - reversed_positions)
+
+
+def choose_bag(oldest, blood_groups):
+    """ Return the ID of the bag to dispatch from blood_groups, given oldest(group), which returns (collection date
+    ordinal, bag ID) of a group's oldest bag or None. blood_groups must be ordered from the recipient's own group down
+    to universal O-: the oldest bag of the first group is preferred, then the oldest bag of the groups in between, and
+    the last group is used only when nothing else is left. Returns None if all are empty """
+    if not blood_groups:
+        return None
+    first = oldest(blood_groups[0])
+    if first is not None:
+        return first[1]
+    candidates = [oldest(group) for group in blood_groups[1:-1]]
+    candidates = [candidate for candidate in candidates if candidate is not None]
+    if candidates:
+        return min(candidates)[1]
+    if len(blood_groups) > 1:
+        last = oldest(blood_groups[-1])
+        if last is not None:
+            return last[1]
+    return None
+
+
+@contextmanager
+def _gc_paused():
+    """ Pause the cyclic garbage collector while building millions of tuples, none of which can be part of a cycle.
+    Otherwise every few hundred new tuples trigger a collection that walks all the tuples built so far """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _kept(values, keep):
+    """ Return the rows of a list column at the positions keep, or the list itself if every row is kept """
+    return values if len(keep) == len(values) else [values[i] for i in keep.tolist()]
+
+
+def _shared_days(days):
+    """ Convert an array of day ordinals to a list of ints, sharing one int object per distinct date """
+    if len(days) == 0:
+        return []
+    first = int(days.min())
+    span = list(range(first, int(days.max()) + 1))
+    return [span[offset] for offset in (days - first).tolist()]
+
+
+def _date_strings(days):
+    """ Convert an array of day ordinals to a list of YYYY-MM-DD strings, sharing one string per distinct date """
+    if len(days) == 0:
+        return []
+    first = int(days.min())
+    span = np.arange(first, int(days.max()) + 1, dtype=np.int64)
+    names = np.datetime_as_string((span - EPOCH_ORDINAL).astype('datetime64[D]')).tolist()
+    return [names[offset] for offset in (days - first).tolist()]
+
+
+class DonorStore:
+    """ Donor records keyed on donor ID, with secondary indexes by blood group, by last donation date and by both """
+
+    def __init__(self):
+        self.records = {}  # Primary index: donor ID -> Donor
+        # Secondary index by blood group; dicts are used as insertion-ordered sets of donor IDs
+        self.by_group = {group: {} for group in BLOOD_GROUPS}
+        self.by_date = []  # Sorted list of (last donation date ordinal, donor ID) pairs
+        # Eligibility index: the by_date entries split by blood group. Every donor may give again a fixed number of
+        # days after their last donation, so each list is also in order of the date the donor becomes eligible again,
+        # and the donors eligible on a given day are a prefix of it
+        self.recall = {group: [] for group in BLOOD_GROUPS}
+        self.journal = None  # Journal that every change is appended to, once attached
+
+    @classmethod
+    def from_columns(cls, columns):
+        """ Build a store in bulk from the columns returned by columnar.read_donors, sorting each index once """
+        store = cls()
+        keep = last_occurrences(columns['id'])
+        ids, codes, days = columns['id'][keep], columns['group'][keep], columns['date'][keep]
+        names, phones, emails = (_kept(columns[name], keep) for name in ('name', 'phone', 'email'))
+        with _gc_paused():
+            groups = [BLOOD_GROUPS[code] for code in codes.tolist()]  # Shares the eight group strings
+            id_objects, day_objects = ids.tolist(), _shared_days(days)
+            # tuple.__new__ skips the argument handling of Donor._make, which adds up over a million rows
+            make_donor = partial(tuple.__new__, Donor)
+            store.records = dict(zip(id_objects, map(make_donor, zip(names, phones, emails, groups, day_objects))))
+            for code, group in enumerate(BLOOD_GROUPS):
+                store.by_group[group] = dict.fromkeys([id_objects[i] for i in np.flatnonzero(codes == code).tolist()])
+            order = np.lexsort((ids, days))
+            store.by_date = [(day_objects[i], id_objects[i]) for i in order.tolist()]
+            ordered_codes = codes[order]
+            for code, group in enumerate(BLOOD_GROUPS):
+                store.recall[group] = [store.by_date[i] for i in np.flatnonzero(ordered_codes == code).tolist()]
+        return store
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, donor_id):
+        return donor_id in self.records
+
+    def get(self, donor_id):
+        """ Return the details of a donor, or None if the ID is not in the database """
+        return self.records.get(donor_id)
+
+    def items(self):
+        """ Return (donor ID, details) pairs in insertion order """
+        return self.records.items()
+
+    def add(self, donor_id, name, phone, email, blood_group, last_donation_date):
+        """ Add a donor, replacing any existing record with the same ID. Raises ValueError for an unknown blood group
+        or a malformed date """
+        day = parse_day(last_donation_date)  # Parse the date once, on the way in
+        blood_group = check_group(blood_group)  # Before any change, so an unknown group leaves the store as it was
+        if donor_id in self.records:
+            self._unindex(donor_id)
+        self.records[donor_id] = Donor(name, phone, email, blood_group, day)
+        self.by_group.setdefault(blood_group, {})[donor_id] = None
+        self._index_date(donor_id, blood_group, day)
+        if self.journal is not None:
+            self.journal.append(['donor', donor_id, name, phone, email, blood_group, last_donation_date])
+
+    def remove(self, donor_id):
+        """ Remove a donor and drop it from every index """
+        details = self._unindex(donor_id)
+        if self.journal is not None:
+            self.journal.append(['donor-', donor_id])
+        return details
+
+    def _unindex(self, donor_id):
+        """ Drop a donor from the primary and secondary indexes and return its details """
+        details = self.records.pop(donor_id)
+        del self.by_group[details.blood_group][donor_id]
+        self._unindex_date(donor_id, details.blood_group, details.last_donation)
+        return details
+
+    def update_last_donation(self, donor_id, new_date):
+        """ Set a donor's last donation date (YYYY-MM-DD) and move it in the date indexes """
+        details = self.records[donor_id]
+        day = parse_day(new_date)
+        self._unindex_date(donor_id, details.blood_group, details.last_donation)
+        self.records[donor_id] = details._replace(last_donation=day)
+        self._index_date(donor_id, details.blood_group, day)
+        if self.journal is not None:
+            self.journal.append(['donor', donor_id, details.name, details.phone, details.email, details.blood_group,
+                                 new_date])
+
+    def in_groups(self, blood_groups):
+        """ Yield (donor ID, details) for every donor whose blood group is in blood_groups """
+        for group in blood_groups:
+            for donor_id in self.by_group.get(group, ()):
+                yield donor_id, self.records[donor_id]
+
+    def donated_between(self, first_day, last_day):
+        """ Return the IDs of donors whose last donation date falls within [first_day, last_day] """
+        start = bisect.bisect_left(self.by_date, (first_day.toordinal(),))
+        end = bisect.bisect_left(self.by_date, (last_day.toordinal() + 1,))
+        return [donor_id for day, donor_id in self.by_date[start:end]]
+
+    def eligible(self, blood_groups, last_day, limit, after=None):
+        """ Return up to limit (donor ID, details) pairs for donors in blood_groups whose last donation was on or
+        before last_day, the longest since donating first
+
+        For the next page, pass the (last donation date ordinal, donor ID) of the last donor returned as after. Each
+        group's eligible donors are a prefix of its recall list, so the lists are merged lazily and the cost grows with
+        the page size, not with the number of donors """
+        end_key = (last_day.toordinal() + 1,)
+        pages = []
+        for group in blood_groups:
+            entries = self.recall.get(group, [])
+            start = bisect.bisect_right(entries, after) if after is not None else 0
+            end = bisect.bisect_left(entries, end_key)
+            pages.append(map(entries.__getitem__, range(start, end)))
+        return [(donor_id, self.records[donor_id]) for day, donor_id in islice(heapq.merge(*pages), limit)]
+
+    def _index_date(self, donor_id, blood_group, day):
+        """ Add a (date, donor ID) pair to the date and eligibility indexes """
+        entry = (day, donor_id)
+        bisect.insort(self.by_date, entry)
+        bisect.insort(self.recall.setdefault(blood_group, []), entry)
+
+    def _unindex_date(self, donor_id, blood_group, day):
+        """ Remove a (date, donor ID) pair from the date and eligibility indexes """
+        entry = (day, donor_id)
+        del self.by_date[bisect.bisect_left(self.by_date, entry)]
+        entries = self.recall[blood_group]
+        del entries[bisect.bisect_left(entries, entry)]
+
+
+class BagStore:
+    """ Blood bag records keyed on bag ID, with secondary indexes by blood group and by collection date """
+
+    def __init__(self):
+        # Primary index: bag ID -> Bag. The date is parsed once when the bag is added, so nothing else has to parse it
+        # again
+        self.records = {}
+        self.by_group = {group: {} for group in BLOOD_GROUPS}  # Insertion-ordered sets of bag IDs per group
+        # Sorted list of (collection date ordinal, bag ID) pairs. It doubles as the expiry index: bags past their
+        # shelf life always form a prefix of it, and disposing of them cuts that prefix off
+        self.by_date = []
+        # Per-group min-heaps of (collection date ordinal, bag ID), oldest bag on top. Removed bags are left in place
+        # and skipped when they reach the top, except a bag on top which is popped straight away
+        self.queues = {group: [] for group in BLOOD_GROUPS}
+        # Heap entries of expired bags that a query skipped, oldest first, put back if a later query asks for them.
+        # Unlike the heaps, they are dropped as soon as their bag leaves the store
+        self.set_aside = {group: [] for group in BLOOD_GROUPS}
+        self.journal = None  # Journal that every change is appended to, once attached
+        self.sequence = None  # IdSequence that new bag IDs are drawn from, once attached
+
+    @classmethod
+    def from_columns(cls, columns):
+        """ Build a store in bulk from the columns returned by columnar.read_bags, sorting each index once """
+        store = cls()
+        keep = last_occurrences(columns['id'])
+        ids, codes, days = columns['id'][keep], columns['group'][keep], columns['date'][keep]
+        with _gc_paused():
+            groups = [BLOOD_GROUPS[code] for code in codes.tolist()]  # Shares the eight group strings
+            id_objects, day_objects = ids.tolist(), _shared_days(days)
+            store.records = dict(zip(id_objects, map(partial(tuple.__new__, Bag), zip(groups, day_objects))))
+            order = np.lexsort((ids, days))
+            store.by_date = [(day_objects[i], id_objects[i]) for i in order.tolist()]
+            ordered_codes = codes[order]
+            for code, group in enumerate(BLOOD_GROUPS):
+                store.by_group[group] = dict.fromkeys([id_objects[i] for i in np.flatnonzero(codes == code).tolist()])
+                # The heap shares the date index's entries; a sorted list is already a valid heap
+                store.queues[group] = [store.by_date[i] for i in np.flatnonzero(ordered_codes == code).tolist()]
+        return store
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, bag_id):
+        return bag_id in self.records
+
+    def get(self, bag_id):
+        """ Return the details of a bag, or None if the ID is not in the inventory """
+        return self.records.get(bag_id)
+
+    def items(self):
+        """ Return (bag ID, details) pairs in insertion order """
+        return self.records.items()
+
+    def add(self, bag_id, blood_group, date_collected):
+        """ Add a bag, replacing any existing record with the same ID. Raises ValueError for an unknown blood group or a
+        malformed date """
+        day = parse_day(date_collected)
+        blood_group = check_group(blood_group)  # Before any change, so an unknown group leaves the store as it was
+        if self.records.get(bag_id) != (blood_group, day):  # Re-adding an identical bag leaves the indexes as they are
+            if bag_id in self.records:
+                self._unindex(bag_id)
+            self.records[bag_id] = Bag(blood_group, day)
+            self.by_group.setdefault(blood_group, {})[bag_id] = None
+            entry = (day, bag_id)
+            bisect.insort(self.by_date, entry)
+            heapq.heappush(self.queues.setdefault(blood_group, []), entry)
+        if self.journal is not None:
+            self.journal.append(['bag', bag_id, blood_group, date_collected])
+
+    def remove(self, bag_id):
+        """ Remove a bag (dispatched or disposed of) and drop it from every index """
+        details = self._unindex(bag_id)
+        if self.journal is not None:
+            self.journal.append(['bag-', bag_id])
+        return details
+
+    def _unindex(self, bag_id):
+        """ Drop a bag from the primary and secondary indexes and return its details """
+        details = self.records.pop(bag_id)
+        del self.by_group[details.blood_group][bag_id]
+        entry = (details.collected, bag_id)
+        del self.by_date[bisect.bisect_left(self.by_date, entry)]
+        queue = self.queues[details.blood_group]
+        if queue and queue[0] == entry:  # The usual case when dispatching oldest-first
+            heapq.heappop(queue)
+        set_aside = self.set_aside.get(details.blood_group)
+        if set_aside and entry <= set_aside[-1]:
+            position = bisect.bisect_left(set_aside, entry)
+            if position < len(set_aside) and set_aside[position] == entry:
+                del set_aside[position]
+        return details
+
+    def count(self, blood_group, expired_before=None):
+        """ Return the number of bags in stock for a blood group, leaving out bags collected before expired_before
+        (a date) if it is given. Expired bags are a prefix of the date index, so only they are visited """
+        count = len(self.by_group.get(blood_group, ()))
+        if expired_before is not None:
+            end = bisect.bisect_left(self.by_date, (expired_before.toordinal(),))
+            count -= sum(1 for day, bag_id in self.by_date[:end] if self.records[bag_id].blood_group == blood_group)
+        return count
+
+    def group_counts(self):
+        """ Return the number of bags in stock for each of the eight blood groups, in BLOOD_GROUPS order
+
+        The group index is updated by every add, dispatch and disposal, so this costs the same whatever the size of
+        the stock """
+        return [len(self.by_group.get(group, ())) for group in BLOOD_GROUPS]
+
+    def oldest(self, blood_group, expired_before=None):
+        """ Return (collection date ordinal, bag ID) for the oldest bag of a blood group, or None if there is none.
+        With expired_before (a date), bags collected before it are past their shelf life and are skipped """
+        queue = self.queues.get(blood_group)
+        first_day = expired_before.toordinal() if expired_before is not None else None
+        set_aside = self.set_aside.setdefault(blood_group, [])
+        if set_aside and (first_day is None or set_aside[-1][0] >= first_day):  # An earlier cutoff than before
+            for entry in set_aside:
+                heapq.heappush(queue, entry)
+            set_aside.clear()
+        while queue:
+            day, bag_id = queue[0]
+            details = self.records.get(bag_id)
+            # Skip entries for bags that were removed, or re-added under a different group or date
+            if details is not None and details.blood_group == blood_group and details.collected == day:
+                if first_day is None or day >= first_day:
+                    return queue[0]
+                # The cutoff only moves forward from day to day, so expired bags are set aside instead of being
+                # looked at again by every dispatch
+                set_aside.append(heapq.heappop(queue))
+            else:
+                heapq.heappop(queue)
+        return None
+
+    def oldest_bags(self, blood_group, count, expired_before=None):
+        """ Return the IDs of up to count bags of a blood group, oldest first, leaving them in stock. With
+        expired_before (a date), bags collected before it are skipped """
+        queue = self.queues.get(blood_group, [])
+        # A bag removed and added back can have two live entries in the heap; only one of them is put back
+        taken = {}
+        while len(taken) < count and self.oldest(blood_group, expired_before) is not None:
+            taken[heapq.heappop(queue)] = None
+        for entry in taken:
+            heapq.heappush(queue, entry)
+        return [bag_id for day, bag_id in taken]
+
+    def oldest_in_groups(self, blood_groups, expired_before=None):
+        """ Return the ID of the bag to dispatch from blood_groups (see choose_bag), skipping bags collected before
+        expired_before (a date) if it is given. Returns None if there is none """
+        return choose_bag(partial(self.oldest, expired_before=expired_before), blood_groups)
+
+    def collected_before(self, day):
+        """ Return the IDs of bags collected strictly before the given date, oldest first
+
+        Expired bags are disposed of as a batch, so on each sweep this only visits the bags that have crossed the
+        cutoff since the previous one """
+        end = bisect.bisect_left(self.by_date, (day.toordinal(),))
+        return [bag_id for collected, bag_id in self.by_date[:end]]
+
+    def dispose(self, bag_ids):
+        """ Remove a batch of bags, such as the result of collected_before, in one pass over the date index. Returns the
+        IDs that were no longer in stock """
+        bag_ids = list(dict.fromkeys(bag_ids))  # A repeated ID is removed once
+        missing = [bag_id for bag_id in bag_ids if bag_id not in self.records]
+        bag_ids = [bag_id for bag_id in bag_ids if bag_id in self.records]
+        if not bag_ids:
+            return missing
+        leaving = set(bag_ids)
+        if all(bag_id in leaving for day, bag_id in self.by_date[:len(bag_ids)]):
+            del self.by_date[:len(bag_ids)]  # Expired bags: the batch is the oldest bags in stock
+        elif len(bag_ids) * DISPOSE_REBUILD_RATIO < len(self.by_date):
+            for bag_id in bag_ids:  # A small batch, such as bags dispatched to hospitals
+                entry = (self.records[bag_id].collected, bag_id)
+                del self.by_date[bisect.bisect_left(self.by_date, entry)]
+        else:
+            self.by_date = [entry for entry in self.by_date if entry[1] not in leaving]
+        groups = set()
+        for bag_id in bag_ids:
+            details = self.records.pop(bag_id)
+            del self.by_group[details.blood_group][bag_id]
+            groups.add(details.blood_group)
+            # The heap entries are dropped lazily; expired bags are the oldest, so they are popped on the next look
+            if self.journal is not None:
+                self.journal.append(['bag-', bag_id])
+        for blood_group in groups:  # Set-aside entries are not, so they cannot pile up in a long-running service
+            set_aside = self.set_aside.get(blood_group)
+            if set_aside:
+                set_aside[:] = [entry for entry in set_aside if entry[1] not in leaving]
+        return missing
+
+    def max_id(self):
+        """ Return the highest bag ID in stock, or 0 if there are none """
+        return max(self.records, default=0)
+
+    def commit(self):
+        """ Make every change so far durable by syncing the journal """
+        if self.journal is not None:
+            self.journal.sync()
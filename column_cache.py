@@ -0,0 +1,120 @@
+""" On-disk cache of the parsed columns of the LifeServe Blood Institute (LBI) donor and bag text databases
+
+Parsing a text database is most of the time it takes to load it, so after a file has been parsed its columns (see
+columnar.py) and the list of its bad rows are saved next to it, as donors.txt.cols for donors.txt. The cache is one
+JSON header line followed by the raw bytes of each column: the NumPy arrays as they are in memory, and each text column
+as its values joined by newlines (a field can never hold a newline). Loading the cache maps the file into memory and
+views the arrays in place, so the ID, group and date columns of a million rows cost no parsing and no copying.
+
+The header records the size and modification time of the text file the cache was built from; if either has changed,
+the cache is ignored and rebuilt on the next load. The cache is written to a temporary file and renamed into place,
+and a cache that cannot be written (say, in a read-only directory) is simply not used. Caches can be built ahead of
+time, for example after copying in a new database:
+python column_cache.py donors.txt bags.txt
+"""
+
+import json
+import mmap
+import os
+import sys
+import numpy as np
+from columnar import read_bags, read_donors
+
+CACHE_SUFFIX = '.cols'
+CACHE_VERSION = 2  # Changed whenever the layout of the cache or of the columns changes
+ALIGNMENT = 8  # Each column starts on a multiple of this many bytes, so the arrays are aligned
+
+
+def cache_path(path):
+    return path + CACHE_SUFFIX
+
+
+def read_cached(path, reader):
+    """ Return reader(path), which returns (columns, errors), from the cache of path when it is up to date; otherwise
+    parse path with reader and save the result to the cache. Raises OSError if path cannot be read """
+    cached = load_cache(path)
+    if cached is not None:
+        return cached
+    source = os.stat(path)  # Taken before reading, so a file changed while it is parsed fails the next check
+    columns, errors = reader(path)
+    try:
+        save_cache(path, source, columns, errors)
+    except OSError:
+        pass  # Loading still works, it just parses the file again next time
+    return columns, errors
+
+
+def save_cache(path, source, columns, errors):
+    """ Write the cache of the text file path, whose os.stat() before it was parsed is source """
+    layout = []
+    chunks = []
+    offset = 0
+    for name, values in columns.items():
+        if isinstance(values, np.ndarray):
+            data = values.tobytes()
+            layout.append({'name': name, 'dtype': values.dtype.str, 'offset': offset, 'count': len(values)})
+        else:
+            data = '\n'.join(values).encode()
+            layout.append({'name': name, 'offset': offset, 'length': len(data), 'count': len(values)})
+        padding = -len(data) % ALIGNMENT
+        chunks.append(data + bytes(padding))
+        offset += len(data) + padding
+    header = {'version': CACHE_VERSION, 'size': source.st_size, 'mtime_ns': source.st_mtime_ns, 'length': offset,
+              'columns': layout, 'errors': errors}
+    header_line = json.dumps(header).encode() + b'\n'
+    # Pad the header too, so the columns start aligned
+    header_line = header_line[:-1] + b' ' * (-len(header_line) % ALIGNMENT) + b'\n'
+    temp_path = cache_path(path) + '.tmp'
+    with open(temp_path, 'wb') as cache_file:
+        cache_file.write(header_line)
+        cache_file.writelines(chunks)
+    os.replace(temp_path, cache_path(path))
+
+
+def load_cache(path):
+    """ Return the (columns, errors) cached for the text file path, or None if there is no cache or it is out of date
+    or damaged. The arrays are read-only views of the mapped cache file """
+    try:
+        source = os.stat(path)
+        with open(cache_path(path), 'rb') as cache_file:
+            header_line = cache_file.readline()
+            header = json.loads(header_line)
+            if (header['version'] != CACHE_VERSION or header['size'] != source.st_size or
+                    header['mtime_ns'] != source.st_mtime_ns):
+                return None
+            start = len(header_line)
+            if os.fstat(cache_file.fileno()).st_size != start + header['length']:
+                return None  # Cut short, for instance by a crash before the file reached the disk
+            data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) if header['length'] else b''
+        columns = {}
+        for column in header['columns']:
+            offset, count = start + column['offset'], column['count']
+            if 'dtype' not in column:
+                text = data[offset:offset + column['length']].decode()
+                columns[column['name']] = text.split('\n') if count else []
+            elif count:
+                columns[column['name']] = np.frombuffer(data, column['dtype'], count, offset)
+            else:
+                columns[column['name']] = np.empty(0, column['dtype'])
+        errors = [tuple(error) for error in header['errors']]
+        return columns, errors
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def main(arguments):
+    if len(arguments) not in (1, 2):
+        sys.exit('Usage: python column_cache.py donors.txt [bags.txt]')
+    for path, reader in zip(arguments, (read_donors, read_bags)):
+        try:
+            columns, errors = read_cached(path, reader)
+        except OSError as error:
+            sys.exit(str(error))
+        if not os.path.exists(cache_path(path)):
+            sys.exit('Could not write ' + cache_path(path))
+        print('{}: {:,} rows, {:,} bad rows cached in {}'.format(path, len(columns['id']), len(errors),
+                                                                 cache_path(path)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,226 @@
+""" Streaming, columnar reader for the LifeServe Blood Institute (LBI) donor and bag text databases
+
+Files are read in large chunks and each chunk is split into fields with NumPy array operations over its bytes (the
+positions of every newline and comma), so ids, blood groups and dates go straight into compact columns without
+creating a Python object per row: int64 ids, uint8 blood group codes (see compatibility.py) and int32 day ordinals
+(date.toordinal()). A chunk with a malformed row is re-parsed one line at a time so that every bad row is reported with
+its line number and skipped instead of aborting the load.
+"""
+
+import re
+import numpy as np
+import metrics
+from compatibility import GROUP_CODES, NO_GROUP
+
+CHUNK_SIZE = 4 * 1024 * 1024  # Bytes read and parsed at a time
+EPOCH_ORDINAL = 719163  # date(1970, 1, 1).toordinal(), to convert NumPy dates to day ordinals
+
+BAG_COLUMNS = ('id', 'group', 'date')
+DONOR_COLUMNS = ('id', 'name', 'phone', 'email', 'group', 'date')
+
+# Byte values the fast path looks for
+NEWLINE, COMMA, DASH, ZERO, NINE = b'\n,-09'
+# _WHITESPACE[byte] is True for the bytes bytes.strip() removes, so rows are trimmed the same way on both paths
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[list(b' \t\n\r\x0b\x0c')] = True
+MAX_ID_DIGITS = 18  # Longest ID that always fits in an int64
+
+# The eight group names packed into one integer each (up to three bytes), sorted for searchsorted lookups
+_GROUP_KEYS = np.array(sorted(int.from_bytes(group.encode().ljust(3, b'\0'), 'big') for group in GROUP_CODES))
+_GROUP_KEY_CODES = np.array([GROUP_CODES[key.to_bytes(3, 'big').rstrip(b'\0').decode()] for key in _GROUP_KEYS.tolist()],
+                            dtype=np.uint8)
+
+# Row patterns for the line-by-line path, matched against lines stripped of surrounding whitespace (including the \r of
+# \r\n line ends); the date must at least look like YYYY-MM-DD, its range is checked by NumPy
+BAG_ROW = re.compile(rb'^(\d+),([^,\r\n]*),(\d{4}-\d\d-\d\d)$', re.MULTILINE)
+DONOR_ROW = re.compile(rb'^(\d+),([^,\r\n]*),([^,\r\n]*),([^,\r\n]*),([^,\r\n]*),(\d{4}-\d\d-\d\d)$',
+                       re.MULTILINE)
+_GROUP_BYTES = {group.encode(): code for group, code in GROUP_CODES.items()}
+
+# Field positions in a matched row
+_FIELDS = {'bags': {'id': 0, 'group': 1, 'date': 2},
+           'donors': {'id': 0, 'name': 1, 'phone': 2, 'email': 3, 'group': 4, 'date': 5}}
+_PATTERNS = {'bags': BAG_ROW, 'donors': DONOR_ROW}
+
+
+def read_bags(path, columns=BAG_COLUMNS, chunk_size=CHUNK_SIZE):
+    """ Read a bags file (id,group,date) into columns; see read_columns """
+    return read_columns(path, 'bags', columns, chunk_size)
+
+
+def read_donors(path, columns=DONOR_COLUMNS, chunk_size=CHUNK_SIZE):
+    """ Read a donors file (id,name,phone,email,group,date) into columns; see read_columns """
+    return read_columns(path, 'donors', columns, chunk_size)
+
+
+def read_columns(path, kind, columns, chunk_size=CHUNK_SIZE):
+    """ Stream a 'bags' or 'donors' file into a dictionary of columns holding only the requested fields
+
+    Returns (columns, errors), where errors is a list of (line number, line text, reason) for every row that was
+    skipped. 'id' is an int64 array, 'group' a uint8 array of group codes, 'date' an int32 array of day ordinals and
+    the text fields are lists of str. Raises OSError if the file cannot be read """
+    fields = _FIELDS[kind]
+    for column in columns:
+        if column not in fields:
+            raise ValueError('Unknown ' + kind + ' column: ' + column)
+    parts = {column: [] for column in columns}
+    errors = []
+    line_number = 1  # Number of the first line in the current chunk
+    with open(path, 'rb') as data_file:
+        remainder = b''
+        while True:
+            block = data_file.read(chunk_size)
+            metrics.count('bytes_read', len(block))
+            chunk = remainder + block
+            if not block:
+                if not chunk:
+                    break
+                if not chunk.endswith(b'\n'):
+                    chunk += b'\n'
+                remainder = b''
+            else:
+                cut = chunk.rfind(b'\n') + 1  # Only parse whole lines; the tail waits for the next block
+                chunk, remainder = chunk[:cut], chunk[cut:]
+                if not chunk:
+                    continue
+            lines = chunk.count(b'\n')
+            metrics.count('rows_scanned', lines)
+            _parse_chunk(chunk, kind, columns, line_number, parts, errors)
+            line_number += lines
+            if not block:
+                break
+
+    result = {}
+    for column in columns:
+        if column in ('id', 'group', 'date'):
+            dtype = {'id': np.int64, 'group': np.uint8, 'date': np.int32}[column]
+            result[column] = np.concatenate(parts[column]) if parts[column] else np.zeros(0, dtype=dtype)
+        else:
+            result[column] = [value for part in parts[column] for value in part]
+    return result, errors
+
+
+def _parse_chunk(chunk, kind, columns, first_line, parts, errors):
+    """ Parse one chunk of whole lines, appending its columns to parts and its bad rows to errors """
+    converted = _parse_fast(chunk, kind, columns)
+    if converted is not None:
+        for column in columns:
+            parts[column].append(converted[column])
+        return
+
+    # Slow path: at least one line is malformed, so check the lines one by one
+    good_rows = []
+    for offset, line in enumerate(chunk.split(b'\n')[:-1]):
+        row = line.strip()
+        if not row:
+            continue  # Blank lines are ignored
+        match = _PATTERNS[kind].match(row)
+        if match is None:
+            errors.append((first_line + offset, line.decode(errors='replace'), 'wrong number or format of fields'))
+            continue
+        try:
+            _convert([match.groups()], kind, columns)
+        except ValueError as error:
+            errors.append((first_line + offset, line.decode(errors='replace'), str(error)))
+            continue
+        good_rows.append(match.groups())
+    if good_rows:
+        converted = _convert(good_rows, kind, columns)
+        for column in columns:
+            parts[column].append(converted[column])
+
+
+def _parse_fast(chunk, kind, columns):
+    """ Parse a chunk of whole lines with array operations and return its columns, or None if any line is malformed
+    and the chunk has to be checked line by line """
+    fields = _FIELDS[kind]
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == NEWLINE)
+    line_count = len(newlines)
+    starts = np.concatenate(([0], newlines[:-1] + 1))
+    ends = newlines
+    # Every line needs exactly one comma between each pair of fields
+    commas = np.flatnonzero(buf == COMMA)
+    per_line = np.diff(np.concatenate(([0], np.searchsorted(commas, newlines))))
+    if (per_line != len(fields) - 1).any():
+        return None
+    # Trim surrounding whitespace, as the line-by-line path does; every line has a comma, so none is left empty
+    if _WHITESPACE[buf[starts]].any() or _WHITESPACE[buf[ends - 1]].any():
+        solid = np.flatnonzero(~_WHITESPACE[buf])
+        starts = solid[np.searchsorted(solid, starts)]
+        ends = solid[np.searchsorted(solid, ends) - 1] + 1
+    commas = commas.reshape(line_count, len(fields) - 1)
+    field_starts = np.column_stack([starts, commas + 1])
+    field_ends = np.column_stack([commas, ends])
+
+    # ID: 1 to MAX_ID_DIGITS digits, read right-aligned into a digit matrix and weighted by powers of ten
+    id_start, id_end = field_starts[:, fields['id']], field_ends[:, fields['id']]
+    id_length = id_end - id_start
+    if id_length.min() < 1 or id_length.max() > MAX_ID_DIGITS:
+        return None
+    width = int(id_length.max())
+    positions = id_end[:, None] - width + np.arange(width)
+    in_field = positions >= id_start[:, None]
+    digits = buf[np.maximum(positions, 0)].astype(np.int64)
+    if ((digits < ZERO) | (digits > NINE))[in_field].any():
+        return None
+    digits = np.where(in_field, digits - ZERO, 0)
+    ids = digits @ (10 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+
+    # Blood group: two or three bytes packed into an integer and looked up among the eight known groups
+    group_start, group_end = field_starts[:, fields['group']], field_ends[:, fields['group']]
+    group_length = group_end - group_start
+    if group_length.min() < 2 or group_length.max() > 3:
+        return None
+    keys = (buf[group_start].astype(np.int64) << 16) | (buf[group_start + 1].astype(np.int64) << 8) | \
+        np.where(group_length == 3, buf[np.minimum(group_start + 2, len(buf) - 1)], 0)
+    found = np.minimum(np.searchsorted(_GROUP_KEYS, keys), len(_GROUP_KEYS) - 1)
+    if (_GROUP_KEYS[found] != keys).any():
+        return None
+    codes = _GROUP_KEY_CODES[found]
+
+    # Date: exactly YYYY-MM-DD, parsed by NumPy straight from the bytes
+    date_start, date_end = field_starts[:, fields['date']], field_ends[:, fields['date']]
+    if ((date_end - date_start) != 10).any():
+        return None
+    date_bytes = buf[date_start[:, None] + np.arange(10)]
+    is_digit = (date_bytes >= ZERO) & (date_bytes <= NINE)
+    if not (is_digit[:, [0, 1, 2, 3, 5, 6, 8, 9]].all() and (date_bytes[:, [4, 7]] == DASH).all()):
+        return None
+    try:
+        days = np.ascontiguousarray(date_bytes).view('S10').ravel().astype('datetime64[D]')
+    except ValueError:  # An impossible month or day
+        return None
+
+    converted = {'id': ids, 'group': codes, 'date': (days.astype(np.int64) + EPOCH_ORDINAL).astype(np.int32)}
+    for column in columns:
+        if column not in converted:
+            column_start = field_starts[:, fields[column]].tolist()
+            column_end = field_ends[:, fields[column]].tolist()
+            try:
+                converted[column] = [chunk[start:end].decode() for start, end in zip(column_start, column_end)]
+            except UnicodeDecodeError:
+                return None
+    return converted
+
+
+def _convert(rows, kind, columns):
+    """ Convert a non-empty list of matched rows (tuples of bytes) into columns, raising ValueError if any value is
+    invalid. The blood group and date are always checked, so the same rows are kept whichever columns are loaded """
+    fields = _FIELDS[kind]
+    values = list(zip(*rows))
+    groups = values[fields['group']]
+    codes = np.fromiter(map(_GROUP_BYTES.get, groups, [NO_GROUP] * len(groups)), dtype=np.uint8, count=len(groups))
+    if (codes == NO_GROUP).any():
+        raise ValueError('unknown blood group')
+    days = np.array(values[fields['date']]).astype('datetime64[D]')  # Raises ValueError for impossible dates
+    converted = {'group': codes, 'date': (days.astype(np.int64) + EPOCH_ORDINAL).astype(np.int32)}
+    for column in columns:
+        if column == 'id':
+            try:
+                converted['id'] = np.array(values[fields['id']]).astype(np.int64)
+            except OverflowError:
+                raise ValueError('ID out of range')
+        elif column not in converted:
+            converted[column] = [value.decode() for value in values[fields[column]]]
+    return converted
@@ -0,0 +1,102 @@
+""" Blood-group transfusion compatibility engine shared by the LifeServe Blood Institute (LBI) programs
+
+Each of the eight ABO/Rh groups is encoded as a 3-bit antigen mask: A = 4, B = 2 and Rh(D) = 1. A donor can give to a
+recipient when the donor carries no antigen the recipient lacks, i.e. (donor & ~recipient) == 0. That makes every
+compatibility question a bitwise test which NumPy can run over whole columns of bags and recipients at once: the
+array functions at the end answer N bags x M recipients in one operation by indexing the 8 x 8 COMPATIBLE table.
+"""
+
+import numpy as np
+
+# Antigen bits
+ANTIGEN_A = 4
+ANTIGEN_B = 2
+ANTIGEN_RH = 1
+
+# ABO and Rh types as they are keyed in by staff
+ABO_TYPES = {'O': 0, 'B': ANTIGEN_B, 'A': ANTIGEN_A, 'AB': ANTIGEN_A | ANTIGEN_B}
+RH_TYPES = {'-': 0, '+': ANTIGEN_RH}
+
+# The eight blood groups listed by code, so BLOOD_GROUPS[code] is the group name
+BLOOD_GROUPS = ['O-', 'O+', 'B-', 'B+', 'A-', 'A+', 'AB-', 'AB+']
+GROUP_CODES = {group: code for code, group in enumerate(BLOOD_GROUPS)}
+NO_GROUP = 255  # Code used for a blood group that could not be recognised
+
+# COMPATIBLE[donor code, recipient code] is True when the donor can give to the recipient
+_codes = np.arange(len(BLOOD_GROUPS), dtype=np.uint8)
+COMPATIBLE = (_codes[:, None] & ~_codes[None, :] & 7) == 0
+
+# DONOR_MASKS[recipient code] has bit d set when donor code d is compatible
+DONOR_MASKS = [sum(1 << donor for donor in range(8) if COMPATIBLE[donor, recipient]) for recipient in range(8)]
+
+
+def group_code(abo, rh):
+    """ Return the code for an ABO type and Rh type pair, or NO_GROUP if either is not recognised """
+    if abo not in ABO_TYPES or rh not in RH_TYPES:
+        return NO_GROUP
+    return ABO_TYPES[abo] | RH_TYPES[rh]
+
+
+def is_compatible(donor_group, recipient_group):
+    """ Return True if a donor of donor_group can give blood to a recipient of recipient_group """
+    return bool(DONOR_MASKS[GROUP_CODES[recipient_group]] >> GROUP_CODES[donor_group] & 1)
+
+
+def donor_groups(recipient_group):
+    """ Return the list of blood groups a recipient can receive from, universal O- first """
+    mask = DONOR_MASKS[GROUP_CODES[recipient_group]]
+    return [group for code, group in enumerate(BLOOD_GROUPS) if mask >> code & 1]
+
+
+def dispatch_groups(recipient_group):
+    """ Return the groups a recipient can receive from in the order stock should be used: the recipient's own group
+    first and universal O- last. Ordering by descending code does this, since every compatible code is a subset of
+    the recipient's antigens """
+    return donor_groups(recipient_group)[::-1]
+
+
+def compatibility_table():
+    """ Return the compatibility table as a dictionary of recipient group -> list of compatible donor groups """
+    return {group: donor_groups(group) for group in BLOOD_GROUPS}
+
+
+def encode(groups):
+    """ Encode a sequence of blood group names as a uint8 array of codes (NO_GROUP for anything unrecognised) """
+    return np.fromiter((GROUP_CODES.get(group, NO_GROUP) for group in groups), dtype=np.uint8, count=len(groups))
+
+
+def compatibility_matrix(donor_codes, recipient_codes):
+    """ Return an N x M boolean array, True where bag/donor n can serve recipient m (never for NO_GROUP) """
+    donor_codes = np.asarray(donor_codes, dtype=np.uint8)
+    recipient_codes = np.asarray(recipient_codes, dtype=np.uint8)
+    matrix = np.zeros((len(donor_codes), len(recipient_codes)), dtype=bool)
+    donor_ok = donor_codes < len(BLOOD_GROUPS)
+    recipient_ok = recipient_codes < len(BLOOD_GROUPS)
+    # Index the 8 x 8 table with every (donor, recipient) pair at once
+    matrix[np.ix_(donor_ok, recipient_ok)] = COMPATIBLE[np.ix_(donor_codes[donor_ok], recipient_codes[recipient_ok])]
+    return matrix
+
+
+def compatible_with(donor_codes, recipient_code):
+    """ Return a boolean mask over donor_codes, True for every bag/donor that can serve one recipient group """
+    return compatibility_matrix(donor_codes, [recipient_code])[:, 0]
+
+
+def compatible_supply(group_counts, recipient_codes):
+    """ Return, for each recipient code, how many bags could serve it given the number of bags per group (in
+    BLOOD_GROUPS order); 0 for NO_GROUP """
+    per_group = np.asarray(group_counts, dtype=np.int64) @ COMPATIBLE  # Compatible stock for each recipient group
+    recipient_codes = np.asarray(recipient_codes, dtype=np.uint8)
+    counts = np.zeros(len(recipient_codes), dtype=np.int64)
+    valid = recipient_codes < len(BLOOD_GROUPS)
+    counts[valid] = per_group[recipient_codes[valid]]
+    return counts
+
+
+def supply_by_recipient(donor_codes, recipient_codes):
+    """ Return, for each of the M recipients, how many of the N bags/donors could serve them
+
+    Bags are counted per group first, so the cost is O(N + M) rather than the O(N x M) of compatibility_matrix """
+    donor_codes = np.asarray(donor_codes, dtype=np.uint8)
+    return compatible_supply(np.bincount(donor_codes[donor_codes < len(BLOOD_GROUPS)], minlength=len(BLOOD_GROUPS)),
+                             recipient_codes)
@@ -0,0 +1,498 @@
+""" Single-writer database service for the LifeServe Blood Institute (LBI) blood bank
+
+One service process loads the donor and bag stores and owns them; every terminal talks to it over a Unix socket, one
+JSON request and response per line, instead of loading its own copy and overwriting the others' changes. Requests from
+all connections are handled by one event loop, so every change is applied in a single order and a bag can only be
+dispatched once: removing a bag another terminal already removed fails with KeyError.
+
+Reads are answered straight away. A write is applied and appended to the journal at once, but only acknowledged after
+the next commit. Commits are grouped: the committer fsyncs the journal in a worker thread while further writes keep
+arriving, then acknowledges every write the fsync covered, so one fsync serves as many terminals as are writing.
+Once the journal has grown large, the snapshot that replaces it is built in a worker thread too: reads are still
+answered meanwhile, and writes wait until it is done.
+
+Reads see every write applied so far, including writes still waiting for their commit, so a terminal can act on
+another terminal's change before it is durable. If a commit fails, the writes it covered are answered with the error
+and the service stops rather than carry on from a state the journal may not hold.
+
+RemoteDonorStore and RemoteBagStore offer the methods of the in-memory stores, so Assignment_3 can run against the
+service (set LBI_SERVICE to the socket path).
+
+python db_service.py [socket] [donors file] [bags file]   run the service
+python db_service.py measure [terminals] [operations]      measure throughput against a scratch service
+"""
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from datetime import date
+import metrics
+from blood_store import Donor, Bag
+
+SOCKET_PATH = 'lbi.sock'
+
+
+class ServiceError(Exception):
+    """ Raised by a client when the service reports an error other than a missing record or a bad value """
+
+
+def _record(record):
+    return list(record) if record is not None else None
+
+
+def _day(date_string):
+    return date.fromisoformat(date_string)
+
+
+def _optional_day(date_string):
+    return date.fromisoformat(date_string) if date_string is not None else None
+
+
+def _optional_iso(day):
+    return day.isoformat() if day is not None else None
+
+
+# Requests that only read, answered as soon as they arrive: name -> function(donors, stock, *arguments)
+READS = {
+    'donor': lambda donors, stock, donor_id: _record(donors.get(donor_id)),
+    'donor_count': lambda donors, stock: len(donors),
+    'donor_items': lambda donors, stock: [[donor_id, list(donor)] for donor_id, donor in donors.items()],
+    'donors_in_groups': lambda donors, stock, groups, limit: [
+        [donor_id, list(donor)] for donor_id, donor in _first(donors.in_groups(groups), limit)],
+    'eligible': lambda donors, stock, groups, last_day, limit, after: [
+        [donor_id, list(donor)] for donor_id, donor in
+        donors.eligible(groups, _day(last_day), limit, tuple(after) if after is not None else None)],
+    'donated_between': lambda donors, stock, first, last: donors.donated_between(_day(first), _day(last)),
+    'bag': lambda donors, stock, bag_id: _record(stock.get(bag_id)),
+    'bag_count': lambda donors, stock: len(stock),
+    'bag_items': lambda donors, stock: [[bag_id, list(bag)] for bag_id, bag in stock.items()],
+    'count': lambda donors, stock, group, expired_before=None: stock.count(group, _optional_day(expired_before)),
+    'group_counts': lambda donors, stock: stock.group_counts(),
+    'oldest': lambda donors, stock, group, expired_before=None: stock.oldest(group, _optional_day(expired_before)),
+    'oldest_bags': lambda donors, stock, group, count, expired_before=None: stock.oldest_bags(
+        group, count, _optional_day(expired_before)),
+    'oldest_in_groups': lambda donors, stock, groups, expired_before=None: stock.oldest_in_groups(
+        groups, _optional_day(expired_before)),
+    'collected_before': lambda donors, stock, day: stock.collected_before(_day(day)),
+    'max_id': lambda donors, stock: stock.max_id(),
+}
+
+def _add_bag(stock, bag_id, blood_group, date_collected):
+    """ Add a new bag. Unlike stock.add, an ID already in stock is refused rather than replaced, so terminals that
+    picked the same ID cannot overwrite each other's bags """
+    if not isinstance(bag_id, int):
+        raise TypeError('bag ID must be an integer')
+    if bag_id in stock:
+        raise ValueError('bag {} is already in stock'.format(bag_id))
+    stock.add(bag_id, blood_group, date_collected)
+
+
+def _dispose(stock, bag_ids):
+    """ Remove a batch of bags and return the IDs that were no longer in stock, as stock.dispose does. The whole
+    batch is checked first, so a bad ID fails the request before any bag is removed """
+    if not isinstance(bag_ids, list) or not all(isinstance(bag_id, int) for bag_id in bag_ids):
+        raise TypeError('bag IDs must be a list of integers')
+    bag_ids = list(dict.fromkeys(bag_ids))  # A repeated ID is removed once
+    missing = [bag_id for bag_id in bag_ids if bag_id not in stock]
+    if len(missing) < len(bag_ids):
+        stock.dispose([bag_id for bag_id in bag_ids if bag_id in stock])
+    return missing
+
+
+# Requests that change the stores, acknowledged once committed
+WRITES = {
+    'add_donor': lambda donors, stock, *fields: donors.add(*fields),
+    'remove_donor': lambda donors, stock, donor_id: _record(donors.remove(donor_id)),
+    'update_last_donation': lambda donors, stock, donor_id, new_date: donors.update_last_donation(donor_id, new_date),
+    'add_bag': lambda donors, stock, bag_id, group, collected: _add_bag(stock, bag_id, group, collected),
+    'remove_bag': lambda donors, stock, bag_id: _record(stock.remove(bag_id)),
+    'dispose': lambda donors, stock, bag_ids: _dispose(stock, bag_ids),
+    'next_bag_id': lambda donors, stock: stock.sequence.next_id(),
+}
+
+_ERRORS = {'KeyError': KeyError, 'ValueError': ValueError, 'IndexError': IndexError, 'TypeError': TypeError,
+           'OSError': OSError}
+
+
+def _commit_failed(error):
+    """ Response to a write that was not, and will not be, committed """
+    return {'ok': False, 'error': 'OSError', 'message': 'could not commit: ' + str(error)}
+
+
+def _first(iterable, limit):
+    for position, item in enumerate(iterable):
+        if limit is not None and position >= limit:
+            break
+        yield item
+
+
+class DatabaseService:
+    """ Owns the donor and bag stores and serves them to any number of connections """
+
+    def __init__(self, donors, stock, compact=None):
+        self.donors = donors
+        self.stock = stock
+        self.journal = stock.journal
+        self.compact = compact  # compact(donors, stock), called when the journal has grown large
+        # Only the committer syncs, so appending a write never blocks the event loop on an fsync
+        self.journal.sync_every = float('inf')
+        self.journal.sync_interval = float('inf')
+        self.waiting = []  # Futures of writes applied but not yet committed
+        self.failure = None  # Error of the commit that failed, after which no write is taken
+        self.wake = None  # Set when writes are waiting
+        self.writable = None  # Cleared while a compaction snapshot is being built, holding back new writes
+        self.connections = set()  # Stream writers of the connected terminals
+        self.commits = 0
+        self.writes = 0
+
+    async def serve(self, path=SOCKET_PATH):
+        """ Serve connections on a Unix socket at path until cancelled. Raises the error of a failed commit, after
+        failing the writes it covered and disconnecting every terminal """
+        self.wake = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        if os.path.exists(path):
+            os.remove(path)  # Left behind by a service that stopped without cleaning up
+        server = await asyncio.start_unix_server(self.handle_connection, path)
+        committer = asyncio.ensure_future(self.commit_loop())
+        try:
+            async with server:
+                await committer  # Runs until cancelled, or until a commit fails
+        finally:
+            committer.cancel()
+            for writer in list(self.connections):
+                writer.close()  # Sends what was already written, such as the errors of failed writes
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def handle_connection(self, reader, writer):
+        """ Answer one terminal's requests, in order, until it disconnects """
+        self.connections.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write((json.dumps(await self.answer(line)) + '\n').encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def answer(self, line):
+        """ Run one request line and return the response """
+        try:
+            request = json.loads(line)
+            name, arguments = request['op'], request.get('args', [])
+            if name in READS:
+                return {'ok': True, 'result': READS[name](self.donors, self.stock, *arguments)}
+            if name not in WRITES:
+                raise ValueError('unknown request ' + str(name))
+            if not self.writable.is_set():
+                await self.writable.wait()
+            if self.failure is not None:
+                return _commit_failed(self.failure)
+            result = WRITES[name](self.donors, self.stock, *arguments)
+        except (KeyError, ValueError, IndexError, TypeError) as error:
+            return {'ok': False, 'error': type(error).__name__, 'message': str(error)}
+        committed = asyncio.get_running_loop().create_future()
+        self.waiting.append(committed)
+        self.wake.set()
+        try:
+            await committed  # Acknowledged only once durable
+        except Exception as error:  # The commit failed, so the write may be lost
+            return _commit_failed(error)
+        return {'ok': True, 'result': result}
+
+    async def commit_loop(self):
+        """ Fsync the journal whenever writes are waiting and acknowledge every write each fsync covered. If a commit
+        or compaction fails, every write not yet acknowledged fails with its error, which is then raised """
+        try:
+            await self._commit_forever()
+        except Exception as error:  # Whatever the failure, no later write could be committed either
+            self.failure = error
+            for committed in self.waiting:
+                if not committed.done():
+                    committed.set_exception(error)
+            self.waiting = []
+            self.writable.set()  # Releases writes held back by a compaction, which then find the service stopping
+            raise
+
+    async def _commit_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            batch = self.waiting[:]  # Stays in self.waiting until committed, so a failure also fails these writes
+            descriptor = self.journal.flush()
+            await loop.run_in_executor(None, os.fsync, descriptor)
+            self.waiting = self.waiting[len(batch):]
+            metrics.count('fsyncs')
+            self.commits += 1
+            self.writes += len(batch)
+            for committed in batch:
+                committed.set_result(None)
+            if self.compact is not None and self.journal.should_compact():
+                # Formatting the snapshot takes a while for a large database, so it runs in a worker thread while
+                # reads are still answered; writes wait, as the snapshot must match the journal segment it replaces
+                self.writable.clear()
+                try:
+                    await loop.run_in_executor(None, self.compact, self.donors, self.stock)
+                finally:
+                    self.writable.set()
+
+
+class ServiceClient:
+    """ A connection to the database service """
+
+    def __init__(self, path=SOCKET_PATH):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+
+    def call(self, name, *arguments):
+        """ Send one request and return its result, raising the error the service reported if it failed """
+        self.file.write((json.dumps({'op': name, 'args': list(arguments)}) + '\n').encode())
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('the database service closed the connection')
+        response = json.loads(line)
+        if not response['ok']:
+            raise _ERRORS.get(response['error'], ServiceError)(response['message'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def _donor(fields):
+    return Donor(*fields) if fields is not None else None
+
+
+def _bag(fields):
+    return Bag(*fields) if fields is not None else None
+
+
+class RemoteDonorStore:
+    """ The service's donor store, with the methods of blood_store.DonorStore """
+
+    def __init__(self, client):
+        self.client = client
+        self.journal = None  # The service keeps the journal
+
+    def __len__(self):
+        return self.client.call('donor_count')
+
+    def __contains__(self, donor_id):
+        return self.get(donor_id) is not None
+
+    def get(self, donor_id):
+        return _donor(self.client.call('donor', donor_id))
+
+    def items(self):
+        return [(donor_id, Donor(*fields)) for donor_id, fields in self.client.call('donor_items')]
+
+    def add(self, donor_id, name, phone, email, blood_group, last_donation_date):
+        self.client.call('add_donor', donor_id, name, phone, email, blood_group, last_donation_date)
+
+    def remove(self, donor_id):
+        return _donor(self.client.call('remove_donor', donor_id))
+
+    def update_last_donation(self, donor_id, new_date):
+        self.client.call('update_last_donation', donor_id, new_date)
+
+    def in_groups(self, blood_groups, limit=None):
+        return [(donor_id, Donor(*fields))
+                for donor_id, fields in self.client.call('donors_in_groups', list(blood_groups), limit)]
+
+    def donated_between(self, first_day, last_day):
+        return self.client.call('donated_between', first_day.isoformat(), last_day.isoformat())
+
+    def eligible(self, blood_groups, last_day, limit, after=None):
+        return [(donor_id, Donor(*fields)) for donor_id, fields in
+                self.client.call('eligible', list(blood_groups), last_day.isoformat(), limit, after)]
+
+
+class RemoteSequence:
+    """ New bag IDs handed out by the service, so every terminal draws from the same sequence wherever it runs """
+
+    def __init__(self, client):
+        self.client = client
+
+    def next_id(self):
+        return self.client.call('next_bag_id')
+
+
+class RemoteBagStore:
+    """ The service's bag store, with the methods of blood_store.BagStore. Every change is committed by the service
+    before the call returns; adding a bag whose ID is already in stock fails with ValueError """
+
+    def __init__(self, client):
+        self.client = client
+        self.journal = None  # The service keeps the journal
+        self.sequence = RemoteSequence(client)  # New bag IDs come from the service's sequence
+
+    def __len__(self):
+        return self.client.call('bag_count')
+
+    def __contains__(self, bag_id):
+        return self.get(bag_id) is not None
+
+    def get(self, bag_id):
+        return _bag(self.client.call('bag', bag_id))
+
+    def items(self):
+        return [(bag_id, Bag(*fields)) for bag_id, fields in self.client.call('bag_items')]
+
+    def add(self, bag_id, blood_group, date_collected):
+        self.client.call('add_bag', bag_id, blood_group, date_collected)
+
+    def remove(self, bag_id):
+        return _bag(self.client.call('remove_bag', bag_id))
+
+    def dispose(self, bag_ids):
+        return self.client.call('dispose', list(bag_ids))
+
+    def count(self, blood_group, expired_before=None):
+        return self.client.call('count', blood_group, _optional_iso(expired_before))
+
+    def group_counts(self):
+        return self.client.call('group_counts')
+
+    def oldest(self, blood_group, expired_before=None):
+        oldest = self.client.call('oldest', blood_group, _optional_iso(expired_before))
+        return tuple(oldest) if oldest is not None else None
+
+    def oldest_bags(self, blood_group, count, expired_before=None):
+        return self.client.call('oldest_bags', blood_group, count, _optional_iso(expired_before))
+
+    def oldest_in_groups(self, blood_groups, expired_before=None):
+        return self.client.call('oldest_in_groups', list(blood_groups), _optional_iso(expired_before))
+
+    def collected_before(self, day):
+        return self.client.call('collected_before', day.isoformat())
+
+    def max_id(self):
+        return self.client.call('max_id')
+
+    def commit(self):
+        """ Nothing to do: the service commits every change before acknowledging it """
+
+    def close(self):
+        self.client.close()
+
+
+def connect(path=SOCKET_PATH):
+    """ Connect to the service and return its (donor store, bag store) """
+    client = ServiceClient(path)
+    return RemoteDonorStore(client), RemoteBagStore(client)
+
+
+def run_service(path, donor_file, bag_file):
+    """ Load the database the way Assignment_3 does and serve it until interrupted """
+    import Assignment_3_11747979 as lbi
+    donors, stock = lbi.load_db(donor_file, bag_file)
+    service = DatabaseService(donors, stock, lbi.compact_db)
+    print('Serving', len(donors), 'donors and', len(stock), 'bags on', path)
+
+    async def serve_until_stopped():
+        # SIGTERM stops the service as cleanly as Ctrl+C does
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            await service.serve(path)
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        asyncio.run(serve_until_stopped())
+    except KeyboardInterrupt:
+        pass
+    except Exception as error:
+        # The stores hold writes that were never acknowledged, so they are not compacted into the database files
+        print('Committed', service.writes, 'writes in', service.commits, 'commits')
+        sys.exit('Stopped: a commit failed: ' + str(error))
+    print('Committed', service.writes, 'writes in', service.commits, 'commits')
+    lbi.close_db(donors, stock)
+
+
+def _terminal(path, first_id, operations, results):
+    """ One simulated terminal: record a donation (new bag) and dispatch the oldest bag of a group, repeatedly """
+    donors, stock = connect(path)
+    today = date.today().isoformat()
+    done = 0
+    for bag_id in range(first_id, first_id + operations // 2):
+        stock.add(bag_id, 'O+', today)
+        oldest = stock.oldest_in_groups(['O+', 'O-'])
+        try:
+            stock.remove(oldest)
+        except KeyError:  # Another terminal dispatched it first
+            pass
+        done += 2
+    stock.close()
+    results.put(done)
+
+
+def measure(terminals, operations):
+    """ Start a scratch service and time terminals processes making operations writes each """
+    import multiprocessing
+    import tempfile
+    import threading
+    from blood_store import DonorStore, BagStore
+    from journal import Journal
+    from sequence import IdSequence
+
+    scratch = tempfile.mkdtemp(prefix='lbi-service-')
+    path = os.path.join(scratch, SOCKET_PATH)
+    journal = Journal(scratch)
+    journal.start('donors.txt', 'bags.txt')
+    donors, stock = DonorStore(), BagStore()
+    donors.journal = stock.journal = journal
+    stock.sequence = IdSequence(os.path.join(scratch, 'bags.seq'))
+    service = DatabaseService(donors, stock)
+    loop = asyncio.new_event_loop()
+    serving = loop.create_task(service.serve(path))
+
+    def run_loop():
+        try:
+            loop.run_until_complete(serving)
+        except asyncio.CancelledError:
+            pass
+        loop.close()
+
+    thread = threading.Thread(target=run_loop)
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_terminal, args=(path, 1 + number * operations, operations, results))
+               for number in range(terminals)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    total = sum(results.get() for worker in workers)
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+    loop.call_soon_threadsafe(serving.cancel)
+    thread.join()
+    journal.close()
+    print(terminals, 'terminal(s):', total, 'writes in', format(elapsed, '.2f'), 'seconds =',
+          format(total / elapsed, ',.0f'), 'writes/second,', format(service.writes / max(service.commits, 1), '.1f'),
+          'writes per commit')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'measure':
+        measure(int(sys.argv[2]) if len(sys.argv) > 2 else 4, int(sys.argv[3]) if len(sys.argv) > 3 else 2000)
+    else:
+        arguments = sys.argv[1:] + [SOCKET_PATH, 'donors.txt', 'bags.txt'][len(sys.argv) - 1:]
+        run_service(*arguments[:3])
@@ -0,0 +1,242 @@
+""" Asynchronous client for polling many hospital demand servers at once
+
+Each hospital gets a small pool of keep-alive connections. Every request has its own timeout and is retried with
+exponential backoff (plus jitter) when the connection fails, times out or the server answers 503, the equivalent of the
+'X' sentinel of hospital.check_demand. Assignment_3 uses the client whenever hospital servers are configured: one
+demand at a time with first_demand, one round of every hospital with collect_demands (through poll_all), or
+continuously with stream_to, where stream_demands puts demands on an asyncio.Queue as they arrive and consume_demands
+hands them in batches to the function that attends to them.
+
+Run it on its own to measure throughput and latency against local stand-in servers (see hospital_server.py):
+python hospital_client.py [hospitals] [rounds]
+"""
+
+import asyncio
+import random
+import sys
+import time
+from compatibility import GROUP_CODES
+
+POOL_SIZE = 4  # Connections kept open per hospital
+REQUEST_TIMEOUT = 2.0  # Seconds allowed for one request
+RETRIES = 3  # Extra attempts after a failed request
+BACKOFF = 0.05  # Seconds before the first retry; doubled for every further retry
+
+
+class HospitalError(Exception):
+    """ Raised when a hospital request fails in a way worth retrying """
+
+
+def parse_address(address):
+    """ Turn 'host:port' into a (host, port) tuple """
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class ConnectionPool:
+    """ Keep-alive connections to one hospital, at most size of them in use at a time """
+
+    def __init__(self, host, port, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.idle = []  # Open (reader, writer) pairs not in use
+        self.slots = asyncio.Semaphore(size)
+
+    async def request(self, path):
+        """ Send a GET request and return (status code, body), reusing an idle connection when there is one """
+        async with self.slots:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                writer.write(('GET ' + path + ' HTTP/1.1\r\nHost: ' + self.host + '\r\n\r\n').encode())
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise HospitalError('connection closed by the hospital server')
+                status = int(status_line.split()[1])
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode().partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                body = (await reader.readexactly(length)).decode() if length else ''
+            except BaseException:
+                writer.close()  # A connection in an unknown state is never reused
+                raise
+            self.idle.append((reader, writer))
+            return status, body
+
+    async def close(self):
+        """ Close every idle connection """
+        for reader, writer in self.idle:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self.idle = []
+
+
+class HospitalClient:
+    """ Polls a list of hospital servers concurrently """
+
+    def __init__(self, hospitals, pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.pools = {hospital: ConnectionPool(*parse_address(hospital), size=pool_size) for hospital in hospitals}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.latencies = []  # Seconds taken by every successful request, for reporting
+        self.failures = 0  # Requests that failed even after retrying
+
+    async def fetch_demand(self, hospital):
+        """ Return the blood group a hospital currently requires, or None if it could not be reached """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                status, body = await asyncio.wait_for(self.pools[hospital].request('/demand'), self.timeout)
+                if status == 200 and body in GROUP_CODES:
+                    self.latencies.append(time.perf_counter() - started)
+                    return body
+                if status != 503:
+                    break  # Not a temporary failure, so retrying will not help
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HospitalError, ValueError,
+                    IndexError):
+                pass
+            if attempt < self.retries:
+                await asyncio.sleep(delay * (1 + random.random()))  # Jitter spreads the retries out
+                delay *= 2
+        self.failures += 1
+        return None
+
+    async def poll_all(self):
+        """ Ask every hospital for its demand at once and return a list of (hospital, blood group or None) """
+        hospitals = list(self.pools)
+        demands = await asyncio.gather(*(self.fetch_demand(hospital) for hospital in hospitals))
+        return list(zip(hospitals, demands))
+
+    async def stream_demands(self, queue, interval=1.0, rounds=None):
+        """ Poll every hospital each interval seconds and put each demand on queue as soon as it arrives; put None on
+        the queue when every hospital has been polled rounds times (never, if rounds is None)
+
+        Each hospital is polled by its own task, so a slow or failing hospital does not hold up the others """
+        async def poll(hospital):
+            count = 0
+            while rounds is None or count < rounds:
+                started = time.monotonic()
+                blood_group = await self.fetch_demand(hospital)
+                if blood_group is not None:
+                    await queue.put(blood_group)
+                count += 1
+                await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+        await asyncio.gather(*(poll(hospital) for hospital in self.pools))
+        await queue.put(None)
+
+    async def close(self):
+        """ Close every pooled connection """
+        for pool in self.pools.values():
+            await pool.close()
+
+
+async def consume_demands(queue, handler, batch_size=100):
+    """ Hand demands from queue to handler(list of blood groups) in batches, until a None arrives
+
+    Whatever is waiting on the queue is taken at once (up to batch_size), so bursts are handled as one batch """
+    finished = False
+    while not finished:
+        batch = []
+        blood_group = await queue.get()
+        while True:
+            if blood_group is None:
+                finished = True
+                break
+            batch.append(blood_group)
+            if len(batch) >= batch_size or queue.empty():
+                break
+            blood_group = queue.get_nowait()
+        if batch:
+            handler(batch)
+
+
+def first_demand(hospitals, **options):
+    """ Ask the hospitals in turn and return the first blood group one of them requires, or None if none of them
+    could be reached """
+    async def ask():
+        client = HospitalClient(hospitals, **options)
+        try:
+            for hospital in hospitals:
+                blood_group = await client.fetch_demand(hospital)
+                if blood_group is not None:
+                    return blood_group
+            return None
+        finally:
+            await client.close()
+
+    return asyncio.run(ask())
+
+
+def stream_to(hospitals, handler, rounds, interval=1.0, **options):
+    """ Poll every hospital rounds times, interval seconds apart, and hand the demands to handler(list of blood
+    groups) in batches as they arrive. Returns the number of polls that got no demand """
+    async def stream():
+        client = HospitalClient(hospitals, **options)
+        queue = asyncio.Queue()
+        try:
+            await asyncio.gather(client.stream_demands(queue, interval, rounds), consume_demands(queue, handler))
+        finally:
+            await client.close()
+        return client.failures
+
+    return asyncio.run(stream())
+
+
+def collect_demands(hospitals, **options):
+    """ Poll every hospital once and return (list of demanded blood groups, number of hospitals not reached) """
+    async def poll():
+        client = HospitalClient(hospitals, **options)
+        try:
+            return await client.poll_all()
+        finally:
+            await client.close()
+
+    results = asyncio.run(poll())
+    demands = [blood_group for hospital, blood_group in results if blood_group is not None]
+    return demands, len(results) - len(demands)
+
+
+async def measure(hospital_count, rounds, delay=0.0):
+    """ Start hospital_count stand-in servers, poll them for a number of rounds and print throughput and latency """
+    from hospital_server import start_server
+    servers = [await start_server(port=0, delay=delay) for hospital in range(hospital_count)]
+    hospitals = ['127.0.0.1:' + str(server.sockets[0].getsockname()[1]) for server in servers]
+    client = HospitalClient(hospitals)
+    queue = asyncio.Queue()
+    received = []
+    started = time.perf_counter()
+    await asyncio.gather(client.stream_demands(queue, interval=0, rounds=rounds),
+                         consume_demands(queue, received.extend))
+    elapsed = time.perf_counter() - started
+    await client.close()
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+    latencies = sorted(client.latencies)
+    print('Demands received:', len(received), 'from', hospital_count * rounds, 'polls in',
+          format(elapsed, '.2f'), 'seconds')
+    print('Throughput:', format(len(latencies) / elapsed, ',.0f'), 'requests/second')
+    if latencies:
+        for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            print('Latency', label + ':', format(latencies[int(fraction * (len(latencies) - 1))] * 1000, '.2f'), 'ms')
+    print('Failed after retries:', client.failures)
+
+
+if __name__ == '__main__':
+    asyncio.run(measure(int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+                        int(sys.argv[2]) if len(sys.argv) > 2 else 20))
@@ -0,0 +1,73 @@
+""" Local stand-in for a hospital demand web server
+
+Serves GET /demand over HTTP/1.1 with keep-alive. Each request is answered the way hospital.check_demand behaves: a
+random blood group as text/plain, or - when check_demand returns its 'X' sentinel - a 503 Service Unavailable, which
+the client treats as a failed connection. An optional delay and failure rate make timeouts and retries easy to test.
+
+Run it with: python hospital_server.py [port] [delay in seconds]
+"""
+
+import asyncio
+import random
+import sys
+from hospital import check_demand
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8750
+
+
+async def handle_connection(reader, writer, delay=0.0, failure_rate=None):
+    """ Answer requests on one connection until the client closes it """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            # Skip the headers; a GET has no body
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if delay > 0:
+                await asyncio.sleep(delay)
+            parts = request_line.split()
+            if len(parts) < 2 or parts[0] != b'GET' or parts[1] != b'/demand':
+                status, body = '404 Not Found', ''
+            else:
+                blood_group = check_demand()
+                if failure_rate is not None:  # Override the 1-in-9 failure rate of check_demand
+                    while blood_group == 'X':
+                        blood_group = check_demand()
+                    if random.random() < failure_rate:
+                        blood_group = 'X'
+                if blood_group == 'X':
+                    status, body = '503 Service Unavailable', ''
+                else:
+                    status, body = '200 OK', blood_group
+            writer.write(('HTTP/1.1 ' + status + '\r\nContent-Type: text/plain\r\nContent-Length: ' +
+                          str(len(body)) + '\r\n\r\n' + body).encode())
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host=DEFAULT_HOST, port=DEFAULT_PORT, delay=0.0, failure_rate=None):
+    """ Start a stand-in hospital server and return the asyncio server object (port 0 picks a free port) """
+    return await asyncio.start_server(lambda reader, writer: handle_connection(reader, writer, delay, failure_rate),
+                                      host, port)
+
+
+async def serve_forever(host=DEFAULT_HOST, port=DEFAULT_PORT, delay=0.0):
+    """ Run a stand-in hospital server until interrupted """
+    server = await start_server(host, port, delay)
+    print('Hospital stand-in serving on', host + ':' + str(port))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve_forever(port=int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT,
+                                  delay=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0))
+    except KeyboardInterrupt:
+        pass
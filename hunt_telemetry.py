@@ -0,0 +1,172 @@
+""" Telemetry and session logs for Square Hunt
+
+Telemetry stamps every click, tick and screen refresh of Assignment_2 with the monotonic clock. It keeps latency
+histograms of the time from a click arriving to its feedback being on screen, of how late each tick fires after its
+deadline, and of how long each refresh takes, and prints them at the end of every game.
+
+With SQUARE_HUNT_LOG set to a file name, the events are also written to that file as a compact binary session log: a
+GAME record with the settings and seed of each game, then TICK, CLICK, FRAME and END records. Since a SquareHunt is
+determined by its seed and its clicks, replay() plays the logged games again headlessly with the same results, which
+reproduces a slow session for profiling:
+python hunt_telemetry.py square-hunt.log
+"""
+
+import os
+import struct
+import sys
+import time
+from metrics import OperationStats
+from square_hunt import SquareHunt
+
+LOG_MAGIC = b'SQHT1\n'
+# Record kinds, each followed by its fields
+GAME, TICK, CLICK, FRAME, END = range(5)
+RECORDS = {
+    GAME: struct.Struct('<HHHdQ'),  # grid_box, targets, squares, interval, seed
+    TICK: struct.Struct('<dd'),  # deadline, fired (seconds since the game started)
+    CLICK: struct.Struct('<ddd'),  # arrived, x, y
+    FRAME: struct.Struct('<dd'),  # started, finished
+    END: struct.Struct('<III'),  # score, hits, misses
+}
+HISTOGRAMS = (('click_feedback', 'click to feedback'), ('tick_lateness', 'tick lateness'), ('frame_time', 'frame time'))
+LOG_FILE = os.environ.get('SQUARE_HUNT_LOG')  # Session log written by Assignment_2, if set
+
+
+class Telemetry:
+    """ Timings of the games played in one session, optionally logged to a binary session log at path. Events are
+    buffered in memory and written at the end of each game, so recording one costs no I/O """
+
+    def __init__(self, path=None):
+        self.stats = {name: OperationStats() for name, title in HISTOGRAMS}
+        self.log = open(path, 'wb') if path else None
+        self.buffer = bytearray(LOG_MAGIC) if self.log else None
+        self.started = time.monotonic()  # Start of the current game
+
+    def _record(self, kind, *fields):
+        if self.buffer is not None:
+            self.buffer.append(kind)
+            self.buffer += RECORDS[kind].pack(*fields)
+
+    def start_game(self, game):
+        """ Start timing a new game, which must be created with a seed for the log to replay it """
+        self.stats = {name: OperationStats() for name, title in HISTOGRAMS}
+        self.started = time.monotonic()
+        self._record(GAME, game.grid_box, game.targets_per_tick, game.squares, game.interval, game.seed)
+
+    def tick(self, deadline, fired):
+        """ Record a tick due at the monotonic time deadline that fired at fired """
+        self.stats['tick_lateness'].record(max(0.0, fired - deadline))
+        self._record(TICK, deadline - self.started, fired - self.started)
+
+    def click(self, arrived, x, y):
+        """ Record a click at (x, y) that arrived at the monotonic time arrived and was scored by the game """
+        self._record(CLICK, arrived - self.started, x, y)
+
+    def click_feedback(self, arrived, shown):
+        """ Record that the feedback for a click that arrived at arrived was on screen at shown """
+        self.stats['click_feedback'].record(shown - arrived)
+
+    def frame(self, started, finished):
+        """ Record a screen refresh """
+        self.stats['frame_time'].record(finished - started)
+        self._record(FRAME, started - self.started, finished - self.started)
+
+    def end_game(self, game, file=sys.stdout):
+        """ Print the game's timings and write its events to the session log """
+        self._record(END, game.score, game.hits, game.misses)
+        print_histograms(self.stats, file)
+        self.flush()
+
+    def flush(self):
+        if self.log is not None and self.buffer:
+            self.log.write(self.buffer)
+            self.log.flush()
+            self.buffer.clear()
+
+    def close(self):
+        if self.log is not None:
+            self.flush()
+            self.log.close()
+            self.log = self.buffer = None
+
+
+def print_histograms(stats, file=sys.stdout):
+    """ Print the percentiles of each timing, in milliseconds, and a bar per latency bucket """
+    for name, title in HISTOGRAMS:
+        timings = stats[name]
+        if timings.calls == 0:
+            continue
+        print('{}: {} events, p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            title, timings.calls, timings.percentile(0.5) * 1000, timings.percentile(0.95) * 1000,
+            timings.percentile(0.99) * 1000, timings.slowest * 1000), file=file)
+        widest = max(timings.histogram)
+        for bucket, count in enumerate(timings.histogram):
+            if count:
+                print('  < {:>10,} us {:>6} {}'.format(2 ** bucket, count, '#' * max(1, 40 * count // widest)),
+                      file=file)
+
+
+def read_session(path):
+    """ Yield the (kind, fields) records of a session log """
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    if not data.startswith(LOG_MAGIC):
+        raise ValueError(path + ' is not a Square Hunt session log')
+    position = len(LOG_MAGIC)
+    while position < len(data):
+        kind = data[position]
+        record = RECORDS.get(kind)
+        if record is None or position + 1 + record.size > len(data):
+            raise ValueError('corrupt record at byte {} of {}'.format(position, path))
+        yield kind, record.unpack_from(data, position + 1)
+        position += 1 + record.size
+
+
+def replay(path):
+    """ Play every game of a session log again without a display. Returns a (game, logged end, timings) list per
+    game: the logged end is (score, hits, misses), or None for a game restarted before it finished, and the timings
+    are the histograms of the logged ticks and frames. Raises ValueError if a replayed game ends differently """
+    games = []
+    game = stats = None
+    for kind, fields in read_session(path):
+        if kind == GAME:
+            grid_box, targets, squares, interval, seed = fields
+            game = SquareHunt(grid_box, interval, seed, squares, targets)
+            stats = {name: OperationStats() for name, title in HISTOGRAMS}
+            games.append([game, None, stats])
+        elif game is None:
+            raise ValueError('{} record before the first game in {}'.format(kind, path))
+        elif kind == TICK:
+            game.tick()
+            stats['tick_lateness'].record(max(0.0, fields[1] - fields[0]))
+        elif kind == CLICK:
+            game.click(fields[1], fields[2])
+        elif kind == FRAME:
+            stats['frame_time'].record(fields[1] - fields[0])
+        else:
+            games[-1][1] = fields
+            if fields != (game.score, game.hits, game.misses):
+                raise ValueError('game {} replayed to {} instead of the logged {}'.format(
+                    len(games), (game.score, game.hits, game.misses), fields))
+    return games
+
+
+def main(arguments):
+    if len(arguments) != 1:
+        sys.exit('Usage: python hunt_telemetry.py square-hunt.log')
+    started = time.perf_counter()
+    try:
+        games = replay(arguments[0])
+    except (IOError, ValueError) as error:
+        sys.exit(str(error))
+    seconds = time.perf_counter() - started
+    for number, (game, end, stats) in enumerate(games, 1):
+        print('Game {}: {}x{} grid, {} target(s), seed {}: score {}{}'.format(
+            number, game.grid_box, game.grid_box, game.targets_per_tick, game.seed, game.score,
+            ' (as logged)' if end is not None else ' (restarted before it finished)'))
+        print_histograms(stats)
+    print('Replayed {} game(s) in {:.3f} s'.format(len(games), seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,241 @@
+""" Append-only operation journal for the LifeServe Blood Institute (LBI) donor and bag databases
+
+Every change to the donor or bag stores is appended to the journal as one small line instead of rewriting the database
+files. The journal is split into numbered segments; compaction starts a new segment, writes the full state to the
+snapshot files in a background thread and then deletes the segments the snapshot covers. A meta file records which
+donor and bag files the remaining segments apply to, so load_db can rebuild the database by reading those files and
+replaying the segments in order.
+
+Each journal operation sets or deletes a whole record, so replaying an operation that is already reflected in the
+files does no harm. Together with writing every file to a temporary name and renaming it into place, that means a
+crash at any point leaves a database that replays to the last synced operation.
+"""
+
+import json
+import os
+import threading
+import time
+import zlib
+import metrics
+
+JOURNAL_PREFIX = 'lbi-journal-'
+JOURNAL_SUFFIX = '.log'
+SNAPSHOT_META = 'lbi-snapshot.meta'
+SYNC_EVERY = 64  # fsync once this many operations are waiting...
+SYNC_INTERVAL = 1.0  # ...or once this many seconds have passed since the last fsync
+COMPACT_BYTES = 4 * 1024 * 1024  # Compact once the live segments hold this many bytes
+
+
+def atomic_write(path, lines):
+    """ Write lines to path through a temporary file, so readers only ever see the old or the new contents """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as temp_file:
+        temp_file.writelines(lines)
+        temp_file.flush()
+        metrics.count('bytes_written', temp_file.tell())
+        os.fsync(temp_file.fileno())
+        metrics.count('fsyncs')
+    os.replace(temp_path, path)
+    _sync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def _sync_directory(directory):
+    """ fsync a directory so a rename or delete inside it is durable (not supported on every platform) """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+        metrics.count('fsyncs')
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def apply_op(donors, stock, op):
+    """ Apply one journal operation to the donor and bag stores """
+    kind = op[0]
+    if kind == 'donor':
+        donors.add(*op[1:])
+    elif kind == 'donor-':
+        if op[1] in donors:
+            donors.remove(op[1])
+    elif kind == 'bag':
+        stock.add(*op[1:])
+    elif kind == 'bag-':
+        if op[1] in stock:
+            stock.remove(op[1])
+    else:
+        raise ValueError('Unknown journal operation: ' + str(kind))
+
+
+class Journal:
+    """ Segmented append-only journal with batched fsync and background compaction """
+
+    def __init__(self, directory='.', sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL,
+                 compact_bytes=COMPACT_BYTES):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_bytes = compact_bytes
+        self.file = None  # Segment currently open for appending
+        self.segment = 0  # Number of the current segment
+        self.pending = 0  # Operations written since the last fsync
+        self.last_sync = time.monotonic()
+        self.live_bytes = 0  # Bytes held in segments not yet covered by a snapshot
+        self.compactor = None  # Background compaction thread, if one is running
+        self.error = None  # Exception raised by the last background compaction
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segments(self):
+        """ Return the numbers of the segment files on disk, in order """
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(JOURNAL_PREFIX) and name.endswith(JOURNAL_SUFFIX):
+                numbers.append(int(name[len(JOURNAL_PREFIX):-len(JOURNAL_SUFFIX)]))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return self._path('{}{:06d}{}'.format(JOURNAL_PREFIX, number, JOURNAL_SUFFIX))
+
+    def read_meta(self):
+        """ Return (donor file, bag file, last compacted segment) from the meta file, or None if there is none """
+        try:
+            with open(self._path(SNAPSHOT_META), 'r') as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        return meta['donors'], meta['bags'], meta['segment']
+
+    def read_origin(self):
+        """ Return (donor file, bag file) the journal was first started on, which its snapshots replace, or None if
+        there is no meta file """
+        try:
+            with open(self._path(SNAPSHOT_META), 'r') as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        return tuple(meta.get('origin', (meta['donors'], meta['bags'])))  # Older meta files only name one pair
+
+    def write_meta(self, donor_file, bag_file, segment):
+        """ Record which files the journal applies to and the last segment they already include, keeping the files
+        the journal was first started on """
+        origin = self.read_origin() or (donor_file, bag_file)
+        meta = {'donors': donor_file, 'bags': bag_file, 'segment': segment, 'origin': list(origin)}
+        atomic_write(self._path(SNAPSHOT_META), [json.dumps(meta) + '\n'])
+
+    def replay(self):
+        """ Yield every operation in the live segments, in the order it was appended
+
+        Reading a segment stops at the first torn or corrupt line, which can only be the tail of an append that was
+        in progress when the program stopped """
+        meta = self.read_meta()
+        compacted = meta[2] if meta is not None else 0
+        for number in self.segments():
+            if number <= compacted:
+                continue  # Already part of the snapshot files
+            with open(self._segment_path(number), 'r') as segment_file:
+                for line in segment_file:
+                    checksum, _, body = line.rstrip('\n').partition(' ')
+                    if not line.endswith('\n') or checksum != '{:08x}'.format(zlib.crc32(body.encode())):
+                        break
+                    self.live_bytes += len(line)
+                    metrics.count('bytes_read', len(line))
+                    metrics.count('rows_scanned')
+                    yield json.loads(body)
+
+    def start(self, donor_file, bag_file):
+        """ Open a fresh segment for this session, recording the base files first if the journal is new """
+        meta = self.read_meta()
+        if meta is None:
+            self.write_meta(donor_file, bag_file, 0)
+            meta = (donor_file, bag_file, 0)
+        self.segment = max(self.segments() + [meta[2]]) + 1
+        # A new segment per session keeps a torn tail from an earlier crash at the end of its own segment
+        self.file = open(self._segment_path(self.segment), 'a')
+        _sync_directory(os.path.abspath(self.directory))
+
+    def append(self, op):
+        """ Append one operation; it is fsynced as part of the next batch """
+        body = json.dumps(op)
+        line = '{:08x} {}\n'.format(zlib.crc32(body.encode()), body)
+        self.file.write(line)
+        self.live_bytes += len(line)
+        metrics.count('bytes_written', len(line))
+        self.pending += 1
+        if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Flush and fsync every operation appended so far """
+        if self.pending:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            metrics.count('fsyncs')
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def flush(self):
+        """ Hand every operation appended so far to the operating system and return the file descriptor to fsync to
+        make them durable, so the fsync can run in another thread while appending carries on """
+        self.file.flush()
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        return self.file.fileno()
+
+    def should_compact(self):
+        """ Return True when the live segments are big enough to be worth folding into a snapshot """
+        running = self.compactor is not None and self.compactor.is_alive()
+        return self.live_bytes >= self.compact_bytes and not running
+
+    def compact(self, donor_file, bag_file, donor_lines, bag_lines):
+        """ Start a new segment and write the given snapshot lines to donor_file and bag_file in the background
+
+        donor_lines and bag_lines must describe the state as of every operation appended so far """
+        self.wait()
+        self.sync()
+        covered = self.segment
+        self.file.close()
+        self.segment += 1
+        self.file = open(self._segment_path(self.segment), 'a')
+        self.live_bytes = 0
+        self.compactor = threading.Thread(target=self._write_snapshot,
+                                          args=(donor_file, bag_file, donor_lines, bag_lines, covered))
+        self.compactor.start()
+
+    def _write_snapshot(self, donor_file, bag_file, donor_lines, bag_lines, covered):
+        """ Body of the compaction thread """
+        try:
+            atomic_write(donor_file, donor_lines)
+            atomic_write(bag_file, bag_lines)
+            self.write_meta(donor_file, bag_file, covered)
+            for number in self.segments():
+                if number <= covered:
+                    os.remove(self._segment_path(number))
+            _sync_directory(os.path.abspath(self.directory))
+        except OSError as error:
+            self.error = error  # The segments are still on disk, so nothing is lost; reported by wait()
+
+    def wait(self):
+        """ Wait for a running compaction to finish, re-raising any error it hit """
+        if self.compactor is not None:
+            self.compactor.join()
+            self.compactor = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """ Finish any compaction, sync the journal and close the current segment """
+        self.wait()
+        if self.file is not None:
+            self.sync()
+            empty = self.file.tell() == 0
+            self.file.close()
+            self.file = None
+            if empty:  # Nothing was appended this session, so the segment is not worth keeping
+                os.remove(self._segment_path(self.segment))
@@ -0,0 +1,133 @@
+""" Opt-in latency and I/O instrumentation for the LifeServe Blood Institute (LBI) blood bank program
+
+Functions decorated with @timed record a latency histogram each, and count() adds to counters (rows scanned, bytes
+read and written, fsyncs) of every timed function currently running in the thread, so a save_db inside attend_demand
+counts towards both. Work done by other threads, such as background compaction, is counted under 'background'.
+
+Collection is off unless the LBI_METRICS environment variable is set: to a file name, the figures are written there as
+JSON on exit; to 1, a summary is printed to stderr on exit. While it is off, a timed call or count() costs one check.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+BUCKETS = 32  # Latency bucket i counts calls taking under 2 ** i microseconds (the last one counts the rest)
+BACKGROUND = 'background'
+
+_stats = None  # {operation name: OperationStats} while collecting, None when disabled
+_local = threading.local()
+
+
+class OperationStats:
+    """ Latency histogram and counters of one operation """
+
+    def __init__(self):
+        self.histogram = [0] * BUCKETS
+        self.calls = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.counters = {}
+
+    def record(self, seconds):
+        """ Add one call that took seconds """
+        self.calls += 1
+        self.seconds += seconds
+        self.slowest = max(self.slowest, seconds)
+        self.histogram[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """ Return the upper bound, in seconds, of the histogram bucket holding the given fraction of calls """
+        wanted = fraction * self.calls
+        seen = 0
+        for bucket, calls in enumerate(self.histogram):
+            seen += calls
+            if calls and seen >= wanted:
+                return min(2 ** bucket / 1e6, self.slowest)
+        return self.slowest
+
+    def to_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'max': self.slowest,
+                'p50': self.percentile(0.5), 'p95': self.percentile(0.95), 'p99': self.percentile(0.99),
+                'histogram_us': {str(2 ** bucket): calls for bucket, calls in enumerate(self.histogram) if calls},
+                'counters': self.counters}
+
+
+def enable(path=None):
+    """ Start collecting; on exit the figures are written to path as JSON, or printed to stderr if path is None """
+    global _stats
+    if _stats is None:
+        _stats = {}
+        atexit.register(dump, path)
+
+
+def enabled():
+    return _stats is not None
+
+
+def _operation(name):
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = OperationStats()
+    return stats
+
+
+def timed(function):
+    """ Decorator recording the latency of every call of function under its name """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _stats is None:
+            return function(*args, **kwargs)
+        running = getattr(_local, 'running', None)
+        if running is None:
+            running = _local.running = []
+        running.append(name)
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _operation(name).record(time.perf_counter() - started)
+            running.pop()
+
+    return wrapper
+
+
+def count(counter, amount=1):
+    """ Add amount to a counter of every timed operation running in this thread """
+    if _stats is None:
+        return
+    running = getattr(_local, 'running', None) or [BACKGROUND]
+    for name in set(running):  # A function running inside itself counts once
+        counters = _operation(name).counters
+        counters[counter] = counters.get(counter, 0) + amount
+
+
+def snapshot():
+    """ Return the figures collected so far as a dictionary """
+    return {name: stats.to_dict() for name, stats in sorted((_stats or {}).items())}
+
+
+def dump(path=None):
+    """ Write the figures to path as JSON, or print a summary to stderr if path is None """
+    if path is not None:
+        with open(path, 'w') as metrics_file:
+            json.dump(snapshot(), metrics_file, indent=2)
+        return
+    print('{:<18}{:>8}{:>11}{:>11}{:>11}{:>11}  counters'.format('operation', 'calls', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                                 'max ms'), file=sys.stderr)
+    for name, figures in snapshot().items():
+        counters = ', '.join(key + '=' + format(value, ',') for key, value in sorted(figures['counters'].items()))
+        print('{:<18}{:>8}{:>11.3f}{:>11.3f}{:>11.3f}{:>11.3f}  {}'.format(
+            name, figures['calls'], figures['p50'] * 1000, figures['p95'] * 1000, figures['p99'] * 1000,
+            figures['max'] * 1000, counters), file=sys.stderr)
+
+
+_setting = os.environ.get('LBI_METRICS')
+if _setting:
+    enable(None if _setting == '1' else _setting)
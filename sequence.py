@@ -0,0 +1,70 @@
+""" Durable, monotonic ID sequence for new blood bags
+
+The sequence file holds the next ID nobody has reserved yet. A program reserves a block of IDs by locking the sequence,
+reading that value, writing back value + block size and releasing the lock, and then hands the block out from memory.
+Every terminal that records donations therefore gets its own disjoint range, and a new bag costs one file update per
+block instead of a scan of the bags file. IDs left unused in a block when a program exits are simply skipped.
+"""
+
+from journal import atomic_write
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+BLOCK_SIZE = 32  # IDs reserved at a time
+
+
+class IdSequence:
+    """ Hands out IDs from blocks reserved in a shared sequence file """
+
+    def __init__(self, path, floor=1, block_size=BLOCK_SIZE):
+        self.path = path
+        self.floor = floor  # No ID below this is handed out, e.g. one more than the highest ID already in use
+        self.block_size = block_size
+        self.next = 0  # Next ID of the current block
+        self.end = 0  # One past the last ID of the current block
+
+    def next_id(self):
+        """ Return a new, never before issued ID """
+        if self.next >= self.end:
+            self.next, self.end = self.reserve(self.block_size)
+        issued = self.next
+        self.next += 1
+        return issued
+
+    def reserve(self, count):
+        """ Reserve count consecutive IDs for the caller and return them as a (first, end) range """
+        with open(self.path + '.lock', 'a+') as lock_file:
+            _lock(lock_file)
+            try:
+                try:
+                    with open(self.path, 'r') as sequence_file:
+                        first = int(sequence_file.read().strip() or 0)
+                except FileNotFoundError:
+                    first = 0
+                first = max(first, self.floor)
+                atomic_write(self.path, [str(first + count) + '\n'])  # Durable before any ID is used
+            finally:
+                _unlock(lock_file)
+        return first, first + count
+
+
+def _lock(lock_file):
+    """ Block until this process holds the exclusive lock on lock_file """
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock(lock_file):
+    """ Release the lock taken by _lock """
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
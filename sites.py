@@ -0,0 +1,303 @@
+""" Stock of every LifeServe Blood Institute (LBI) collection centre, without loading every centre's bags
+
+Each collection centre runs its own copy of Assignment_3 in its own directory, with its own bags file and journal. A
+sites file lists the centres, one per line: name,directory,latitude,longitude (a relative directory is taken from
+the sites file's directory). SiteInventory reads the centres' bags in a pool of processes, one centre per task, so the
+centres are read side by side, one per core. Each worker reads a centre's bags file (from its column cache when it
+is up to date) and replays the bag changes in its journal. It then sends back only a SiteStock: the centre's bag
+count per blood group and its oldest bag of each group, so no process ever holds more than one centre's bags.
+
+The summaries answer "which is the nearest centre that can supply this group?", are added up into the stock across
+every centre, and are only reloaded for centres whose files have changed since they were read:
+python sites.py sites.txt A+ --near=-37.81,144.96
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+import time
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from column_cache import read_cached
+from columnar import read_bags
+from compatibility import BLOOD_GROUPS, GROUP_CODES, dispatch_groups
+from blood_store import choose_bag, parse_day, last_occurrences
+from journal import Journal, JOURNAL_PREFIX, SNAPSHOT_META
+
+BAGS_FILE = 'bags.txt'  # Bags file of a centre that has no journal yet
+EARTH_RADIUS = 6371.0  # Mean radius of the earth in km, for distances between centres
+BAG_SHELF_LIFE = 30  # Days a bag can be referred for after collection, as in Assignment_3_11747979.py
+
+
+class Site:
+    """ A collection centre: its name, its directory and where it is """
+
+    def __init__(self, name, directory, latitude, longitude):
+        self.name = name
+        self.directory = directory
+        self.latitude = latitude
+        self.longitude = longitude
+        self.stock = None  # SiteStock as last read
+        self.state = None  # (site_state() of the files, expiry cutoff) the stock was read with
+
+    def distance(self, latitude, longitude):
+        """ Return the great-circle distance in km from this site to a point (haversine formula) """
+        phi1, phi2 = math.radians(self.latitude), math.radians(latitude)
+        half_chord = (math.sin((phi2 - phi1) / 2) ** 2 +
+                      math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude - self.longitude) / 2) ** 2)
+        return 2 * EARTH_RADIUS * math.asin(math.sqrt(half_chord))
+
+
+class SiteStock:
+    """ Summary of one centre's stock: bags per blood group and the oldest bag of each group that is still within its
+    shelf life. It answers the same group_counts, oldest and oldest_in_groups questions as blood_store.BagStore """
+
+    def __init__(self, counts, oldest, rows, bad_rows):
+        self.counts = counts  # Bags per group, in BLOOD_GROUPS order
+        # (collection date ordinal, bag ID) of the oldest bag per group that has not expired, or None
+        self.oldest_bags = oldest
+        self.rows = rows  # Bags in stock
+        self.bad_rows = bad_rows  # Rows of the bags file that could not be read
+
+    def group_counts(self):
+        return list(self.counts)
+
+    def oldest(self, blood_group):
+        """ Return (collection date ordinal, bag ID) for the oldest bag of a blood group, or None if there is none """
+        return self.oldest_bags[GROUP_CODES[blood_group]]
+
+    def group_of(self, bag_id):
+        """ Return the blood group of one of the oldest bags, or None if bag_id is not one of them """
+        for code, oldest in enumerate(self.oldest_bags):
+            if oldest is not None and oldest[1] == bag_id:
+                return BLOOD_GROUPS[code]
+        return None
+
+    def oldest_in_groups(self, blood_groups):
+        """ Return the ID of the bag to dispatch from blood_groups; see blood_store.choose_bag """
+        return choose_bag(self.oldest, blood_groups)
+
+
+def read_sites(path):
+    """ Read a sites file into a list of Sites. Raises ValueError for a malformed line or a repeated name, and
+    OSError if the file cannot be read """
+    base = os.path.dirname(os.path.abspath(path))
+    sites = []
+    names = set()
+    with open(path) as sites_file:
+        for line_number, line in enumerate(sites_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            try:
+                name, directory, latitude, longitude = fields
+                latitude, longitude = float(latitude), float(longitude)
+            except ValueError:
+                raise ValueError('line {} of {} is not name,directory,latitude,longitude'.format(line_number, path))
+            if name in names:
+                raise ValueError('site {} is listed twice in {}'.format(name, path))
+            names.add(name)
+            sites.append(Site(name, os.path.join(base, directory), latitude, longitude))
+    return sites
+
+
+def _bags_file(journal):
+    meta = journal.read_meta()
+    return os.path.join(journal.directory, meta[1] if meta is not None else BAGS_FILE)
+
+
+def site_state(directory):
+    """ Return the name, size and modification time of each file a centre's stock is read from. Any change to the
+    stock changes at least one of them """
+    names = [name for name in os.listdir(directory) if name.startswith(JOURNAL_PREFIX) or name == SNAPSHOT_META]
+    paths = [os.path.join(directory, name) for name in sorted(names)] + [_bags_file(Journal(directory))]
+    state = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue  # A segment deleted by a compaction since the directory was listed
+        state.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(state)
+
+
+def load_site(directory, expired_before=None):
+    """ Read a centre's stock and return its SiteStock, whose oldest bags leave out bags collected before
+    expired_before (a date). This runs in a worker process. Raises OSError if the bags file cannot be read and
+    ValueError if the journal holds an invalid operation """
+    journal = Journal(directory)
+    columns, errors = read_cached(_bags_file(journal), read_bags)
+    keep = last_occurrences(columns['id'])  # A repeated ID keeps its latest row
+    ids, codes, days = columns['id'][keep], columns['group'][keep], columns['date'][keep]
+    changes = {}  # Bag ID -> (group code, day) set by the journal, or None once it was removed
+    for op in journal.replay():
+        if op[0] == 'bag':
+            changes[op[1]] = (GROUP_CODES[op[2]], parse_day(op[3]))
+        elif op[0] == 'bag-':
+            changes[op[1]] = None
+        elif op[0] not in ('donor', 'donor-'):
+            raise ValueError('Unknown journal operation: ' + str(op[0]))
+    if changes:
+        unchanged = ~np.isin(ids, np.fromiter(changes, dtype=np.int64, count=len(changes)))
+        added = [(bag_id, change[0], change[1]) for bag_id, change in changes.items() if change is not None]
+        ids = np.concatenate([ids[unchanged], np.array([bag[0] for bag in added], dtype=np.int64)])
+        codes = np.concatenate([codes[unchanged], np.array([bag[1] for bag in added], dtype=np.uint8)])
+        days = np.concatenate([days[unchanged], np.array([bag[2] for bag in added], dtype=np.int32)])
+    counts = np.bincount(codes, minlength=len(BLOOD_GROUPS))[:len(BLOOD_GROUPS)].tolist()
+    rows = len(ids)
+    if expired_before is not None:  # Expired bags still count as stock until disposed of, but are never referred
+        fresh = days >= expired_before.toordinal()
+        ids, codes, days = ids[fresh], codes[fresh], days[fresh]
+    # The first bag of each group in (date, ID) order is its oldest
+    order = np.lexsort((ids, days))
+    group_codes, first = np.unique(codes[order], return_index=True)
+    oldest = [None] * len(BLOOD_GROUPS)
+    for code, position in zip(group_codes.tolist(), order[first].tolist()):
+        oldest[code] = (int(days[position]), int(ids[position]))
+    return SiteStock(counts, oldest, rows, len(errors))
+
+
+class SiteInventory:
+    """ The stock of every centre in a sites file, as SiteStock summaries read by a pool of worker processes """
+
+    def __init__(self, sites, workers=None):
+        self.sites = sites
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None  # Worker processes, started on the first refresh that needs them and kept for later ones
+
+    def _start_pool(self):
+        # Forking a process that runs other threads (Assignment_3's journal) can copy a lock mid-use, so where
+        # possible the workers are forked from a clean server process instead
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def refresh(self, expired_before=None):
+        """ Read the stock of every centre whose files have changed since it was last read, in parallel, leaving
+        bags collected before expired_before (a date) out of the oldest bags. Returns the names of the centres that
+        could not be read, whose last known stock is kept """
+        stale = []
+        failed = []
+        for site in self.sites:
+            try:
+                state = (site_state(site.directory), expired_before)  # A new cutoff also needs a new summary
+            except OSError:
+                failed.append(site.name)
+                continue
+            if state != site.state:
+                stale.append((site, state))
+        if not stale:
+            return failed
+        directories = [site.directory for site, state in stale]
+        if self.workers == 1 or (len(stale) == 1 and self.pool is None):  # Not worth starting processes for
+            results = [_try_load_site(directory, expired_before) for directory in directories]
+        else:
+            if self.pool is None:
+                self._start_pool()
+            results = list(self.pool.map(_try_load_site, directories, [expired_before] * len(directories)))
+        for (site, state), stock in zip(stale, results):
+            if stock is None:
+                failed.append(site.name)
+            else:
+                site.stock, site.state = stock, state
+        return failed
+
+    def group_counts(self):
+        """ Return the bags in stock per blood group across every centre, in BLOOD_GROUPS order """
+        totals = [0] * len(BLOOD_GROUPS)
+        for site in self.sites:
+            if site.stock is not None:
+                totals = [total + count for total, count in zip(totals, site.stock.counts)]
+        return totals
+
+    def nearest_with_stock(self, blood_group, latitude, longitude, exclude=None):
+        """ Return (site, distance in km, bag ID, bag group) for the nearest centre that holds a bag a blood_group
+        recipient can receive, with the bag it should dispatch, or None if no centre has one. The centre named
+        exclude, usually the one asking, is skipped """
+        groups = dispatch_groups(blood_group)
+        candidates = [(site.distance(latitude, longitude), site) for site in self.sites
+                      if site.stock is not None and site.name != exclude]
+        candidates.sort(key=lambda candidate: candidate[0])
+        for distance, site in candidates:
+            bag_id = site.stock.oldest_in_groups(groups)
+            if bag_id is not None:
+                return site, distance, bag_id, site.stock.group_of(bag_id)
+        return None
+
+    def find(self, name):
+        """ Return the site called name, or None """
+        for site in self.sites:
+            if site.name == name:
+                return site
+        return None
+
+
+def _try_load_site(directory, expired_before):
+    """ load_site, returning None instead of raising for a centre whose stock cannot be read """
+    try:
+        return load_site(directory, expired_before)
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Summarise the stock of every collection centre in a sites file')
+    parser.add_argument('sites', help='sites file: name,directory,latitude,longitude per line')
+    parser.add_argument('group', nargs='?', help='find the nearest centre that can supply this blood group')
+    parser.add_argument('--near', help='latitude,longitude to measure from, or the name of a site')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    options = parser.parse_args(arguments)
+    try:
+        inventory = SiteInventory(read_sites(options.sites), options.workers)
+    except (OSError, ValueError) as error:
+        sys.exit(str(error))
+    if options.group is not None and options.group not in GROUP_CODES:
+        sys.exit('Unknown blood group ' + options.group)
+
+    started = time.perf_counter()
+    failed = inventory.refresh(date.today() - timedelta(days=BAG_SHELF_LIFE))
+    seconds = time.perf_counter() - started
+    inventory.close()
+    print('{:<16}{:>12}'.format('site', 'bags') + ''.join('{:>10}'.format(group) for group in BLOOD_GROUPS))
+    for site in inventory.sites:
+        if site.stock is not None:
+            print('{:<16}{:>12,}'.format(site.name, site.stock.rows) +
+                  ''.join('{:>10,}'.format(count) for count in site.stock.counts))
+    totals = inventory.group_counts()
+    print('{:<16}{:>12,}'.format('all sites', sum(totals)) + ''.join('{:>10,}'.format(count) for count in totals))
+    print('Read {} site(s) in {:.3f} s with {} worker(s)'.format(len(inventory.sites), seconds, inventory.workers))
+    for name in failed:
+        print('Could not read the stock of', name)
+
+    if options.group is not None:
+        exclude = None
+        if options.near is None:
+            sys.exit('--near is needed to find the nearest centre')
+        origin = inventory.find(options.near)
+        if origin is not None:
+            latitude, longitude, exclude = origin.latitude, origin.longitude, origin.name
+        else:
+            try:
+                latitude, longitude = (float(value) for value in options.near.split(','))
+            except ValueError:
+                sys.exit('--near must be latitude,longitude or a site name')
+        found = inventory.nearest_with_stock(options.group, latitude, longitude, exclude)
+        if found is None:
+            print('No site has stock for', options.group)
+        else:
+            site, distance, bag_id, bag_group = found
+            print('Nearest stock for {}: {} ({:.1f} km), bag {} ({})'.format(options.group, site.name, distance,
+                                                                          bag_id, bag_group))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,299 @@
+""" SQLite storage backend for the LifeServe Blood Institute (LBI) donor and bag databases
+
+SQLiteDonorStore and SQLiteBagStore offer the same methods and Donor and Bag records as the in-memory DonorStore and
+BagStore, but every call is answered by an indexed query, so point reads, date range queries and updates work without
+loading the database into memory. Names and other fields can hold any character, commas included. Dates are stored as
+YYYY-MM-DD text, which sorts in date order.
+
+One database file holds the donors table and any number of stock tables. Running this module migrates the text files
+into a database in one go:
+python sqlite_store.py lbi.db [donors.txt] [bags.txt] [oldbags.txt]
+"""
+
+import re
+import sqlite3
+import sys
+from datetime import date
+from functools import partial
+import metrics
+from compatibility import BLOOD_GROUPS
+from columnar import read_donors, read_bags
+from blood_store import Donor, Bag, check_group, choose_bag, parse_day, _date_strings
+
+DEFAULT_STOCK_TABLE = 'bags'
+_TABLE_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+def _check_table(table):
+    """ Stock table names are put straight into SQL, so only plain lowercase identifiers are accepted """
+    if not _TABLE_NAME.match(table):
+        raise ValueError('Invalid stock table name: ' + table)
+    return table
+
+
+def create_tables(connection, stock_table=DEFAULT_STOCK_TABLE):
+    """ Create the donors table and a stock table, with their indexes and per-group bag counts, if they do not exist
+    yet. Triggers keep the counts up to date on every insert, update and delete, so reading them costs the same
+    whatever the size of the stock """
+    stock_table = _check_table(stock_table)
+    connection.executescript('''
+        PRAGMA recursive_triggers = ON;  -- INSERT OR REPLACE fires the delete trigger for the row it replaces
+        CREATE TABLE IF NOT EXISTS donors (id INTEGER PRIMARY KEY, name TEXT NOT NULL, phone TEXT NOT NULL,
+                                           email TEXT NOT NULL, blood_group TEXT NOT NULL,
+                                           last_donation TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS donors_by_group ON donors (blood_group, last_donation);
+        CREATE INDEX IF NOT EXISTS donors_by_date ON donors (last_donation);
+        CREATE TABLE IF NOT EXISTS {0} (id INTEGER PRIMARY KEY, blood_group TEXT NOT NULL, collected TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS {0}_by_group ON {0} (blood_group, collected, id);
+        CREATE INDEX IF NOT EXISTS {0}_by_date ON {0} (collected, id);
+        CREATE TABLE IF NOT EXISTS {0}_counts (blood_group TEXT PRIMARY KEY, bags INTEGER NOT NULL);
+        CREATE TRIGGER IF NOT EXISTS {0}_added AFTER INSERT ON {0} BEGIN
+            INSERT INTO {0}_counts VALUES (NEW.blood_group, 1) ON CONFLICT (blood_group) DO UPDATE SET bags = bags + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS {0}_removed AFTER DELETE ON {0} BEGIN
+            UPDATE {0}_counts SET bags = bags - 1 WHERE blood_group = OLD.blood_group;
+        END;
+        CREATE TRIGGER IF NOT EXISTS {0}_regrouped AFTER UPDATE OF blood_group ON {0} BEGIN
+            UPDATE {0}_counts SET bags = bags - 1 WHERE blood_group = OLD.blood_group;
+            INSERT INTO {0}_counts VALUES (NEW.blood_group, 1) ON CONFLICT (blood_group) DO UPDATE SET bags = bags + 1;
+        END;
+    '''.format(stock_table))
+    # A database written before the counts existed gets them counted once
+    if connection.execute('SELECT COUNT(*) FROM {}_counts'.format(stock_table)).fetchone()[0] == 0:
+        connection.execute('INSERT INTO {0}_counts SELECT blood_group, COUNT(*) FROM {0} GROUP BY blood_group'
+                           .format(stock_table))
+        connection.commit()
+
+
+def open_database(path, stock_table=DEFAULT_STOCK_TABLE):
+    """ Open (or create) a database file and return its (donor store, bag store) """
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')  # Readers do not block the writer, and commits are cheap
+    create_tables(connection, stock_table)
+    return SQLiteDonorStore(connection), SQLiteBagStore(connection, stock_table)
+
+
+def _donor(row):
+    """ Turn a (name, phone, email, blood group, last donation) row into a Donor """
+    return Donor(row[0], row[1], row[2], row[3], parse_day(row[4]))
+
+
+class SQLiteDonorStore:
+    """ Donor records in the donors table, with the same methods as blood_store.DonorStore """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.journal = None  # SQLite keeps its own journal
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM donors').fetchone()[0]
+
+    def __contains__(self, donor_id):
+        return self.get(donor_id) is not None
+
+    def get(self, donor_id):
+        """ Return the details of a donor, or None if the ID is not in the database """
+        row = self.connection.execute('SELECT name, phone, email, blood_group, last_donation FROM donors WHERE id = ?',
+                                      (donor_id,)).fetchone()
+        return _donor(row) if row is not None else None
+
+    def items(self):
+        """ Yield (donor ID, details) pairs in ID order """
+        cursor = self.connection.execute('SELECT id, name, phone, email, blood_group, last_donation FROM donors '
+                                         'ORDER BY id')
+        for row in cursor:
+            yield row[0], _donor(row[1:])
+
+    def add(self, donor_id, name, phone, email, blood_group, last_donation_date):
+        """ Add a donor, replacing any existing record with the same ID. Raises ValueError for an unknown blood group
+        or a malformed date """
+        check_group(blood_group)
+        date.fromisoformat(last_donation_date)  # Reject a malformed date before it reaches the table
+        self.connection.execute('INSERT OR REPLACE INTO donors VALUES (?, ?, ?, ?, ?, ?)',
+                                (donor_id, name, phone, email, blood_group, last_donation_date))
+
+    def remove(self, donor_id):
+        """ Remove a donor. The DELETE itself decides whether the donor was there, so a donor another connection
+        removed in the meantime raises KeyError """
+        rows = self.connection.execute('DELETE FROM donors WHERE id = ? RETURNING name, phone, email, blood_group, '
+                                       'last_donation', (donor_id,)).fetchall()
+        if not rows:
+            raise KeyError(donor_id)
+        return _donor(rows[0])
+
+    def update_last_donation(self, donor_id, new_date):
+        """ Set a donor's last donation date (YYYY-MM-DD) """
+        date.fromisoformat(new_date)
+        if self.connection.execute('UPDATE donors SET last_donation = ? WHERE id = ?',
+                                   (new_date, donor_id)).rowcount == 0:
+            raise KeyError(donor_id)
+
+    def in_groups(self, blood_groups):
+        """ Yield (donor ID, details) for every donor whose blood group is in blood_groups, group by group """
+        for group in blood_groups:
+            cursor = self.connection.execute('SELECT id, name, phone, email, blood_group, last_donation FROM donors '
+                                             'WHERE blood_group = ? ORDER BY last_donation, id', (group,))
+            for row in cursor:
+                yield row[0], _donor(row[1:])
+
+    def donated_between(self, first_day, last_day):
+        """ Return the IDs of donors whose last donation date falls within [first_day, last_day] """
+        cursor = self.connection.execute('SELECT id FROM donors WHERE last_donation BETWEEN ? AND ? '
+                                         'ORDER BY last_donation, id', (first_day.isoformat(), last_day.isoformat()))
+        return [row[0] for row in cursor]
+
+    def eligible(self, blood_groups, last_day, limit, after=None):
+        """ Return up to limit (donor ID, details) pairs for donors in blood_groups whose last donation was on or
+        before last_day, the longest since donating first; see blood_store.DonorStore.eligible """
+        blood_groups = list(blood_groups)
+        if not blood_groups:
+            return []
+        after_date, after_id = (date.fromordinal(after[0]).isoformat(), after[1]) if after is not None else ('', 0)
+        cursor = self.connection.execute(
+            'SELECT id, name, phone, email, blood_group, last_donation FROM donors '
+            'WHERE blood_group IN ({}) AND last_donation <= ? AND (last_donation > ? OR last_donation = ? AND id > ?) '
+            'ORDER BY last_donation, id LIMIT ?'.format(', '.join('?' * len(blood_groups))),
+            blood_groups + [last_day.isoformat(), after_date, after_date, after_id, limit])
+        return [(row[0], _donor(row[1:])) for row in cursor]
+
+
+class SQLiteBagStore:
+    """ Blood bag records in a stock table, with the same methods as blood_store.BagStore """
+
+    def __init__(self, connection, table=DEFAULT_STOCK_TABLE):
+        self.connection = connection
+        self.table = _check_table(table)
+        self.journal = None  # SQLite keeps its own journal
+        self.sequence = None  # IdSequence that new bag IDs are drawn from, once attached
+
+    def _query(self, sql, parameters=()):
+        return self.connection.execute(sql.format(self.table), parameters)
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM {}').fetchone()[0]
+
+    def __contains__(self, bag_id):
+        return self.get(bag_id) is not None
+
+    def get(self, bag_id):
+        """ Return the details of a bag, or None if it is not in stock """
+        row = self._query('SELECT blood_group, collected FROM {} WHERE id = ?', (bag_id,)).fetchone()
+        return Bag(row[0], parse_day(row[1])) if row is not None else None
+
+    def items(self):
+        """ Yield (bag ID, details) pairs in ID order """
+        for bag_id, blood_group, collected in self._query('SELECT id, blood_group, collected FROM {} ORDER BY id'):
+            yield bag_id, Bag(blood_group, parse_day(collected))
+
+    def max_id(self):
+        """ Return the highest bag ID in stock, or 0 if there are none """
+        return self._query('SELECT COALESCE(MAX(id), 0) FROM {}').fetchone()[0]
+
+    def add(self, bag_id, blood_group, date_collected):
+        """ Add a bag, replacing any existing record with the same ID. Raises ValueError for an unknown blood group or a
+        malformed date """
+        check_group(blood_group)
+        date.fromisoformat(date_collected)
+        self._query('INSERT OR REPLACE INTO {} VALUES (?, ?, ?)', (bag_id, blood_group, date_collected))
+
+    def remove(self, bag_id):
+        """ Remove a bag (dispatched or disposed of). The DELETE itself decides whether the bag was in stock, so
+        a bag another terminal dispatched in the meantime raises KeyError instead of being dispatched twice """
+        rows = self._query('DELETE FROM {} WHERE id = ? RETURNING blood_group, collected', (bag_id,)).fetchall()
+        if not rows:
+            raise KeyError(bag_id)
+        return Bag(rows[0][0], parse_day(rows[0][1]))
+
+    def dispose(self, bag_ids):
+        """ Remove a batch of bags. Returns the IDs that were no longer in stock """
+        return [bag_id for bag_id in bag_ids if self._query('DELETE FROM {} WHERE id = ?', (bag_id,)).rowcount == 0]
+
+    def count(self, blood_group, expired_before=None):
+        """ Return the number of bags in stock for a blood group, leaving out bags collected before expired_before """
+        if expired_before is not None:
+            return self._query('SELECT COUNT(*) FROM {} WHERE blood_group = ? AND collected >= ?',
+                               (blood_group, expired_before.isoformat())).fetchone()[0]
+        row = self._query('SELECT bags FROM {}_counts WHERE blood_group = ?', (blood_group,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def group_counts(self):
+        """ Return the number of bags in stock for each of the eight blood groups, in BLOOD_GROUPS order """
+        counts = dict(self._query('SELECT blood_group, bags FROM {}_counts'))
+        return [counts.get(group, 0) for group in BLOOD_GROUPS]
+
+    def oldest(self, blood_group, expired_before=None):
+        """ Return (collection date ordinal, bag ID) for the oldest bag of a blood group, or None if there is none.
+        Bags collected before expired_before are skipped """
+        bags = self.oldest_bags(blood_group, 1, expired_before, with_days=True)
+        return bags[0] if bags else None
+
+    def oldest_bags(self, blood_group, count, expired_before=None, with_days=False):
+        """ Return the IDs of up to count bags of a blood group, oldest first, skipping bags collected before
+        expired_before """
+        first_date = expired_before.isoformat() if expired_before is not None else ''
+        cursor = self._query('SELECT collected, id FROM {} WHERE blood_group = ? AND collected >= ? '
+                             'ORDER BY collected, id LIMIT ?', (blood_group, first_date, count))
+        if with_days:
+            return [(parse_day(collected), bag_id) for collected, bag_id in cursor]
+        return [bag_id for collected, bag_id in cursor]
+
+    def oldest_in_groups(self, blood_groups, expired_before=None):
+        """ Return the ID of the bag to dispatch from blood_groups; see blood_store.BagStore.oldest_in_groups """
+        return choose_bag(partial(self.oldest, expired_before=expired_before), blood_groups)
+
+    def collected_before(self, day):
+        """ Return the IDs of bags collected strictly before the given date, oldest first """
+        cursor = self._query('SELECT id FROM {} WHERE collected < ? ORDER BY collected, id', (day.isoformat(),))
+        return [row[0] for row in cursor]
+
+    def commit(self):
+        """ Make every change so far durable """
+        self.connection.commit()
+        metrics.count('commits')
+
+    def close(self):
+        """ Commit and close the database """
+        self.connection.commit()
+        self.connection.close()
+
+
+def migrate(db_path, donor_file, stock_files):
+    """ Copy a donors text file and stock text files into a database in one transaction
+
+    stock_files maps each stock table name to the text file it is loaded from. Returns a dictionary of the rows each
+    file could not load, as lists of (line number, line text, reason) """
+    connection = sqlite3.connect(db_path)
+    skipped = {}
+    try:
+        create_tables(connection)
+        donor_columns, skipped[donor_file] = read_donors(donor_file)
+        connection.executemany('INSERT OR REPLACE INTO donors VALUES (?, ?, ?, ?, ?, ?)',
+                               zip(donor_columns['id'].tolist(), donor_columns['name'], donor_columns['phone'],
+                                   donor_columns['email'],
+                                   [BLOOD_GROUPS[code] for code in donor_columns['group'].tolist()],
+                                   _date_strings(donor_columns['date'])))
+        for table, stock_file in stock_files.items():
+            create_tables(connection, table)
+            bag_columns, skipped[stock_file] = read_bags(stock_file)
+            connection.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?, ?)'.format(table),
+                                   zip(bag_columns['id'].tolist(),
+                                       [BLOOD_GROUPS[code] for code in bag_columns['group'].tolist()],
+                                       _date_strings(bag_columns['date'])))
+        connection.commit()
+    finally:
+        connection.close()
+    return skipped
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python sqlite_store.py lbi.db [donors.txt] [bags.txt] [oldbags.txt]')
+    arguments = sys.argv[2:] + ['donors.txt', 'bags.txt', 'oldbags.txt'][len(sys.argv) - 2:]
+    try:
+        bad_rows = migrate(sys.argv[1], arguments[0], {'bags': arguments[1], 'oldbags': arguments[2]})
+    except (OSError, sqlite3.Error) as error:
+        sys.exit('Migration failed: ' + str(error))
+    for file_name, errors in bad_rows.items():
+        for line_number, line, reason in errors:
+            print('Skipped line', line_number, 'of', file_name + ':', reason, '(' + line + ')')
+    print('Migrated', arguments[0], arguments[1], 'and', arguments[2], 'into', sys.argv[1])
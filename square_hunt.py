@@ -0,0 +1,210 @@
+""" Headless Square Hunt engine
+
+SquareHunt holds the rules and state of one game with no drawing: targets appear in random grid boxes on one tick and
+are cleared on the next, and a click inside a target scores a point while any other click loses one. Live targets are
+kept by cell number, so a tick costs time in proportion to the number of targets and a click is scored by integer cell
+arithmetic, however large the grid. Targets are placed by the game's own seeded random generator and time is a
+virtual clock advanced by the ticks, so a game is fully determined by its settings, its seed and its clicks.
+Assignment_2 draws a SquareHunt on screen; run() plays one against a scripted click stream or a Bot without a display,
+thousands of games a second:
+python square_hunt.py --games 10000 --grid 100 --targets 20 --difficulty 3 --accuracy 0.8
+"""
+
+import argparse
+import heapq
+import random
+import sys
+import time
+
+# Layout of the grid, in screen coordinates
+GRID_SIZE = 700  # Size of the grid (700 x 700)
+BTM_LEFT_X = -350  # Bottom left corner of grid (x-coordinate)
+BTM_LEFT_Y = -375  # Bottom left corner of grid (y-coordinate)
+MARGIN = 10  # Margin around size of the target box in pixels
+
+# Rules
+SQUARES = 10  # Target squares shown in a game; each is drawn on one tick and cleared on the next
+MIN_GRID, MAX_GRID = 3, 100  # Grid sizes (boxes per side) that can be played
+MARGIN_SHARE = 5  # On small boxes the margin shrinks to a fifth of the box, so the target stays visible
+DIFFICULTY_INTERVALS = {1: 2, 2: 1.5, 3: 1}  # Seconds between ticks at each difficulty level
+
+# Results of a tick
+DRAW = 'draw'
+CLEAR = 'clear'
+FINISHED = 'finished'
+
+
+def max_targets(grid_box):
+    """ Return the most targets that can be live at once on a grid_box x grid_box grid """
+    return grid_box * grid_box // 2
+
+
+class SquareHunt:
+    """ State of one game of Square Hunt on a grid_box x grid_box grid, ticking every interval seconds, with targets
+    targets shown at a time. Cells are numbered row * grid_box + column from the bottom left """
+
+    def __init__(self, grid_box, interval, seed=None, squares=SQUARES, targets=1):
+        if not MIN_GRID <= grid_box <= MAX_GRID:
+            raise ValueError('grid size must be {}-{}'.format(MIN_GRID, MAX_GRID))
+        if not 1 <= targets <= max_targets(grid_box):
+            raise ValueError('targets must be 1-{}'.format(max_targets(grid_box)))
+        self.grid_box = grid_box
+        self.interval = interval
+        self.squares = squares
+        self.targets_per_tick = targets
+        self.box_size = GRID_SIZE / grid_box  # Get the dimensions of each grid box, as drawn by the grid lines
+        self.margin = min(MARGIN, self.box_size / MARGIN_SHARE)  # Margin between a box and its target
+        self.target_size = self.box_size - 2 * self.margin  # Get the dimensions of the target square
+        self.seed = seed if seed is not None else random.randrange(2 ** 63)  # Kept so the game can be replayed
+        self.rng = random.Random(self.seed)
+        self.score = 0
+        self.square_count = 0  # Ticks so far: odd ones draw targets, even ones clear them
+        self.now = 0.0  # Virtual time of the last tick, in seconds since the game started
+        self.targets = {}  # Live targets: cell -> 'shown' while it can be hit, 'hit' once it has been
+        self.spawned = []  # Cells whose targets the last tick drew
+        self.expired = []  # Cells whose targets the last tick cleared
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def finished(self):
+        return self.square_count > 2 * self.squares
+
+    @property
+    def squares_shown(self):
+        """ Targets drawn and cleared so far """
+        return self.square_count // 2
+
+    def tick(self):
+        """ Advance the game by one tick and return DRAW, CLEAR or FINISHED; spawned and expired list the cells whose
+        targets it drew and cleared. The first tick is at time 0 """
+        if self.square_count > 0:
+            self.now += self.interval
+        self.square_count += 1
+        self.spawned = []
+        self.expired = list(self.targets)  # Every tick clears the targets of the tick before
+        self.targets.clear()
+        if self.square_count > 2 * self.squares:
+            return FINISHED
+        if self.square_count % 2 == 0:
+            return CLEAR
+        while len(self.targets) < self.targets_per_tick:
+            # Pick a random free grid box: a column, then a row
+            cell = self.rng.randrange(self.grid_box) + self.rng.randrange(self.grid_box) * self.grid_box
+            if cell not in self.targets:
+                self.targets[cell] = 'shown'
+                self.spawned.append(cell)
+        return DRAW
+
+    def cell_at(self, x, y):
+        """ Return the cell whose target (x, y) is on, or None if it is outside every target square """
+        column, column_offset = divmod(x - BTM_LEFT_X, self.box_size)
+        row, row_offset = divmod(y - BTM_LEFT_Y, self.box_size)
+        if not (0 <= column < self.grid_box and 0 <= row < self.grid_box):
+            return None
+        low, high = self.margin, self.margin + self.target_size
+        if low <= column_offset <= high and low <= row_offset <= high:
+            return int(row) * self.grid_box + int(column)
+        return None
+
+    def click(self, x, y):
+        """ Score a click at (x, y): returns the cell of the target hit, or None for a miss """
+        cell = self.cell_at(x, y)
+        if self.targets.get(cell) == 'shown':
+            self.score += 1  # Increment score on a successful hit
+            self.hits += 1
+            self.targets[cell] = 'hit'
+            return cell
+        self.score = max(0, self.score - 1)  # A miss loses a point, but the score never goes below zero
+        self.misses += 1
+        return None
+
+    def target_corner(self, cell):
+        """ Return the bottom left corner of the target square in cell """
+        row, column = divmod(cell, self.grid_box)
+        return (BTM_LEFT_X + column * self.box_size + self.margin, BTM_LEFT_Y + row * self.box_size + self.margin)
+
+    def target_centre(self, cell):
+        x, y = self.target_corner(cell)
+        return x + self.target_size / 2, y + self.target_size / 2
+
+    def run(self, clicks=(), player=None):
+        """ Play the whole game on the virtual clock and return the final score. clicks are (time, x, y) in time
+        order; player, if given, is called after every tick and returns more (time, x, y) clicks. Every click is
+        applied between the ticks its time falls between, so one made too late misses a target already cleared, and
+        clicks after the game has finished are ignored """
+        clicks = iter(clicks)
+        scripted = next(clicks, None)
+        pending = []  # Heap of player clicks not yet due
+        while self.tick() != FINISHED:
+            next_tick = self.now + self.interval
+            due = []
+            while scripted is not None and scripted[0] < next_tick:
+                due.append(scripted)
+                scripted = next(clicks, None)
+            if player is not None:
+                for click in player(self):
+                    heapq.heappush(pending, click)
+                while pending and pending[0][0] < next_tick:
+                    due.append(heapq.heappop(pending))
+                due.sort()
+            for click_time, x, y in due:
+                self.click(x, y)
+        return self.score
+
+
+class Bot:
+    """ Player for run() that aims at each new target after a reaction time drawn around reaction seconds. With
+    probability accuracy it clicks the target's centre, otherwise a random point of the grid (which may still hit) """
+
+    def __init__(self, accuracy=0.9, reaction=0.5, seed=None):
+        self.accuracy = accuracy
+        self.reaction = reaction
+        self.rng = random.Random(seed)
+
+    def __call__(self, game):
+        clicks = []
+        for cell in game.spawned:
+            click_time = game.now + self.rng.expovariate(1 / self.reaction)
+            if self.rng.random() < self.accuracy:
+                x, y = game.target_centre(cell)
+            else:
+                x = self.rng.uniform(BTM_LEFT_X, BTM_LEFT_X + GRID_SIZE)
+                y = self.rng.uniform(BTM_LEFT_Y, BTM_LEFT_Y + GRID_SIZE)
+            clicks.append((click_time, x, y))
+        return clicks
+
+
+def simulate(games, grid_box, difficulty, accuracy, reaction, seed=0, targets=1):
+    """ Play games bot games and return their scores. Game n uses seed + n for both the game and the bot """
+    interval = DIFFICULTY_INTERVALS[difficulty]
+    return [SquareHunt(grid_box, interval, seed + game, targets=targets).run(
+        player=Bot(accuracy, reaction, seed + game)) for game in range(games)]
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description='Simulate Square Hunt games played by a bot, without a display')
+    parser.add_argument('--games', type=int, default=1000, help='number of games to play')
+    parser.add_argument('--grid', type=int, default=MIN_GRID, help='grid size ({}-{})'.format(MIN_GRID, MAX_GRID))
+    parser.add_argument('--targets', type=int, default=1, help='targets shown at a time')
+    parser.add_argument('--difficulty', type=int, default=1, choices=sorted(DIFFICULTY_INTERVALS),
+                        help='difficulty level')
+    parser.add_argument('--accuracy', type=float, default=0.9, help='share of clicks aimed at the target')
+    parser.add_argument('--reaction', type=float, default=0.5, help='mean seconds before the bot clicks')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game')
+    options = parser.parse_args(arguments)
+    started = time.perf_counter()
+    try:
+        scores = simulate(options.games, options.grid, options.difficulty, options.accuracy, options.reaction,
+                          options.seed, options.targets)
+    except ValueError as error:
+        sys.exit(str(error))
+    seconds = time.perf_counter() - started
+    print('{:,} games in {:.2f} s ({:,.0f} games/s)'.format(len(scores), seconds, len(scores) / seconds))
+    if scores:
+        print('Mean score {:.2f} of {}, best {}, worst {}'.format(sum(scores) / len(scores), SQUARES * options.targets,
+                                                                  max(scores), min(scores)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+""" Headless stock reports for the LifeServe Blood Institute (LBI) blood bank
+
+StockChart draws the pie chart of the stock per blood group off screen (Agg) and writes it as PNG or SVG. The figure is
+created on the first chart and only redrawn when the counts change; until then the encoded image is reused, so a
+dashboard can refresh every few seconds for almost nothing. The counts come from the stores' group_counts(), which are
+kept up to date by every change, so no refresh rescans the stock.
+
+stock_series rebuilds the stock level per group after every change in the journal (the changes since the last
+compaction), which render_series plots as a line chart.
+
+python stock_report.py watch lbi.db stock.png [seconds]   refresh a chart of an SQLite database's stock
+python stock_report.py history stock-history.svg          plot the stock after every journalled change
+"""
+
+import io
+import os
+import sys
+import time
+import numpy as np
+from compatibility import BLOOD_GROUPS, GROUP_CODES
+from columnar import read_bags
+from journal import Journal
+
+REFRESH_INTERVAL = 5.0  # Seconds between dashboard refreshes
+
+
+def _write_image(path, image):
+    """ Replace path with image in one step, so a dashboard never shows a half-written file """
+    with open(path + '.tmp', 'wb') as image_file:
+        image_file.write(image)
+    os.replace(path + '.tmp', path)
+
+
+def _file_format(path):
+    return os.path.splitext(path)[1][1:].lower() or 'png'
+
+
+def _new_figure(size):
+    """ Create an off-screen figure. Matplotlib is only imported here, on the first chart, since importing it takes
+    longer than starting the rest of the program """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=size)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+class StockChart:
+    """ Pie chart of the bags in stock per blood group, drawn on one reused off-screen figure """
+
+    def __init__(self, size=(6, 6)):
+        self.size = size
+        self.figure = self.axes = None  # Created on the first draw
+        self.counts = None  # Counts the figure currently shows
+        self.images = {}  # File format -> the figure encoded in it, for the counts shown
+
+    def draw(self, counts):
+        """ Redraw the figure for counts (in BLOOD_GROUPS order); returns False if it already shows them """
+        counts = list(counts)
+        if counts == self.counts:
+            return False
+        if self.figure is None:
+            self.figure = _new_figure(self.size)
+            self.axes = self.figure.add_subplot()
+        self.axes.clear()
+        shown = [(group, count) for group, count in zip(BLOOD_GROUPS, counts) if count > 0]
+        self.axes.pie([count for group, count in shown],
+                      labels=['{} ({:,.0f})'.format(group, count) for group, count in shown])
+        self.axes.set_title('Bags in stock: {:,}'.format(sum(counts)))
+        self.counts = counts
+        self.images = {}
+        return True
+
+    def render(self, counts, path):
+        """ Write the chart of counts to path, as SVG if it ends in .svg and PNG otherwise; returns False if the
+        counts had not changed and the cached image was written again """
+        changed = self.draw(counts)
+        file_format = _file_format(path)
+        image = self.images.get(file_format)
+        if image is None:
+            buffer = io.BytesIO()
+            self.figure.savefig(buffer, format=file_format)
+            image = self.images[file_format] = buffer.getvalue()
+        _write_image(path, image)
+        return changed
+
+
+def stock_series(directory='.'):
+    """ Return the stock per blood group (lists in BLOOD_GROUPS order) as of the snapshot the journal in directory
+    applies to, followed by the stock after every bag change in the journal. Returns [] if there is no journal """
+    journal = Journal(directory)
+    meta = journal.read_meta()
+    if meta is None:
+        return []
+    columns, errors = read_bags(os.path.join(directory, meta[1]), ('id', 'group'))
+    groups = dict(zip(columns['id'].tolist(), columns['group'].tolist()))  # Bag ID -> group code; last row wins
+    counts = np.bincount(np.fromiter(groups.values(), dtype=np.int64, count=len(groups)),
+                         minlength=len(BLOOD_GROUPS))[:len(BLOOD_GROUPS)]
+    series = [counts.tolist()]
+    for op in journal.replay():
+        if op[0] == 'bag':
+            old = groups.get(op[1])
+            if old is not None:
+                counts[old] -= 1
+            groups[op[1]] = GROUP_CODES[op[2]]
+            counts[groups[op[1]]] += 1
+        elif op[0] == 'bag-' and op[1] in groups:
+            counts[groups.pop(op[1])] -= 1
+        else:
+            continue
+        series.append(counts.tolist())
+    return series
+
+
+def render_series(series, path, size=(8, 5)):
+    """ Write a line chart of stock_series output to path (PNG, or SVG if it ends in .svg) """
+    figure = _new_figure(size)
+    axes = figure.add_subplot()
+    levels = np.array(series).reshape(-1, len(BLOOD_GROUPS))
+    for code, group in enumerate(BLOOD_GROUPS):
+        axes.plot(levels[:, code], label=group)
+    axes.set_xlabel('Changes since the last compaction')
+    axes.set_ylabel('Bags in stock')
+    axes.legend(ncol=4)
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=_file_format(path))
+    _write_image(path, buffer.getvalue())
+
+
+def watch(db_path, path, interval=REFRESH_INTERVAL, stock_table=None):
+    """ Refresh the chart of an SQLite database's stock every interval seconds, until interrupted """
+    from sqlite_store import open_database, DEFAULT_STOCK_TABLE
+    donors, stock = open_database(db_path, stock_table or DEFAULT_STOCK_TABLE)
+    chart = StockChart()
+    try:
+        while True:
+            if chart.render(stock.group_counts(), path):
+                print('Stock changed:', dict(zip(BLOOD_GROUPS, chart.counts)))
+            time.sleep(interval)
+    finally:
+        stock.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'watch':
+        try:
+            watch(sys.argv[2], sys.argv[3], float(sys.argv[4]) if len(sys.argv) > 4 else REFRESH_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+    elif len(sys.argv) == 3 and sys.argv[1] == 'history':
+        render_series(stock_series(), sys.argv[2])
+    else:
+        sys.exit('Usage: python stock_report.py watch lbi.db stock.png [seconds]\n'
+                 '       python stock_report.py history stock-history.png')